@@ -0,0 +1,3 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python2.7
+"""
+Calls per second through BitmessageClient against a local single-threaded
+stub of the Bitmessage XML-RPC API. 'before' replays the old keep_alive
+(helloWorld before every call), 'after' is the current client.
+
+usage: python2.7 benchmarks/bitmessageclient_bench.py [calls]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.bitmessage_communication import bitmessageserver
+from shared.bitmessage_communication.bitmessageclient import BitmessageClient
+from settings_local import DEFAULT_ADDRESS_LABEL
+
+import base64
+import json
+import threading
+import time
+
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+CALLS = 2000
+
+class QuietRequestHandler(SimpleXMLRPCRequestHandler):
+  def log_message(self, *args):
+    pass
+
+def start_stub_api():
+  server = SimpleXMLRPCServer(('127.0.0.1', 0), requestHandler=QuietRequestHandler, logRequests=False)
+  address = {
+      'label': base64.encodestring(DEFAULT_ADDRESS_LABEL),
+      'address': 'BM-stub',
+      'stream': 1,
+      'enabled': True,
+      'chan': False}
+  server.register_function(lambda a, b: '%s-%s' % (a, b), 'helloWorld')
+  server.register_function(lambda: json.dumps({'addresses': [address]}), 'listAddresses2')
+  server.register_function(lambda name, addr: 'success', 'joinChan')
+  server.register_function(
+      lambda: json.dumps({'inboxMessageIds': [{'msgid': '%064x' % i} for i in range(20)]}),
+      'getAllInboxMessageIds')
+
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server.server_address[1]
+
+def measure(name, call, calls):
+  start = time.time()
+  for i in range(calls):
+    call()
+  elapsed = time.time() - start
+  print('%-7s %7.0f calls/s' % (name, calls / elapsed))
+
+def main():
+  calls = int(sys.argv[1]) if len(sys.argv) > 1 else CALLS
+
+  bitmessageserver.BITMESSAGE_HOST = '127.0.0.1'
+  bitmessageserver.BITMESSAGE_PORT = start_stub_api()
+  client = BitmessageClient()
+
+  def old_keep_alive_call():
+    assert(client.api.helloWorld('x', 'y') == 'x-y')
+    client.api.getAllInboxMessageIds()
+
+  measure('before', old_keep_alive_call, calls)
+  measure('after', client.get_inbox_ids, calls)
+
+if __name__=="__main__":
+  main()
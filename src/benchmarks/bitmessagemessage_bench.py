@@ -0,0 +1,93 @@
+#!/usr/bin/env python2.7
+"""
+Builds a synthetic 100k message inbox and compares the old eager
+BitmessageMessage with the lazy, __slots__ based one. Only every 20th
+message is opened, roughly what OracleCommunication does with chan traffic.
+
+usage: python2.7 benchmarks/bitmessagemessage_bench.py [messages]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.bitmessage_communication.bitmessagemessage import BitmessageMessage
+
+import base64
+import datetime
+import json
+import time
+
+MESSAGES = 100000
+OPENED_EVERY = 20
+
+class EagerBitmessageMessage:
+  # BitmessageMessage as it was before lazy decoding
+  def __init__(self, message_dict, client_address):
+    self.encoding_type = message_dict['encodingType']
+    self.from_address = message_dict['fromAddress']
+    self.to_address = message_dict['toAddress']
+    self.received_time_epoch = int(message_dict['receivedTime'])
+    self.received_time = datetime.datetime.fromtimestamp(self.received_time_epoch)
+    self.read = message_dict['read'] == True
+    self.msgid = message_dict['msgid']
+    self.subject_encoded = message_dict['subject']
+    self.subject = base64.decodestring(self.subject_encoded)
+    self.message_encoded = message_dict['message']
+    self.message = base64.decodestring(self.message_encoded)
+    self.direct = self.to_address == client_address
+
+def synthetic_inbox(count):
+  body = json.dumps({
+      'operation': 'sign',
+      'pwtxid': '3MZ1R2bLpuXnvDJvxoVQHqgk8nqnJbyWB9',
+      'transaction': '01' * 400})
+  messages = []
+  for i in range(count):
+    messages.append({
+        'encodingType': 2,
+        'fromAddress': 'BM-2cXemdJibdXtifKfTHR4somZbbCGAHRG4H',
+        'toAddress': 'BM-2cXemdJibdXtifKfTHR4somZbbCGAHRG4H',
+        'receivedTime': str(1400000000 + i),
+        'read': i % 2 == 0,
+        'msgid': '%064x' % i,
+        'subject': base64.encodestring('sign %d' % i),
+        'message': base64.encodestring(body)})
+  return json.dumps({'inboxMessages': messages})
+
+def footprint(msg):
+  # bytes owned by the message object itself; encoded strings are shared
+  # with the API response in both implementations so they're left out
+  size = sys.getsizeof(msg)
+  if hasattr(msg, '__dict__'):
+    size += sys.getsizeof(msg.__dict__)
+    decoded = [msg.subject, msg.message, msg.received_time]
+  else:
+    decoded = [msg._subject, msg._message]
+  return size + sum(sys.getsizeof(value) for value in decoded if value is not None)
+
+def run(name, build, inbox_json):
+  start = time.time()
+  messages = build(inbox_json)
+  built = time.time()
+  opened = 0
+  for idx, msg in enumerate(messages):
+    if msg.read or msg.direct:
+      continue
+    if idx % OPENED_EVERY == 1:
+      json.loads(msg.message)
+      opened += 1
+  done = time.time()
+  memory = sum(footprint(msg) for msg in messages)
+  print('%-6s build %6.0f ms   filter+open %5.0f ms   objects %6.1f MB   opened %d' % (
+      name, (built - start) * 1000, (done - built) * 1000, memory / 1e6, opened))
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+  inbox_json = synthetic_inbox(count)
+  print('%d messages, %.1f MB of API response' % (count, len(inbox_json) / 1e6))
+
+  run('eager', lambda j: [EagerBitmessageMessage(m, 'x') for m in json.loads(j)['inboxMessages']], inbox_json)
+  run('lazy', lambda j: BitmessageMessage.from_json(j, 'x'), inbox_json)
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python2.7
+"""
+Write throughput of KeyValue.update for the old db setup (rollback journal,
+synchronous=FULL, commit after every insert), WAL with commit after every
+insert, and WAL with all writes of a request committed in one transaction().
+
+usage: python2.7 benchmarks/db_write_bench.py [requests]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.db_classes import GeneralDb
+from oracle.oracle_db import KeyValue
+
+import tempfile
+import time
+
+REQUESTS = 500
+WRITES_PER_REQUEST = 4
+
+def old_db(filename):
+  db = GeneralDb(filename)
+  db.conn.execute('pragma journal_mode=delete')
+  db.conn.execute('pragma synchronous=full')
+  return db
+
+def write_request(kv, number):
+  for i in range(WRITES_PER_REQUEST):
+    kv.update('bench', '%d-%d' % (number, i), {'sigs_so_far': i})
+
+def measure(name, make_db, batched, requests):
+  filename = tempfile.mktemp(suffix='.db')
+  db = make_db(filename)
+  kv = KeyValue(db)
+
+  start = time.time()
+  for number in range(requests):
+    if batched:
+      with db.transaction():
+        write_request(kv, number)
+    else:
+      write_request(kv, number)
+  elapsed = time.time() - start
+
+  print('%-22s %8.0f writes/s' % (name, requests * WRITES_PER_REQUEST / elapsed))
+  for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(filename + suffix):
+      os.remove(filename + suffix)
+
+def main():
+  requests = int(sys.argv[1]) if len(sys.argv) > 1 else REQUESTS
+  measure('old', old_db, False, requests)
+  measure('wal', GeneralDb, False, requests)
+  measure('wal + transaction()', GeneralDb, True, requests)
+
+if __name__=="__main__":
+  main()
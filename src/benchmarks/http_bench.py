@@ -0,0 +1,79 @@
+#!/usr/bin/env python2.7
+"""
+Requests per second against a local keep-alive HTTP server, from several
+threads at once: urllib2 (new connection every request) and the pooled
+HttpClient from shared.liburl_wrapper.
+
+usage: python2.7 benchmarks/http_bench.py [threads] [requests_per_thread]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.liburl_wrapper import HttpClient
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import threading
+import time
+import urllib2
+
+THREADS = 8
+REQUESTS = 200
+
+BODY = '{"last": "400.00"}'
+
+class Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # send the response in one write, unbuffered writes of headers and body
+  # stall keep-alive connections on delayed ACKs
+  wbufsize = -1
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(BODY)))
+    self.end_headers()
+    self.wfile.write(BODY)
+
+  def log_message(self, *args):
+    pass
+
+def measure(name, get, threads, requests):
+  def run():
+    for i in xrange(requests):
+      assert(get() == BODY)
+
+  workers = [threading.Thread(target=run) for i in range(threads)]
+  start = time.time()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  elapsed = time.time() - start
+  print('%-10s %9.0f requests/s' % (name, threads * requests / elapsed))
+
+def main():
+  threads = int(sys.argv[1]) if len(sys.argv) > 1 else THREADS
+  requests = int(sys.argv[2]) if len(sys.argv) > 2 else REQUESTS
+
+  server = Server(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  url = 'http://127.0.0.1:%d/ticker' % server.server_address[1]
+
+  client = HttpClient(max_idle=threads)
+  print('%d threads, %d requests each' % (threads, requests))
+  measure('urllib2', lambda: urllib2.urlopen(url, timeout=10).read(), threads, requests)
+  measure('pooled', lambda: client.get(url, 10), threads, requests)
+  print('pool: %r' % client.stats())
+
+  client.close()
+  server.shutdown()
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python2.7
+"""
+Time a new bounty waits for its RSA keypair: generated on the spot, as
+before, and claimed from a filled KeyPool. Also keys per second the pool
+generates with its process pool.
+
+usage: python2.7 benchmarks/key_pool_bench.py [keys] [key_size]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.db_classes import GeneralDb
+from oracle.handlers.bounty_contract import key_pool
+from oracle.handlers.bounty_contract.key_pool import KeyPool, KEY_POOL_PROCESSES, generate_keypair
+
+import tempfile
+import time
+
+KEYS = 8
+
+def main():
+  keys = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+  key_size = int(sys.argv[2]) if len(sys.argv) > 2 else key_pool.KEY_SIZE
+
+  directory = tempfile.mkdtemp()
+  key_pool.RSA_KEY_SECRET_FILE = os.path.join(directory, 'rsa_key.secret')
+  db = GeneralDb(os.path.join(directory, 'bench.db'))
+  db.migrate()
+
+  print('%d keys of %d bits, %d generating processes' % (keys, key_size, KEY_POOL_PROCESSES))
+  start = time.time()
+  for i in range(keys):
+    generate_keypair(key_size)
+  inline = (time.time() - start) / keys
+  print('inline         %8.3f s per bounty' % inline)
+
+  pool = KeyPool(db, size=keys, key_size=key_size)
+  start = time.time()
+  pool.start()
+  while pool.keys.unclaimed_count() < keys:
+    time.sleep(0.1)
+  print('pool refill    %8.2f keys/s' % (keys / (time.time() - start)))
+
+  start = time.time()
+  for i in range(keys):
+    with db.transaction():
+      pool.claim('bench-%d' % i)
+  print('pool claim     %8.3f ms per bounty' % ((time.time() - start) / keys * 1000))
+  print(pool.stats())
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python2.7
+"""
+Checks the local transaction parser against bitcoind's decoderawtransaction
+and compares their speed. Transactions are taken from signed_transaction
+table of the oracle db, or from the command line.
+
+usage: python2.7 benchmarks/rawtransaction_bench.py [oracle.db | tx_hex ...]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.bitcoind_client.bitcoinclient import BitcoinClient
+from shared.bitcoind_client.rawtransaction import parse_transaction
+
+import sqlite3
+import time
+
+def load_corpus(args):
+  if len(args) == 1 and os.path.isfile(args[0]):
+    conn = sqlite3.connect(args[0])
+    return [row[0] for row in conn.execute('select hex_transaction from signed_transaction')]
+  return args
+
+def comparable(tx):
+  # fields our helpers read from a decoded transaction
+  return {
+      'txid': tx['txid'],
+      'locktime': tx['locktime'],
+      'vin': [(vin.get('txid'), vin.get('vout'), vin.get('scriptSig', {}).get('asm'))
+          for vin in tx['vin']],
+      'vout': [(vout['value'], vout['scriptPubKey']['hex'], vout['scriptPubKey'].get('addresses'))
+          for vout in tx['vout']]}
+
+def main():
+  corpus = load_corpus(sys.argv[1:] or ['oracle.db'])
+  btc = BitcoinClient()
+
+  mismatches = 0
+  rpc_time = parse_time = 0.0
+  for tx_hex in corpus:
+    start = time.time()
+    decoded = btc.server.decoderawtransaction(tx_hex)
+    rpc_time += time.time() - start
+
+    start = time.time()
+    parsed = parse_transaction(tx_hex)
+    parse_time += time.time() - start
+
+    if comparable(decoded) != comparable(parsed):
+      mismatches += 1
+      print('mismatch for %s' % decoded['txid'])
+
+  count = max(len(corpus), 1)
+  print('%d transactions, %d mismatches' % (len(corpus), mismatches))
+  print('decoderawtransaction %.3f ms/tx, local parser %.3f ms/tx' % (
+      rpc_time * 1000 / count, parse_time * 1000 / count))
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python2.7
+"""
+Time of TaskQueue.get_oldest_task and get_next_check as the number of done
+tasks grows, with and without the pending-tasks index. Then time of draining
+DRAIN_TASKS due tasks one by one (get_oldest_task + done) and in batches
+(claim_tasks + done_many).
+
+usage: python2.7 benchmarks/taskqueue_bench.py [max_rows]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.db_classes import GeneralDb
+from oracle.oracle_db import TaskQueue
+
+import tempfile
+import time
+
+MAX_ROWS = 1000000
+PENDING = 100
+CALLS = 200
+DRAIN_TASKS = 10000
+BATCH_SIZE = 100
+
+def fill(db, queue, done_rows):
+  now = int(time.time())
+  sql = queue.insert_sql.format(queue.table_name)
+  cursor = db.get_cursor()
+  cursor.executemany(sql, (('timelock_create', '{}', now - 60, 1) for i in xrange(done_rows)))
+  # half of pending tasks is due, half waits for its locktime
+  cursor.executemany(sql, (('timelock_create', '{}', now + (i % 2) * 3600 - 1800, 0) for i in xrange(PENDING)))
+  db.commit()
+
+def measure(call):
+  start = time.time()
+  for i in xrange(CALLS):
+    call()
+  return (time.time() - start) * 1000000 / CALLS
+
+def drain_one_by_one(queue):
+  task = queue.get_oldest_task()
+  while task is not None:
+    queue.done(task)
+    task = queue.get_oldest_task()
+
+def drain_in_batches(queue):
+  tasks = queue.claim_tasks(BATCH_SIZE)
+  while tasks:
+    queue.done_many(tasks)
+    tasks = queue.claim_tasks(BATCH_SIZE)
+
+def measure_drain(drain):
+  filename = tempfile.mktemp(suffix='.db')
+  db = GeneralDb(filename)
+  queue = TaskQueue(db)
+  sql = queue.insert_sql.format(queue.table_name)
+  db.get_cursor().executemany(sql, (('timelock_create', '{}', 0, 0) for i in xrange(DRAIN_TASKS)))
+  db.commit()
+
+  start = time.time()
+  drain(queue)
+  elapsed = time.time() - start
+  os.remove(filename)
+  return elapsed
+
+def main():
+  max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else MAX_ROWS
+  print('%10s %18s %18s %18s' % ('done rows', 'no index (us)', 'indexed (us)', 'next_check (us)'))
+
+  rows = 10000
+  while rows <= max_rows:
+    filename = tempfile.mktemp(suffix='.db')
+    db = GeneralDb(filename)
+    queue = TaskQueue(db)
+    fill(db, queue, rows)
+
+    db.execute('drop index %s_pending' % queue.table_name)
+    without_index = measure(queue.get_oldest_task)
+
+    db.execute(queue.migrations[0].format(queue.table_name))
+    with_index = measure(queue.get_oldest_task)
+    next_check = measure(queue.get_next_check)
+
+    print('%10d %18.1f %18.1f %18.1f' % (rows, without_index, with_index, next_check))
+    os.remove(filename)
+    rows *= 10
+
+  print('')
+  print('draining %d tasks: one by one %.2f s, in batches of %d %.2f s' % (
+      DRAIN_TASKS, measure_drain(drain_one_by_one), BATCH_SIZE, measure_drain(drain_in_batches)))
+
+if __name__=="__main__":
+  main()
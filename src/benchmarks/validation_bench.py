@@ -0,0 +1,70 @@
+#!/usr/bin/env python2.7
+"""
+Validations per second of request bodies: the old check that only looks for
+required keys, and the compiled OPERATION_SCHEMAS validators. json.loads of
+the same body is given for scale.
+
+usage: python2.7 benchmarks/validation_bench.py [prevtxs_per_request]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'oracle'))
+
+from handlers.handlers import OPERATION_SCHEMAS
+
+import json
+import time
+
+PREVTXS = 20
+CALLS = 20000
+
+REQUIRED_FIELDS = ['message_id', 'sum_satoshi', 'prevtxs', 'outputs', 'miners_fee_satoshi',
+    'return_address', 'locktime', 'pubkey_list', 'req_sigs']
+
+def timelock_request(prevtxs):
+  return {
+      'operation': 'timelock_create',
+      'message_id': '3Hb6xJXNFr4avRYwtxkiuhNkjKkx3ynCSe-1234567890',
+      'sum_satoshi': 1000000,
+      'prevtxs': [{
+          'txid': '10a3ab54e1e19701fcb86c7725621b5b1b26415f94363de35a493ba9ca502b15',
+          'vout': i,
+          'scriptPubKey': 'a914a37ce66d7065157037e90ca4d4b4a20d8d865a2687',
+          'redeemScript': '5221' + '02' + 'ab' * 32 + '21' + '03' + 'cd' * 32 + '52ae'} for i in range(prevtxs)],
+      'outputs': {
+          '1BcEDbcYXfZXaVJh2WeCbc3TnEU37eRPSt': '0.00006',
+          '1MnVqnwK4gSRePyAcD9DhAvUsBJGwHNp1N': 0.00003},
+      'miners_fee_satoshi': 16384,
+      'return_address': '1MnVqnwK4gSRePyAcD9DhAvUsBJGwHNp1N',
+      'locktime': 1410000000.5,
+      'pubkey_list': ['02' + 'ab' * 32, '03' + 'cd' * 32],
+      'req_sigs': 2}
+
+def required_fields_check(body):
+  for field in REQUIRED_FIELDS:
+    if not field in body:
+      return 'missing %s' % field
+  return None
+
+def measure(name, call):
+  start = time.time()
+  for i in xrange(CALLS):
+    call()
+  elapsed = time.time() - start
+  print('%-16s %9.0f /s' % (name, CALLS / elapsed))
+
+def main():
+  prevtxs = int(sys.argv[1]) if len(sys.argv) > 1 else PREVTXS
+  body = timelock_request(prevtxs)
+  body_json = json.dumps(body)
+  validate = OPERATION_SCHEMAS['timelock_create']
+  assert(validate(body) is None)
+
+  print('timelock_create with %d prevtxs, %d bytes' % (prevtxs, len(body_json)))
+  measure('required keys', lambda: required_fields_check(body))
+  measure('schema', lambda: validate(body))
+  measure('json.loads', lambda: json.loads(body_json))
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,115 @@
+from collections import defaultdict, deque
+from shared.lru_cache import LRUCache
+
+import time
+
+# every sender may send SENDER_BURST messages at once, and SENDER_RATE
+# messages per second after that
+try:
+  from settings_local import SENDER_RATE
+except ImportError:
+  SENDER_RATE = 1.0
+
+try:
+  from settings_local import SENDER_BURST
+except ImportError:
+  SENDER_BURST = 50
+
+# senders whose buckets are remembered, the least active ones are forgotten
+MAX_TRACKED_SENDERS = 10000
+
+# requests waiting for the oracle loop, and how many it gets per tick
+MAX_QUEUED_REQUESTS = 1000
+REQUESTS_PER_TICK = 50
+
+# lower is handled first. Signing keeps contracts in progress moving, new
+# contracts can wait (and be dropped under load)
+OPERATION_PRIORITY = {
+    'sign': 0,
+    'bounty_redeem': 1,
+}
+DEFAULT_PRIORITY = 2
+
+class TokenBucket:
+  def __init__(self, rate, burst, now):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.updated = now
+
+  def take(self, now):
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    if self.tokens < 1:
+      return False
+    self.tokens -= 1
+    return True
+
+
+class AdmissionControl:
+  """
+  Decides which incoming messages get handled, and in which order.
+  allow(sender) rate limits senders before their messages are even parsed,
+  push(request) queues parsed requests by operation priority, and when the
+  queue is full the newest request of the lowest priority is shed.
+  Everything dropped is counted by reason.
+  """
+  def __init__(self, rate=SENDER_RATE, burst=SENDER_BURST, max_queued=MAX_QUEUED_REQUESTS):
+    self.rate = rate
+    self.burst = burst
+    self.max_queued = max_queued
+
+    self.buckets = LRUCache(MAX_TRACKED_SENDERS)
+    self.queues = defaultdict(deque)
+    self.queued = 0
+
+    self.admitted = 0
+    self.dropped = defaultdict(int)
+
+  def allow(self, sender):
+    now = time.time()
+    bucket = self.buckets.get(sender)
+    if bucket is None:
+      bucket = TokenBucket(self.rate, self.burst, now)
+      self.buckets.put(sender, bucket)
+    if bucket.take(now):
+      return True
+    self.dropped['rate_limited'] += 1
+    return False
+
+  def push(self, request):
+    """
+    Returns the request that had to be shed to make room, if any (it can be
+    the pushed one)
+    """
+    priority = OPERATION_PRIORITY.get(request.operation, DEFAULT_PRIORITY)
+    shed = None
+    if self.queued >= self.max_queued:
+      worst = max(p for p in self.queues if self.queues[p])
+      if worst <= priority:
+        self.dropped['queue_full'] += 1
+        return request
+      shed = self.queues[worst].pop()
+      self.queued -= 1
+      self.dropped['queue_full'] += 1
+
+    self.queues[priority].append(request)
+    self.queued += 1
+    self.admitted += 1
+    return shed
+
+  def pop(self, count=REQUESTS_PER_TICK):
+    requests = []
+    for priority in sorted(self.queues):
+      queue = self.queues[priority]
+      while queue and len(requests) < count:
+        requests.append(queue.popleft())
+    self.queued -= len(requests)
+    return requests
+
+  def stats(self):
+    return {
+        'queued': self.queued,
+        'admitted': self.admitted,
+        'dropped': dict(self.dropped),
+        'senders': len(self.buckets)}
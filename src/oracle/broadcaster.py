@@ -0,0 +1,183 @@
+from oracle_db import BroadcastQueue
+from shared.bitcoind_client.bitcoinclient import BitcoinClient, RPC_ERRORS, rpc_error_code
+from shared.liburl_wrapper import http, PUSHTX_URL
+
+from collections import defaultdict
+
+import logging
+import threading
+import time
+
+# where finished transactions are pushed, see SINKS
+try:
+  from settings_local import BROADCAST_SINKS
+except ImportError:
+  BROADCAST_SINKS = ['eligius']
+
+try:
+  from settings_local import BROADCAST_WORKERS
+except ImportError:
+  BROADCAST_WORKERS = 2
+
+# seconds before the n-th retry: RETRY_DELAY * 2 ** (n - 1), at most
+# MAX_RETRY_DELAY. A push is given up after MAX_ATTEMPTS
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 60 * 60
+MAX_ATTEMPTS = 12
+
+PUSH_TIMEOUT = 10
+
+# transactions are queued inside the handler's db transaction, so a worker
+# woken up by enqueue may not see them yet. It looks again after this long
+POLL_INTERVAL = 2
+
+# bitcoind error codes meaning the transaction doesn't need pushing anymore
+RPC_VERIFY_ALREADY_IN_CHAIN = -27
+
+
+class BitcoindSink:
+  """
+  sendrawtransaction on the local bitcoind. Only useful if it's connected
+  to the network and knows the spent outputs
+  """
+  def __init__(self):
+    self.btc = BitcoinClient()
+
+  def push(self, transaction):
+    try:
+      self.btc.send_raw_transaction(transaction)
+    except RPC_ERRORS as e:
+      if rpc_error_code(e) == RPC_VERIFY_ALREADY_IN_CHAIN:
+        return
+      raise
+
+
+class HttpPushSink:
+  # form POST to a push service, any 2xx answer counts as accepted
+  def __init__(self, url, fields):
+    """
+    fields - function returning form fields for the transaction
+    """
+    self.url = url
+    self.fields = fields
+
+  def push(self, transaction):
+    http.post_form(self.url, self.fields(transaction), PUSH_TIMEOUT)
+
+
+class StubSink:
+  # for test systems, remembers transactions instead of pushing them
+  def __init__(self):
+    self.transactions = []
+
+  def push(self, transaction):
+    logging.info('not pushing transaction, stub sink: %s' % transaction)
+    self.transactions.append(transaction)
+
+
+# name -> function making the sink
+SINKS = {
+    'bitcoind': BitcoindSink,
+    'eligius': lambda: HttpPushSink(PUSHTX_URL, lambda transaction: {'send': 'Push', 'transaction': transaction}),
+    'stub': StubSink,
+}
+
+def retry_delay(attempts):
+  return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+class Broadcaster:
+  """
+  Pushes finished transactions to the network in background threads, so
+  signing never waits for a push service. Transactions are kept in
+  broadcast_queue, once for every sink, until the sink accepts them, and
+  failed pushes are retried with exponential backoff, also after a restart.
+  """
+  def __init__(self, db, sinks=None, workers=BROADCAST_WORKERS):
+    """
+    sinks - name -> object with push(transaction), raising on failure.
+            BROADCAST_SINKS by default
+    """
+    self.queue = BroadcastQueue(db)
+    if sinks is None:
+      sinks = dict((name, SINKS[name]()) for name in BROADCAST_SINKS)
+    self.sinks = sinks
+    self.workers = [threading.Thread(target=self.work, name='broadcast-worker-%d' % number)
+        for number in range(workers)]
+    self.wakeup = threading.Event()
+
+    self.lock = threading.Lock()
+    self.sent = defaultdict(int)
+    self.retries = defaultdict(int)
+    self.failed = defaultdict(int)
+
+  def enqueue(self, transaction):
+    for name in self.sinks:
+      self.queue.add(transaction, name)
+    self.wakeup.set()
+
+  def start(self):
+    released = self.queue.release_claimed()
+    if released:
+      logging.info("{0} unfinished pushes returned to the queue".format(released))
+    for worker in self.workers:
+      worker.daemon = True
+      worker.start()
+
+  def work(self):
+    while True:
+      try:
+        item = self.queue.claim()
+        if item is None:
+          self.wait()
+          continue
+        self.push(item)
+      except:
+        logging.exception('broadcast worker failed')
+        time.sleep(POLL_INTERVAL)
+
+  def wait(self):
+    timeout = POLL_INTERVAL
+    next_attempt = self.queue.get_next_attempt()
+    if next_attempt is not None:
+      timeout = max(min(next_attempt - time.time(), timeout), 0)
+    self.wakeup.wait(timeout)
+    self.wakeup.clear()
+
+  def push(self, item):
+    name = item['sink']
+    sink = self.sinks.get(name)
+    try:
+      if sink is None:
+        raise KeyError('sink %s not configured' % name)
+      sink.push(item['transaction_hex'])
+    except Exception as e:
+      attempts = item['attempts'] + 1
+      error = repr(e)
+      if attempts >= MAX_ATTEMPTS:
+        logging.error('giving up pushing transaction %d to %s: %s' % (item['id'], name, error))
+        self.queue.failed(item, error)
+        self.count(self.failed, name)
+      else:
+        logging.warning('pushing transaction %d to %s failed: %s' % (item['id'], name, error))
+        self.queue.retry(item, error, time.time() + retry_delay(attempts))
+        self.count(self.retries, name)
+      return False
+
+    logging.info('transaction %d pushed to %s' % (item['id'], name))
+    self.queue.sent(item)
+    self.count(self.sent, name)
+    return True
+
+  def count(self, counter, name):
+    with self.lock:
+      counter[name] += 1
+
+  def stats(self):
+    stats = self.queue.counts()
+    with self.lock:
+      stats.update({
+          'sent': dict(self.sent),
+          'retries': dict(self.retries),
+          'failed': dict(self.failed)})
+    return stats
@@ -0,0 +1,194 @@
+from collections import defaultdict
+
+import gzip
+import json
+import logging
+import os
+import time
+
+# days rows are kept in oracle.db before they're moved to the archive,
+# None keeps them forever. RETENTION_DAYS in settings overrides single tables
+DEFAULT_RETENTION_DAYS = {
+    'transaction_requests': 30,
+    'task_queue': 30,
+    'key_value_history': 90,
+    'signed_transaction': 365,
+    'seen_request': 30,
+    'broadcast_queue': 30,
+    # pricecheck contracts read it around their locktime, which is long past
+    'price_observation': 30,
+    # a cache, rows archived here are computed again when needed
+    'my_turn': 30,
+}
+
+try:
+  from settings_local import RETENTION_DAYS
+except ImportError:
+  RETENTION_DAYS = {}
+
+try:
+  from settings_local import ARCHIVE_DIR
+except ImportError:
+  ARCHIVE_DIR = 'archive'
+
+# tables keyed by ts, a unix time, instead of id and a current_timestamp ts
+UNIX_TS_TABLES = ('price_observation', )
+
+# rows that may be archived at all, on top of the age check
+ARCHIVABLE_CONDITION = {
+    'task_queue': 'done=1',
+    'broadcast_queue': 'state in (1, 3)',
+}
+
+# limits of a single step, so the oracle loop is never paused for long
+CHUNK_ROWS = 500
+VACUUM_PAGES = 256
+
+# seconds between looking for expired rows, once there's nothing left to do
+COMPACTION_INTERVAL = 10 * 60
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+class Compactor:
+  """
+  Moves rows older than their table's retention from oracle.db into
+  gzipped JSON lines files, archive/<table>/<date>.jsonl.gz (by the day the
+  row was created), and gives the freed pages back with incremental vacuum.
+  Work is done in small steps, called by the oracle loop when it's idle.
+
+  Rows are written to the archive before they're deleted, so a crash in
+  between can only archive a row twice, never lose it.
+  """
+  def __init__(self, db, archive_dir=ARCHIVE_DIR, retention_days=None):
+    self.db = db
+    self.archive_dir = archive_dir
+    if retention_days is None:
+      retention_days = dict(DEFAULT_RETENTION_DAYS)
+      retention_days.update(RETENTION_DAYS)
+    self.retention_days = retention_days
+
+    self.next_run = 0
+    self.archived = defaultdict(int)
+    self.vacuumed_pages = 0
+
+  def enable_incremental_vacuum(self, full_vacuum=False):
+    """
+    auto_vacuum mode of an existing db changes only with a full VACUUM,
+    which can take minutes on a big db, so it's only done when asked for
+    with full_vacuum (run_oracle.py --vacuum, with the oracle stopped).
+    Returns True if the db is in incremental mode
+    """
+    cursor = self.db.get_cursor()
+    if cursor.execute('pragma auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+      return True
+    if not full_vacuum:
+      logging.warning('oracle.db is not in incremental vacuum mode, space of archived rows '
+          'is reused but not given back. Stop the oracle and run `run_oracle.py --vacuum` to switch')
+      return False
+    logging.info('switching oracle.db to incremental vacuum, this may take a while')
+    cursor.execute('pragma auto_vacuum=incremental')
+    cursor.execute('vacuum')
+    return True
+
+  def step(self):
+    """
+    Archives at most CHUNK_ROWS rows of one table, or vacuums at most
+    VACUUM_PAGES pages. Returns True if it did anything
+    """
+    if time.time() < self.next_run:
+      return False
+
+    for table_name in sorted(self.retention_days):
+      if self.archive_expired(table_name):
+        return True
+
+    if self.incremental_vacuum():
+      return True
+
+    self.next_run = time.time() + COMPACTION_INTERVAL
+    return False
+
+  def table_exists(self, table_name):
+    cursor = self.db.get_cursor()
+    sql = "select name from sqlite_master where type='table' and name=?"
+    return cursor.execute(sql, (table_name, )).fetchone() is not None
+
+  def expired_rows(self, table_name):
+    days = self.retention_days[table_name]
+    if days is None or not self.table_exists(table_name):
+      return []
+
+    cutoff = time.time() - days * 24 * 60 * 60
+    if not table_name in UNIX_TS_TABLES:
+      cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(cutoff))
+    condition = ARCHIVABLE_CONDITION.get(table_name, '1')
+    sql = 'select * from {0} where {1} order by {2} limit ?'.format(
+        table_name, condition, self.key_column(table_name))
+
+    # keys grow with ts, so the expired rows are at the beginning
+    rows = []
+    for row in self.db.get_cursor().execute(sql, (CHUNK_ROWS, )).fetchall():
+      if row['ts'] >= cutoff:
+        break
+      rows.append(dict(row))
+    return rows
+
+  def key_column(self, table_name):
+    return 'ts' if table_name in UNIX_TS_TABLES else 'id'
+
+  def row_date(self, table_name, row):
+    if table_name in UNIX_TS_TABLES:
+      return time.strftime('%Y-%m-%d', time.gmtime(row['ts']))
+    return row['ts'][:10]
+
+  def archive_expired(self, table_name):
+    rows = self.expired_rows(table_name)
+    if not rows:
+      return False
+
+    by_date = defaultdict(list)
+    for row in rows:
+      by_date[self.row_date(table_name, row)].append(row)
+    for date, date_rows in sorted(by_date.items()):
+      self.write_archive(table_name, date, date_rows)
+
+    key = self.key_column(table_name)
+    with self.db.transaction():
+      sql = 'delete from {0} where {1}=?'.format(table_name, key)
+      self.db.get_cursor().executemany(sql, [(row[key], ) for row in rows])
+
+    self.archived[table_name] += len(rows)
+    logging.debug('archived %d rows of %s' % (len(rows), table_name))
+    return True
+
+  def write_archive(self, table_name, date, rows):
+    directory = os.path.join(self.archive_dir, table_name)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    # appending makes a multi-member gzip file, readable as a whole by gzip
+    with open(os.path.join(directory, '%s.jsonl.gz' % date), 'ab') as f:
+      archive = gzip.GzipFile(fileobj=f, mode='ab')
+      for row in rows:
+        archive.write(json.dumps(row, sort_keys=True) + '\n')
+      archive.close()
+      f.flush()
+      os.fsync(f.fileno())
+
+  def incremental_vacuum(self):
+    cursor = self.db.get_cursor()
+    if cursor.execute('pragma auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+      return False
+    free_pages = cursor.execute('pragma freelist_count').fetchone()[0]
+    if free_pages == 0:
+      return False
+
+    # pages are freed while the statement is stepped through
+    cursor.execute('pragma incremental_vacuum(%d)' % VACUUM_PAGES).fetchall()
+    self.vacuumed_pages += min(free_pages, VACUUM_PAGES)
+    return True
+
+  def stats(self):
+    return {
+        'archived': dict(self.archived),
+        'vacuumed_pages': self.vacuumed_pages}
@@ -33,13 +33,12 @@ class BaseHandler:
     return hashlib.sha256(json.dumps(request_dict)).hexdigest()
 
   def input_addresses(self, prevtxs):
-    addresses = set()
+    scripts = []
     for prevtx in prevtxs:
       if not 'redeemScript' in prevtx:
         return False
-      script = prevtx['redeemScript']
-      address = self.btc.decode_script(script)['p2sh']
-      addresses.add(address)
+      scripts.append(prevtx['redeemScript'])
+    addresses = set(script['p2sh'] for script in self.btc.decode_scripts(scripts))
     return list(addresses)
 
   def try_prepare_raw_transaction(self, message):
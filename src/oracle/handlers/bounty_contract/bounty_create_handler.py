@@ -8,10 +8,6 @@ import hashlib
 import json
 import logging
 
-from Crypto.PublicKey import RSA
-from Crypto import Random
-
-KEY_SIZE = 4096
 HEURISTIC_ADD_TIME = 60 * 3
 
 # 15 minutes just to be sure no one claimed it
@@ -29,22 +25,7 @@ class BountyCreateHandler(BaseHandler):
     key = RSAKeyPairs(self.oracle.db).get_by_pwtxid(pwtxid)
     if key:
       return key['public']
-
-    random_generator = Random.new().read
-    new_keypair = RSA.generate(KEY_SIZE, random_generator)
-    public_key = json.dumps({'n':new_keypair.n, 'e':new_keypair.e})
-    whole_key_serialized = json.dumps({
-        'n':new_keypair.n,
-        'e':new_keypair.e,
-        'd':new_keypair.d,
-        'p':new_keypair.p,
-        'q':new_keypair.q,
-        'u':new_keypair.u})
-    RSAKeyPairs(self.oracle.db).save({
-        'pwtxid': pwtxid,
-        'public': public_key,
-        'whole': whole_key_serialized})
-    return public_key
+    return self.oracle.key_pool.claim(pwtxid)
 
   def handle_request(self, request):
     message = request.message
@@ -119,7 +119,6 @@ class GuessPasswordHandler(BaseHandler):
       self.oracle.task_queue.done(task)
       return
 
-    LockedPasswordTransaction(self.oracle.db).mark_as_done(pwtxid)  
     if transaction['done'] == 1:
       logging.info('someone was faster')
       self.oracle.task_queue.done(task)
@@ -160,6 +159,8 @@ class GuessPasswordHandler(BaseHandler):
         "operation": 'conditioned_transaction'
     }
     request = json.dumps(request)
+    # writes go after the RPCs above, so the db write lock isn't held during them
+    LockedPasswordTransaction(self.oracle.db).mark_as_done(pwtxid)
     self.oracle.communication.broadcast('conditioned_transaction', request)
     self.oracle.task_queue.done(task)
     SentPasswordTransaction(self.oracle.db).save({
@@ -0,0 +1,228 @@
+from password_db import RSAKeyPairs
+
+from Crypto import Random
+from Crypto.Cipher import AES
+from Crypto.PublicKey import RSA
+
+import base64
+import errno
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+KEY_SIZE = 4096
+
+# unclaimed keypairs kept in rsa_keypairs, a burst of up to this many new
+# bounties doesn't wait for key generation
+try:
+  from settings_local import KEY_POOL_SIZE
+except ImportError:
+  KEY_POOL_SIZE = 20
+
+# processes generating keys, 0 disables the pool and keys are generated
+# when a bounty needs them
+try:
+  from settings_local import KEY_POOL_PROCESSES
+except ImportError:
+  KEY_POOL_PROCESSES = max(multiprocessing.cpu_count() - 1, 1)
+
+# private keys are stored encrypted with a secret from this file, created
+# on first use
+try:
+  from settings_local import RSA_KEY_SECRET_FILE
+except ImportError:
+  RSA_KEY_SECRET_FILE = 'rsa_key.secret'
+
+# generating processes run at lower priority than the oracle
+GENERATOR_NICENESS = 10
+
+# seconds between checking the pool depth. Claims wake the refill up, but
+# it may look before the claim is committed
+REFILL_INTERVAL = 10
+
+ENCRYPTED_PREFIX = 'aes1:'
+SECRET_SIZE = 32
+MAC_SIZE = 32
+
+def generate_keypair(key_size=KEY_SIZE):
+  """
+  Returns (public, whole) serialized for rsa_keypairs, whole not encrypted
+  """
+  keypair = RSA.generate(key_size, Random.new().read)
+  public = json.dumps({'n': keypair.n, 'e': keypair.e})
+  whole = json.dumps({
+      'n': keypair.n,
+      'e': keypair.e,
+      'd': keypair.d,
+      'p': keypair.p,
+      'q': keypair.q,
+      'u': keypair.u})
+  return public, whole
+
+def init_generator():
+  # pycrypto's RNG refuses to run in a forked process until it's reseeded
+  Random.atfork()
+  os.nice(GENERATOR_NICENESS)
+
+
+class KeyCipher:
+  """
+  Encrypts serialized private keys: AES-256-CBC, then HMAC-SHA256 over iv
+  and ciphertext. Keys for both are derived from one secret
+  """
+  def __init__(self, secret):
+    self.encryption_key = hmac.new(secret, 'encryption', hashlib.sha256).digest()
+    self.mac_key = hmac.new(secret, 'authentication', hashlib.sha256).digest()
+
+  def encrypt(self, plaintext):
+    padding = AES.block_size - len(plaintext) % AES.block_size
+    plaintext += chr(padding) * padding
+    iv = Random.new().read(AES.block_size)
+    data = iv + AES.new(self.encryption_key, AES.MODE_CBC, iv).encrypt(plaintext)
+    mac = hmac.new(self.mac_key, data, hashlib.sha256).digest()
+    return ENCRYPTED_PREFIX + base64.b64encode(data + mac)
+
+  def decrypt(self, encrypted):
+    if not encrypted.startswith(ENCRYPTED_PREFIX):
+      # stored before keys were encrypted
+      return encrypted
+    data = base64.b64decode(encrypted[len(ENCRYPTED_PREFIX):])
+    data, mac = data[:-MAC_SIZE], data[-MAC_SIZE:]
+    if not hmac.compare_digest(mac, hmac.new(self.mac_key, data, hashlib.sha256).digest()):
+      raise ValueError('private key fails authentication, wrong %s?' % RSA_KEY_SECRET_FILE)
+    iv, ciphertext = data[:AES.block_size], data[AES.block_size:]
+    plaintext = AES.new(self.encryption_key, AES.MODE_CBC, iv).decrypt(ciphertext)
+    return plaintext[:-ord(plaintext[-1])]
+
+_cipher = None
+_cipher_lock = threading.Lock()
+
+def key_cipher():
+  global _cipher
+  with _cipher_lock:
+    if _cipher is None:
+      _cipher = KeyCipher(load_secret(RSA_KEY_SECRET_FILE))
+    return _cipher
+
+def load_secret(filename):
+  try:
+    with open(filename, 'rb') as f:
+      secret = f.read()
+  except IOError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    secret = create_secret(filename)
+  if len(secret) < SECRET_SIZE:
+    # keys encrypted with it couldn't be decrypted with a new one either
+    raise ValueError('%s is shorter than %d bytes, restore it from a backup' % (filename, SECRET_SIZE))
+  return secret
+
+def create_secret(filename):
+  # written to a temporary file and linked into place, so a crash never
+  # leaves a partial secret behind, and a secret created meanwhile by
+  # another process is used rather than replaced
+  secret = Random.new().read(SECRET_SIZE)
+  fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(secret)
+      f.flush()
+      os.fsync(f.fileno())
+    try:
+      os.link(temp_filename, filename)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+      with open(filename, 'rb') as f:
+        return f.read()
+  finally:
+    os.unlink(temp_filename)
+  logging.info('created %s, keep it with oracle.db backups' % filename)
+  return secret
+
+
+class KeyPool:
+  """
+  Keeps KEY_POOL_SIZE keypairs for bounty contracts generated ahead of time.
+  Keys are generated by KEY_POOL_PROCESSES processes and stored encrypted
+  in rsa_keypairs without a pwtxid, so giving one to a contract is a single
+  update. Every claim wakes the refill thread up; if a burst empties the
+  pool, the key is generated right away, as if there was no pool.
+  """
+  def __init__(self, db, size=KEY_POOL_SIZE, processes=KEY_POOL_PROCESSES, key_size=KEY_SIZE):
+    self.keys = RSAKeyPairs(db)
+    self.size = size
+    self.processes = processes
+    self.key_size = key_size
+    self.wakeup = threading.Event()
+
+    self.generated = 0
+    self.claimed = 0
+    self.fallbacks = 0
+
+  def start(self):
+    """
+    Forks the generating processes, best called before other threads are
+    started
+    """
+    if self.processes <= 0 or self.size <= 0:
+      return
+    self.generators = multiprocessing.Pool(self.processes, init_generator)
+    thread = threading.Thread(target=self.refill, name='key-pool')
+    thread.daemon = True
+    thread.start()
+
+  def refill(self):
+    while True:
+      try:
+        missing = self.size - self.keys.unclaimed_count()
+        if missing <= 0:
+          self.wakeup.wait(REFILL_INTERVAL)
+          self.wakeup.clear()
+          continue
+        batch = min(missing, self.processes)
+        started = time.time()
+        for public, whole in self.generators.imap_unordered(generate_keypair, [self.key_size] * batch):
+          self.keys.add_unclaimed(public, key_cipher().encrypt(whole))
+          self.generated += 1
+        logging.debug('generated %d keypairs in %.1fs' % (batch, time.time() - started))
+      except:
+        logging.exception('key pool refill failed')
+        time.sleep(REFILL_INTERVAL)
+
+  def claim(self, pwtxid):
+    """
+    Returns the public key now belonging to pwtxid. The claim update takes
+    the db write lock even when it finds no key, so an empty pool is
+    noticed first and the key generated before anything is written
+    """
+    self.wakeup.set()
+    if self.keys.unclaimed_count() > 0:
+      key = self.keys.claim(pwtxid)
+      if key is not None:
+        self.claimed += 1
+        return key['public']
+      # another worker took the last key in between, rare enough to
+      # generate one under the lock
+
+    self.fallbacks += 1
+    logging.warning('key pool empty, generating a key for %s' % pwtxid)
+    public, whole = generate_keypair(self.key_size)
+    self.keys.save({
+        'pwtxid': pwtxid,
+        'public': public,
+        'whole': key_cipher().encrypt(whole)})
+    return public
+
+  def stats(self):
+    return {
+        'depth': self.keys.unclaimed_count(),
+        'generated': self.generated,
+        'claimed': self.claimed,
+        'fallbacks': self.fallbacks}
@@ -1,3 +1,5 @@
+from key_pool import key_cipher
+
 import json
 
 from Crypto.PublicKey import RSA
@@ -6,7 +8,7 @@ from decimal import Decimal
 class Util:
   @staticmethod
   def construct_key_from_data(rsa_data):
-    k = json.loads(rsa_data['whole'])
+    k = json.loads(key_cipher().decrypt(rsa_data['whole']))
     key = RSA.construct((
         long(k['n']),
         long(k['e']),
@@ -1,9 +1,11 @@
 from timelock_contract.timelock_create_handler import TimelockCreateHandler
-from pricecheck_contract.pricecheck_create_handler import pricecheckcreatehandler
+from pricecheck_contract.pricecheck_create_handler import PricecheckCreateHandler
 from bounty_contract.bounty_create_handler import BountyCreateHandler
 from bounty_contract.bounty_redeem_handler import GuessPasswordHandler
 from transactionsigner import TransactionSigner
 
+from shared.schema import obj, integer, number, amount, string, hex_string, list_of, dict_of, anything
+
 
 op_handlers = {
 	'sign': TransactionSigner,
@@ -13,11 +15,59 @@ op_handlers = {
     'bounty_redeem': GuessPasswordHandler,
 }
 
-OPERATION_REQUIRED_FIELDS = {
-    'timelock_create': ['message_id', 'sum_satoshi', 'prevtxs', 'outputs', 'miners_fee_satoshi', 'return_address', 'locktime', 'pubkey_list', 'req_sigs'],
-    'pricecheck_create': ['message_id', 'sum_satoshi', 'prevtxs', 'outputs', 'miners_fee_satoshi', 'return_if_greater', 'return_if_lesser', 'price', 'locktime', 'pubkey_list', 'req_sigs'],
-    'bounty_create': ['prevtx', 'locktime', 'message_id', 'sum_amount', 'miners_fee', 'oracle_fees', 'pubkey_list', 'req_sigs', 'password_hash', 'return_address'],
-    'bounty_redeem': ['pwtxid', 'passwords']
+MAX_PREVTXS = 250
+MAX_PUBKEYS = 16
+
+# bitcoin addresses, base58
+ADDRESS = string(min_length=26, max_length=35, pattern='^[1-9A-HJ-NP-Za-km-z]+$')
+PUBKEY = hex_string(lengths=(66, 130))
+PREVTX = obj({
+    'txid': hex_string(lengths=(64, )),
+    'vout': integer(min_value=0)},
+  optional={
+    'scriptPubKey': hex_string(max_length=20000),
+    'redeemScript': hex_string(max_length=1040)})
+
+CONTRACT_FIELDS = {
+    'message_id': string(max_length=255),
+    'sum_satoshi': integer(min_value=1),
+    'prevtxs': list_of(PREVTX, min_length=1, max_length=MAX_PREVTXS),
+    'outputs': dict_of(ADDRESS, amount(), min_length=1, max_length=MAX_PUBKEYS + 1),
+    'miners_fee_satoshi': integer(min_value=0),
+    'locktime': number(min_value=0, max_value=2**32 - 1),
+    'pubkey_list': list_of(PUBKEY, min_length=1, max_length=MAX_PUBKEYS),
+    'req_sigs': integer(min_value=1, max_value=MAX_PUBKEYS),
+}
+
+def contract_fields(**fields):
+  result = dict(CONTRACT_FIELDS)
+  result.update(fields)
+  return result
+
+# what every request has to look like before it's passed to its handler
+OPERATION_SCHEMAS = {
+    'sign': obj({
+        'transaction': hex_string(max_length=200000)}),
+    'timelock_create': obj(contract_fields(
+        return_address=ADDRESS)),
+    'pricecheck_create': obj(contract_fields(
+        return_if_greater=ADDRESS,
+        return_if_lesser=ADDRESS,
+        price=amount())),
+    'bounty_create': obj({
+        'prevtx': anything(),
+        'locktime': number(min_value=0, max_value=2**32 - 1),
+        'message_id': string(max_length=255),
+        'sum_amount': anything(),
+        'miners_fee': anything(),
+        'oracle_fees': anything(),
+        'pubkey_list': list_of(PUBKEY, min_length=1, max_length=MAX_PUBKEYS),
+        'req_sigs': integer(min_value=1, max_value=MAX_PUBKEYS),
+        'password_hash': hex_string(lengths=(128, )),
+        'return_address': ADDRESS}),
+    'bounty_redeem': obj({
+        'pwtxid': string(max_length=255),
+        'passwords': dict_of(hex_string(lengths=(64, )), anything())}),
 }
 
 PROTOCOL_VERSION = '0.12'
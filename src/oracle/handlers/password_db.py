@@ -44,6 +44,10 @@ class LockedPasswordTransaction(TableDb):
     return None
 
 class RSAKeyPairs(TableDb):
+  """
+  Keypairs of bounty contracts. Rows with pwtxid null are generated ahead
+  by KeyPool and not given to any contract yet
+  """
   table_name = 'rsa_keypairs'
   create_sql = 'create table {0} ( \
       id integer primary key autoincrement, \
@@ -54,6 +58,14 @@ class RSAKeyPairs(TableDb):
   insert_sql = 'insert into {0} (pwtxid, public, whole) values (?, ?, ?)'
   all_sql = 'select * from {0} order by ts'
   pwtxid_sql = 'select * from {0} where pwtxid=?'
+  claim_sql = 'update {0} set pwtxid=?, ts=current_timestamp \
+      where id=(select id from {0} where pwtxid is null order by id limit 1)'
+  unclaimed_count_sql = 'select count(*) from {0} where pwtxid is null'
+
+  migrations = [
+    # claim takes the first unclaimed key straight from the index
+    'create index if not exists {0}_unclaimed on {0} (id) where pwtxid is null',
+  ]
 
   def args_for_obj(self, obj):
     return [obj['pwtxid'], obj['public'], obj['whole']]
@@ -75,6 +87,26 @@ class RSAKeyPairs(TableDb):
       return dict(row)
     return None
 
+  def add_unclaimed(self, public, whole):
+    self.save({'pwtxid': None, 'public': public, 'whole': whole})
+
+  def claim(self, pwtxid):
+    """
+    Gives the oldest unclaimed keypair to pwtxid and returns it, None if
+    there's none left
+    """
+    cursor = self.db.get_cursor()
+    sql = self.claim_sql.format(self.table_name)
+    if not cursor.execute(sql, (pwtxid, )).rowcount:
+      return None
+    self.db.commit()
+    return self.get_by_pwtxid(pwtxid)
+
+  def unclaimed_count(self):
+    cursor = self.db.get_cursor()
+    sql = self.unclaimed_count_sql.format(self.table_name)
+    return cursor.execute(sql).fetchone()[0]
+
 
 class RightGuess(TableDb):
   table_name = 'right_guess'
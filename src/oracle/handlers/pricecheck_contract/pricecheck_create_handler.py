@@ -1,12 +1,18 @@
 from basehandler import BaseHandler
 from password_db import LockedPasswordTransaction
+from oracle.oracle_db import PriceObservation
+from oracle.price_sampler import PRICE_LEAD, PRICE_LAG
 
-from shared.liburl_wrapper import safe_read
 from decimal import Decimal
 
 import json
 import logging
 import datetime
+import time
+
+# when no price source answers, the task is retried after this many seconds
+PRICE_RETRY_DELAY = 600
+PRICE_RETRIES = 10
 
 
 class PricecheckCreateHandler(BaseHandler):
@@ -54,12 +60,18 @@ class PricecheckCreateHandler(BaseHandler):
   def handle_task(self, task):
     message = json.loads(task['json_data'])
 
-    response = safe_read("https://www.bitstamp.net/api/ticker/", 10)
-    if not response:
+    # sampled ahead of the locktime by PriceSampler if it was running
+    locktime = int(message['locktime'])
+    price = PriceObservation(self.oracle.db).price_near(locktime, PRICE_LEAD, PRICE_LAG)
+    if price is None:
+      price = self.oracle.price_feed.get_price()
+
+    if price is None:
       if not 'retries_number' in message:
         message['retries_number'] = 0
 
-      if message['retries_number'] > 10:
+      if message['retries_number'] >= PRICE_RETRIES:
+        logging.error('no price for %s, giving up' % message['pwtxid'])
         return
 
       message['retries_number'] += 1
@@ -67,12 +79,10 @@ class PricecheckCreateHandler(BaseHandler):
           "operation": 'pricecheck_create',
           "json_data": json.dumps(message),
           "done": 0,
-          "next_check": int(task['locktime']) + 600
+          "next_check": int(time.time()) + PRICE_RETRY_DELAY
       })
+      return
 
-    response_dict = json.loads(response)
-
-    price = Decimal(response_dict['last'])
     expected_price = Decimal(message['price'])
 
     if price > expected_price:
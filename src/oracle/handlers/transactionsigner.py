@@ -5,8 +5,6 @@ import json
 import logging
 import time
 
-from shared.liburl_wrapper import safe_pushtx
-
 
 TURN_LENGTH_TIME = 60 * 1
 
@@ -31,12 +29,19 @@ class TransactionSigner(BaseHandler):
 
   def get_my_turn(self, redeem_script):
     # oracles sign transactions based on the order of their signatures
+    turn = self.oracle.turn_cache.get_turn(redeem_script)
+    if turn is not None:
+      return turn
 
+    turn = -1
     addresses = sorted(self.btc.decode_script(redeem_script)['addresses'])
-    for idx, addr in enumerate(addresses):
-      if self.btc.address_is_mine(addr):
-        return idx
-    return -1
+    for idx, mine in enumerate(self.btc.addresses_are_mine(addresses)):
+      if mine:
+        turn = idx
+        break
+
+    self.oracle.turn_cache.set_turn(redeem_script, turn)
+    return turn
 
 
   def is_proper_transaction(self, tx, prevtxs):
@@ -118,11 +123,12 @@ class TransactionSigner(BaseHandler):
       return
 
     rq_data['sigs_so_far'] = tx_sigs_count
-    self.kv.update('signable', rq_hash, rq_data)
-    # ^ let's remember the tx with most sigs that we've seen. 
+    # ^ let's remember the tx with most sigs that we've seen. It's written
+    # after the RPCs below, so the db write lock isn't held during them
 
     if tx_sigs_count >= req_sigs:
       logging.debug('already signed with enough keys')
+      self.kv.update('signable', rq_hash, rq_data)
       return
 
     pwtxid = rq_data['pwtxid']
@@ -133,6 +139,7 @@ class TransactionSigner(BaseHandler):
 
     if (tx_new_sigs_count == tx_sigs_count):
       logging.debug('failed signing transaction. already signed by me? aborting')
+      self.kv.update('signable', rq_hash, rq_data)
       return
 
     tx_sigs_count += 1
@@ -144,8 +151,9 @@ class TransactionSigner(BaseHandler):
     subject = ('sign %s' % pwtxid)  if tx_sigs_count < req_sigs else ('final-sign %s' % pwtxid)
 
     if tx_sigs_count == req_sigs:
-      logging.debug('pushing tx to Eligius. you might want to disable this in test systems')
-      logging.debug(safe_pushtx(signed_transaction))
+      # pushed in background, see BROADCAST_SINKS
+      logging.debug('queueing tx for broadcast')
+      self.oracle.broadcaster.enqueue(signed_transaction)
 
     self.oracle.communication.broadcast(subject, json.dumps(body))
 
@@ -166,7 +174,6 @@ class TransactionSigner(BaseHandler):
     # in a perfect world only the first oracle would have to call this
     # and all the others would sign through handle_request
 
-    self.oracle.task_queue.done(task)
     message = json.loads(task['json_data'])
     tx = message['transaction']
 
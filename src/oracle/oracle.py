@@ -1,16 +1,26 @@
 # Main Oracle file
 from oracle_communication import OracleCommunication
-from oracle_db import OracleDb, TaskQueue, KeyValue
+from oracle_db import OracleDb, TaskQueue, KeyValue, TurnCache
+from scheduler import Scheduler
+from taskpool import TaskPool
+from compaction import Compactor
+from price_sampler import PriceSampler
+from broadcaster import Broadcaster
 from handlers.handlers import op_handlers
+from handlers.bounty_contract.key_pool import KeyPool
 
 from settings_local import ORACLE_ADDRESS, ORACLE_FEE
 from shared.bitcoind_client.bitcoinclient import BitcoinClient
+from shared.price_feed import PriceFeed
+from shared.bitcoind_client.rawtransaction import parse_transaction, TransactionParseError
 
+import copy
 import json
+import sqlite3
+import time
 
 from handlers.transactionsigner import TransactionSigner
 
-import time
 import logging
 
 from decimal import Decimal
@@ -18,18 +28,74 @@ from decimal import Decimal
 # 3 minutes between oracles should be sufficient
 HEURISTIC_ADD_TIME = 60 * 3
 
+# tasks claimed from TaskQueue per loop tick, so a flood of due tasks doesn't
+# keep the inbox unpolled until all of them are handled
+TASK_BATCH_SIZE = 100
+
+# seconds before a task whose handler failed is tried again
+TASK_RETRY_DELAY = 60
+
+try:
+  from settings_local import ORACLE_WORKERS
+except ImportError:
+  ORACLE_WORKERS = 4
+
+def run_pooled_task(context, task):
+  context.run_task(task)
+
 class Oracle:
   def __init__(self):
-    self.communication = OracleCommunication()
     self.db = OracleDb()
+    self.db.migrate()
+    self.communication = OracleCommunication(self.db)
     self.btc = BitcoinClient()
     self.kv = KeyValue(self.db)
 
     self.task_queue = TaskQueue(self.db)
+    self.turn_cache = TurnCache(self.db)
+    self.scheduler = Scheduler()
+    self.compactor = Compactor(self.db)
+    # shared by all workers, so contracts maturing together share a fetch
+    self.price_feed = PriceFeed()
+    self.price_sampler = PriceSampler(self)
+    self.broadcaster = Broadcaster(self.db)
+    self.key_pool = KeyPool(self.db)
 
     self.handlers = op_handlers
     self.signer = TransactionSigner(self)
 
+    self.pool = None
+    if ORACLE_WORKERS > 0:
+      self.pool = TaskPool(
+          ORACLE_WORKERS,
+          self.worker_context,
+          run_pooled_task,
+          TASK_BATCH_SIZE,
+          on_finished=self.scheduler.wake)
+
+  def worker_context(self):
+    # handlers reach everything through the oracle object, so a worker gets
+    # a shallow copy of it with its own bitcoind client. OracleDb already
+    # gives every thread its own connection
+    context = copy.copy(self)
+    context.btc = BitcoinClient()
+    context.signer = TransactionSigner(context)
+    return context
+
+  def task_key(self, task):
+    # tasks with the same key are never run concurrently
+    message = json.loads(task['json_data'])
+    if 'pwtxid' in message:
+      return 'pwtxid:%s' % message['pwtxid']
+    if 'transaction' in message:
+      # sign tasks - transactions spending the same outputs
+      try:
+        vin = parse_transaction(message['transaction'])['vin']
+        return 'inputs:%s' % ','.join(sorted('%s:%s' % (i.get('txid'), i.get('vout')) for i in vin))
+      except TransactionParseError:
+        pass
+    return 'task:%s' % task['id']
+
   def handle_request(self, request):
     logging.debug(request)
     operation, message = request
@@ -40,21 +106,29 @@ class Oracle:
 
     handler = self.handlers[operation]
 
-    try:
-      message.message = json.loads(message.message)
-      if 'message_id' in message.message:
-        logging.info('parsing message_id: %r' % message.message['message_id'])
-      handler(self).handle_request(message)
-    except:
-      logging.debug(message)
-      logging.exception('error handling the request')
-
+    if 'message_id' in message.message:
+      logging.info('parsing message_id: %r' % message.message['message_id'])
+    handler(self).handle_request(message)
 
     # Save object to database for future reference
     db_class = self.db.operations[operation]
     if db_class:
       db_class(self.db).save(message)
 
+  def run_task(self, task):
+    # a failing handler leaves the transaction with its exception, so
+    # nothing it wrote is committed, and the task is tried again later.
+    # Returns whether the task succeeded
+    try:
+      with self.db.transaction():
+        self.handle_task(task)
+        self.task_queue.done(task)
+    except:
+      logging.exception("task {0} failed, retrying in {1}s".format(task['id'], TASK_RETRY_DELAY))
+      self.task_queue.retry_later(task, time.time() + TASK_RETRY_DELAY)
+      return False
+    return True
+
   def handle_task(self, task):
     operation = task['operation']
     assert(operation in self.handlers)
@@ -92,35 +166,98 @@ class Oracle:
         self.oracle_address = new_addr
         logging.error("created a new address: '%s'" % new_addr)
         self.kv.store('config','ORACLE_ADDRESS',new_addr)
+        # new key in the wallet can change our turn in known scripts
+        self.turn_cache.invalidate()
     else:
       self.oracle_address = ORACLE_ADDRESS
 
     logging.info("my multisig address is %s" % self.oracle_address)
     logging.info( "my pubkey: %r" % self.btc.validate_address(self.oracle_address)['pubkey'] )
 
+    released = self.task_queue.release_claimed()
+    if released:
+      logging.info("{0} unfinished tasks returned to the queue".format(released))
+
+    self.compactor.enable_incremental_vacuum()
+    # forks, so it goes before any thread is started
+    self.key_pool.start()
+    if self.pool:
+      self.pool.start()
+    self.price_sampler.start()
+    self.broadcaster.start()
+
     logging.debug("awaiting requests...")
-    count = 0
 
     while True:
-      # Proceed all requests
-      requests = self.communication.get_new_requests()
-      if len(requests) == 0:
-        count = count + 1
-        if count > 30:
-            logging.debug("{0} new requests".format(len(requests)))
-            count = 0
-      else:
-        logging.debug("{0} new requests".format(len(requests)))
+      try:
+        self.tick()
+      except sqlite3.OperationalError:
+        # e.g. a write waited for the lock longer than DB_BUSY_TIMEOUT. Claims
+        # and requests are rolled back, so the next tick tries them again
+        logging.exception('database error in the main loop')
+        self.scheduler.wait(None)
 
-      for request in requests:
-        self.handle_request(request)
-        self.communication.mark_request_done(request)
+  def tick(self):
+    # Proceed all requests
+    requests = self.communication.get_new_requests()
+    if len(requests) == 0:
+      self.scheduler.idle()
+    else:
+      self.scheduler.activity()
+      logging.debug("{0} new requests".format(len(requests)))
 
-      task = self.task_queue.get_oldest_task()
-      while task is not None:
-        self.handle_task(task)
-        self.task_queue.done(task)
-        task = self.task_queue.get_oldest_task()
+    for request in requests:
+      operation, message = request
+      self.scheduler.request_picked_up(message.received_time_epoch)
+      # everything a request writes is committed at once, or not at all
+      handled = False
+      try:
+        with self.db.transaction():
+          self.handle_request(request)
+          self.communication.remember_request(request)
+        handled = True
+      except:
+        logging.debug(message)
+        logging.exception('error handling the request')
+      self.communication.mark_request_done(request, handled)
+
+    if self.pool:
+      tasks = self.task_queue.claim_tasks(self.pool.capacity())
+      for task in tasks:
+        self.scheduler.task_picked_up(task['next_check'])
+        self.pool.submit(self.task_key(task), task)
+    else:
+      tasks = self.task_queue.claim_tasks(TASK_BATCH_SIZE)
+      for task in tasks:
+        self.scheduler.task_picked_up(task['next_check'])
+        self.run_task(task)
 
+    if self.communication.has_queued_requests():
+      # more requests were admitted than a tick handles
+      self.scheduler.wake()
+    elif len(requests) == 0 and len(tasks) == 0:
+      # old rows are archived only when there's nothing else to do, in
+      # steps - inbox is still polled between them
+      if self.compactor.step():
+        self.scheduler.wake()
 
-      time.sleep(1)
+    if self.scheduler.stats_due():
+      other_stats = {
+          'bitcoind': self.btc.stats(),
+          'bitmessage': self.communication.client.stats(),
+          'compaction': self.compactor.stats(),
+          'requests': self.communication.stats(),
+          'price_feed': self.price_feed.stats(),
+          'price_sampler': self.price_sampler.stats(),
+          'broadcast': self.broadcaster.stats(),
+          'key_pool': self.key_pool.stats()}
+      if self.pool:
+        other_stats['tasks'] = self.pool.stats()
+      self.scheduler.log_stats(**other_stats)
+    next_check = self.task_queue.get_next_check()
+    if self.pool and self.pool.capacity() == 0:
+      # due tasks wait for a free worker, not for their next_check that
+      # has passed already. A finished task wakes the loop up
+      next_check = None
+    # sleeps until the next task is due or it's time to poll the inbox again
+    self.scheduler.wait(next_check)
@@ -1,72 +1,162 @@
 # File responsible for sending messages according to protocol`
 from shared.bitmessage_communication.bitmessageclient import BitmessageClient
+from shared.lru_cache import LRUCache
+from oracle_db import SeenRequest
+from oracle_request import OracleRequest
+from admission import AdmissionControl
 
 from handlers.handlers import op_handlers
 
 from handlers.handlers import (
     PROTOCOL_VERSION,
-    OPERATION_REQUIRED_FIELDS)
+    OPERATION_SCHEMAS)
 
+import hashlib
 import json
 import logging
 
+# hashes of recently handled requests kept in memory, older ones are checked
+# in the seen_request table
+SEEN_CACHE_SIZE = 10000
+
 class OracleCommunication:
 
-  def __init__(self):
+  def __init__(self, db):
+    self.db = db
     self.client = BitmessageClient()
 
+    self.seen_requests = SeenRequest(db)
+    self.recently_seen = LRUCache(SEEN_CACHE_SIZE)
+    # msgid -> content hash of requests queued or being handled
+    self.request_hashes = {}
+    self.pending_hashes = set()
+    self.duplicates = 0
+
+    self.admission = AdmissionControl()
+
     # Do we really need it here?
     self.default_address = self.client.default_address
     logging.info("my BM address: %r" % self.client.default_address)
 
 
-  def corresponds_to_protocol(self, message):
+  def parse_request(self, message):
+    # returns OracleRequest, or None if the message isn't a valid request
     try:
       body = json.loads(message.message)
     except ValueError:
       logging.info('message is not a valid json')
-      return False
+      return None
+    if not isinstance(body, dict):
+      logging.info('message is not a json object')
+      return None
+
+    operation = self.corresponds_to_protocol(body)
+    if not operation:
+      return None
+    return OracleRequest(operation, body, message)
+
+  def corresponds_to_protocol(self, body):
     if not 'operation' in body:
       logging.info('message has no operation')
       return False
 
-    if not body['operation'] in op_handlers:
+    if not isinstance(body['operation'], basestring) or not body['operation'] in op_handlers:
       logging.info('operation %r not supported' % body['operation'])
       return False
 
     operation = body['operation']
 
-    if operation in OPERATION_REQUIRED_FIELDS:
-      required_fields = OPERATION_REQUIRED_FIELDS[operation]
-      for field in required_fields:
-        if not field in body:
-          logging.info('required field {0} for operation {1} missing'.format(field, operation))
-          return False
+    if operation in OPERATION_SCHEMAS:
+      error = OPERATION_SCHEMAS[operation](body)
+      if error:
+        logging.info('invalid {0} request: {1}'.format(operation, error))
+        return False
     else:
-      logging.warning('operation %r has no OPERATION_REQUIRED_FIELDS defined' % operation)
+      logging.warning('operation %r has no OPERATION_SCHEMAS defined' % operation)
 
     logging.info('operation {0}'.format(operation))
     return operation
 
+  def content_hash(self, message):
+    # resent requests and rebroadcasted sign messages have the same body
+    return hashlib.sha256(message.message).hexdigest()
+
+  def is_duplicate(self, content_hash):
+    if self.recently_seen.get(content_hash):
+      return True
+    if self.seen_requests.seen(content_hash):
+      self.recently_seen.put(content_hash, True)
+      return True
+    return False
+
   def get_new_requests(self):
-    messages = self.client.get_unread_messages()
-    requests = []
-    for msg in messages:
+    """
+    Reads new messages into the admission queue, returns the requests that
+    should be handled now, most important first
+    """
+    for msg in self.client.get_unread_messages():
+      if not self.admission.allow(msg.from_address):
+        logging.info('rate limiting %s, dropping %s' % (msg.from_address, msg.msgid))
+        self.client.mark_message_as_read(msg)
+        continue
+
       if msg.direct:
         self.response(msg, 'DirectMessage', 'direct message unsupported')
         continue
-      operation = self.corresponds_to_protocol(msg)
-      if operation:
-        requests.append((operation, msg))
-      else:
+
+      content_hash = self.content_hash(msg)
+      if content_hash in self.pending_hashes or self.is_duplicate(content_hash):
+        logging.info('dropping duplicate request %s' % msg.msgid)
+        self.duplicates += 1
+        self.client.mark_message_as_read(msg)
+        continue
+
+      request = self.parse_request(msg)
+      if not request:
         # If message is not corresponding to protocol, then mark it as read
         # All other messages will me marked later
         self.client.mark_message_as_read(msg)
-    return requests
+        continue
+
+      self.request_hashes[msg.msgid] = content_hash
+      self.pending_hashes.add(content_hash)
+      shed = self.admission.push(request)
+      if shed:
+        logging.info('request queue full, dropping %r' % shed)
+        self.forget_request(shed)
+        self.client.mark_message_as_read(shed.msgid)
+
+    return [(request.operation, request) for request in self.admission.pop()]
 
-  def mark_request_done(self, request):
+  def has_queued_requests(self):
+    return self.admission.queued > 0
+
+  def forget_request(self, request):
+    content_hash = self.request_hashes.pop(request.msgid, None)
+    self.pending_hashes.discard(content_hash)
+    return content_hash
+
+  def remember_request(self, request):
+    # called in the handler's transaction, so a request is seen only once
+    # what it wrote is committed
     operation, message = request
-    self.client.mark_message_as_read(message)
+    content_hash = self.request_hashes.get(message.msgid)
+    if content_hash:
+      self.seen_requests.save({'content_hash': content_hash})
+
+  def mark_request_done(self, request, handled=True):
+    # a failed request isn't remembered as seen, so it's handled if resent
+    operation, message = request
+    content_hash = self.forget_request(message)
+    if content_hash and handled:
+      self.recently_seen.put(content_hash, True)
+    self.client.mark_message_as_read(message.msgid)
+
+  def stats(self):
+    return {
+        'duplicates': self.duplicates,
+        'seen_cache': self.recently_seen.stats(),
+        'admission': self.admission.stats()}
 
   def response(self, message, subject, response):
     self.response_to_address(message.from_address, subject, response)
@@ -83,7 +173,9 @@ class OracleCommunication:
 
 
   def broadcast(self, subject, message):
-    self.client.send_message(self.client.chan_address, subject, message)
+    # sent once what the handler stored is committed, not while it holds the
+    # db write lock, and not at all if the handler fails
+    self.db.after_commit(lambda: self.client.send_message(self.client.chan_address, subject, message))
 
   def broadcast_identity(self):
 
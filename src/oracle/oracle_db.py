@@ -1,12 +1,35 @@
 from collections import defaultdict
+from decimal import Decimal
 from shared.db_classes import TableDb, GeneralDb
+from shared.lru_cache import LRUCache
 
 import json
+import sqlite3
 import time
 
+try:
+  from settings_local import KEY_VALUE_HISTORY
+except ImportError:
+  KEY_VALUE_HISTORY = False
+
 ORACLE_FILE = 'oracle.db'
 
+# TaskQueue.done values: 0 - pending, 1 - done, IN_FLIGHT - claimed by
+# claim_tasks and being handled
+IN_FLIGHT = 2
+
+# KeyValue entries kept in memory
+KEY_VALUE_CACHE_SIZE = 1024
+
+# TurnCache redeem scripts kept in memory
+TURN_CACHE_SIZE = 4096
+
 class KeyValue(TableDb):
+  """
+  Latest value for every (section, keyid). Values are kept as JSON and the
+  recently used ones are cached in memory. With KEY_VALUE_HISTORY on, values
+  replaced by update() are copied to key_value_history
+  """
   table_name = 'key_value'
   create_sql = 'create table {0} ( \
       id integer primary key autoincrement, \
@@ -14,38 +37,81 @@ class KeyValue(TableDb):
       keyid varchar(255) not null, \
       value text not null )'
   insert_sql = 'insert into {0} (section, keyid, value) values (?, ?, ?)'
+  if sqlite3.sqlite_version_info >= (3, 24, 0):
+    upsert_sql = 'insert into {0} (section, keyid, value) values (?, ?, ?) \
+        on conflict (section, keyid) do update set value=excluded.value'
+  else:
+    upsert_sql = 'insert or replace into {0} (section, keyid, value) values (?, ?, ?)'
+  history_sql = 'insert into {0}_history (section, keyid, value) \
+      select section, keyid, value from {0} where section=? and keyid=?'
   all_sql = 'select * from {0} order by id'
-  get_sql = 'select * from {0} where section=? and keyid=? order by id desc'
+  get_sql = 'select * from {0} where section=? and keyid=?'
+
+  # update() used to append a row on every call, the old rows go to history
+  # before keys are made unique
+  superseded = 'from {0} where id not in (select max(id) from {0} group by section, keyid)'
+  migrations = [
+    "create table if not exists {0}_history ( \
+        id integer primary key autoincrement, \
+        ts datetime default current_timestamp, \
+        section varchar(255) not null, \
+        keyid varchar(255) not null, \
+        value text not null)",
+    "insert into {0}_history (section, keyid, value) select section, keyid, value " + superseded,
+    "delete " + superseded,
+    "create unique index if not exists {0}_section_keyid on {0} (section, keyid)",
+  ]
+
+  def setup(self, db):
+    TableDb.setup(self, db)
+    # shared by all threads, so it's only given committed values
+    self.cache = LRUCache(KEY_VALUE_CACHE_SIZE)
 
   def args_for_obj(self, obj):
     return [obj['section'], obj['keyid'], json.dumps(obj['value'])]
 
   def store ( self, section, keyid, value ):
     assert( self.get_by_section_key(section, keyid) is None )
-    return self.save({ 'section': section, 'keyid': keyid, 'value': value })
+    self.save({ 'section': section, 'keyid': keyid, 'value': value })
+    self.cache_after_commit((section, keyid), json.dumps(value))
 
   def update ( self, section, keyid, value ):
-    #tbd: replace this with an actual "update" sql
-    return self.save({ 'section': section, 'keyid': keyid, 'value': value })
+    cursor = self.db.get_cursor()
+    if KEY_VALUE_HISTORY:
+      cursor.execute(self.history_sql.format(self.table_name), (section, keyid))
 
+    value_json = json.dumps(value)
+    sql = self.upsert_sql.format(self.table_name)
+    cursor.execute(sql, (section, keyid, value_json))
+    self.db.commit()
+    self.cache_after_commit((section, keyid), value_json)
+
+  def cache_after_commit(self, key, value_json):
+    # other threads read the committed value from the db until then
+    self.cache.discard(key)
+    self.db.after_commit(lambda: self.cache.put(key, value_json))
 
   def get_by_section_key(self, section, keyid):
-    cursor = self.db.get_cursor()
-    sql = self.get_sql.format(self.table_name)
+    value_json = self.cache.get((section, keyid))
+    if value_json is None:
+      cursor = self.db.get_cursor()
+      sql = self.get_sql.format(self.table_name)
+
+      row = cursor.execute(sql, (section, keyid, )).fetchone()
+      if not row:
+        return None
+      value_json = row['value']
+      # it may be this thread's uncommitted value, so it's cached once it's
+      # committed. An update() from another thread could've cached a newer one
+      self.db.after_commit(lambda: self.cache.add((section, keyid), value_json))
+
+    return json.loads(value_json)
 
-    row = cursor.execute(sql, (section, keyid, )).fetchone()
-    if row:
-      d = dict(row)
-      d['value'] = json.loads(d['value'])
-      return d['value']
-    return None
-  
 
 class OracleDb(GeneralDb):
 
   def __init__(self):
-    self._filename = ORACLE_FILE
-    self.connect()
+    GeneralDb.__init__(self, ORACLE_FILE)
     operations = {
       'conditioned_transaction': TransactionRequestDb
     }
@@ -67,7 +133,7 @@ class TransactionRequestDb(TableDb):
   insert_sql = "insert into {0} (from_address, json_data) values (?, ?)"
 
   def args_for_obj(self, obj):
-    return [obj.from_address, obj.message]
+    return [obj.from_address, obj.raw_message]
 
 class TaskQueue(TableDb):
   """
@@ -87,9 +153,22 @@ class TaskQueue(TableDb):
       done integer default 0);"
   insert_sql = "insert into {0} (operation, json_data, next_check, done) values (?,?,?,?)"
   oldest_sql = "select * from {0} where next_check<? and done=0 order by ts limit 1"
+  due_sql = "select * from {0} where next_check<? and done=0 order by ts limit ?"
   all_sql = "select * from {0} where next_check<? and done=0 order by ts"
   all_ignore_sql = "select * from {0} where done=0 order by ts"
   mark_done_sql = "update {0} set done=1 where id=?"
+  claim_sql = "update {0} set done=%d where id=?" % IN_FLIGHT
+  release_sql = "update {0} set done=0 where done=%d" % IN_FLIGHT
+  retry_sql = "update {0} set done=0, next_check=? where id=?"
+  next_check_sql = "select min(next_check) as next_check from {0} where done=0"
+  operation_next_check_sql = "select min(next_check) as next_check from {0} \
+      where done=0 and next_check>? and operation=?"
+
+  migrations = [
+    # done tasks are never deleted, so every pending-task query goes
+    # through an index that contains only the pending ones
+    "create index if not exists {0}_pending on {0} (next_check, ts) where done=0",
+  ]
 
   def args_for_obj(self, obj):
     return [obj['operation'], obj['json_data'], obj['next_check'], obj['done']]
@@ -98,11 +177,59 @@ class TaskQueue(TableDb):
     cursor = self.db.get_cursor()
     sql = self.oldest_sql.format(self.table_name)
 
-    row = cursor.execute(sql, (int(time.time()), )).fetchone()
+    row = cursor.execute(sql, (time.time(), )).fetchone()
     if row:
       row = dict(row)
     return row
 
+  def claim_tasks(self, limit):
+    """
+    Returns up to limit due tasks (oldest first) and marks them in flight, so
+    they're not returned again until released. Select and mark happen under
+    one write lock, so concurrent claimers never get the same task
+    """
+    if limit <= 0:
+      return []
+    self.db.commit()
+    cursor = self.db.get_cursor()
+    cursor.execute("begin immediate")
+    try:
+      sql = self.due_sql.format(self.table_name)
+      rows = cursor.execute(sql, (time.time(), limit)).fetchall()
+      tasks = [dict(row) for row in rows]
+
+      sql = self.claim_sql.format(self.table_name)
+      cursor.executemany(sql, [(task['id'], ) for task in tasks])
+    except:
+      self.db.rollback()
+      raise
+    self.db.commit()
+    return tasks
+
+  def release_claimed(self):
+    # tasks claimed by a process that died before finishing them
+    cursor = self.db.get_cursor()
+    sql = self.release_sql.format(self.table_name)
+    released = cursor.execute(sql).rowcount
+    self.db.commit()
+    return released
+
+  def get_next_check(self):
+    # time when the earliest pending task becomes due, None if queue is empty
+    cursor = self.db.get_cursor()
+    sql = self.next_check_sql.format(self.table_name)
+
+    row = cursor.execute(sql).fetchone()
+    return row['next_check']
+
+  def get_operation_next_check(self, operation, after):
+    # earliest next_check after the given time of pending operation tasks
+    cursor = self.db.get_cursor()
+    sql = self.operation_next_check_sql.format(self.table_name)
+
+    row = cursor.execute(sql, (after, operation)).fetchone()
+    return row['next_check']
+
   def get_all_tasks(self):
     cursor = self.db.get_cursor()
     sql = self.all_sql.format(self.table_name)
@@ -123,6 +250,79 @@ class TaskQueue(TableDb):
     cursor = self.db.get_cursor()
     sql = self.mark_done_sql.format(self.table_name)
     cursor.execute(sql, (int(task['id']), ))
+    self.db.commit()
+
+  def retry_later(self, task, next_check):
+    # returns a claimed task to the queue, due again at next_check
+    cursor = self.db.get_cursor()
+    sql = self.retry_sql.format(self.table_name)
+    cursor.execute(sql, (int(next_check), int(task['id'])))
+    self.db.commit()
+
+  def done_many(self, tasks):
+    cursor = self.db.get_cursor()
+    sql = self.mark_done_sql.format(self.table_name)
+    cursor.executemany(sql, [(int(task['id']), ) for task in tasks])
+    self.db.commit()
+
+class TurnCache(TableDb):
+  """
+  Our position in the sorted address list of a redeem script (-1 if we're not
+  part of it). Redeem scripts don't change, so it only has to be invalidated
+  when keys are added to the wallet.
+
+  Anyone can send redeem scripts, so only scripts we're part of are stored
+  in the table, and the in-memory part is size bounded.
+  """
+  table_name = "my_turn"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      redeem_script text unique, \
+      turn integer not null);"
+  insert_sql = "insert or replace into {0} (redeem_script, turn) values (?, ?)"
+  turn_sql = "select turn from {0} where redeem_script=?"
+  clear_sql = "delete from {0}"
+
+  migrations = [
+    "delete from {0} where turn<0",
+  ]
+
+  def setup(self, db):
+    TableDb.setup(self, db)
+    self.turns = LRUCache(TURN_CACHE_SIZE)
+
+  def args_for_obj(self, obj):
+    return [obj['redeem_script'], obj['turn']]
+
+  def get_turn(self, redeem_script):
+    turn = self.turns.get(redeem_script)
+    if turn is not None:
+      return turn
+
+    cursor = self.db.get_cursor()
+    sql = self.turn_sql.format(self.table_name)
+
+    row = cursor.execute(sql, (redeem_script, )).fetchone()
+    if row:
+      self.turns.put(redeem_script, row['turn'])
+      return row['turn']
+    return None
+
+  def set_turn(self, redeem_script, turn):
+    # turns are found out between RPCs, so they're written after the
+    # handler's transaction instead of taking the write lock in its middle
+    if turn >= 0:
+      self.db.after_commit(lambda: self.save({'redeem_script': redeem_script, 'turn': turn}))
+    self.turns.put(redeem_script, turn)
+
+  def invalidate(self):
+    cursor = self.db.get_cursor()
+    sql = self.clear_sql.format(self.table_name)
+    cursor.execute(sql)
+    self.db.commit()
+    self.turns.clear()
+
 
 class UsedInput(TableDb):
   """
@@ -212,3 +412,156 @@ class HandledTransaction(TableDb):
 
 
 
+
+
+class SeenRequest(TableDb):
+  """
+  Hashes of requests already handled, so resent ones can be dropped before
+  they're parsed
+  """
+  table_name = "seen_request"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      content_hash text unique);"
+  insert_sql = "insert or ignore into {0} (content_hash) values (?)"
+  exists_sql = "select 1 from {0} where content_hash=?"
+
+  def args_for_obj(self, obj):
+    return [obj['content_hash']]
+
+  def seen(self, content_hash):
+    cursor = self.db.get_cursor()
+    sql = self.exists_sql.format(self.table_name)
+    return cursor.execute(sql, (content_hash, )).fetchone() is not None
+
+
+class PriceObservation(TableDb):
+  """
+  BTC/USD prices sampled around pricecheck locktimes, by unix time. ts is
+  the rowid, so the table is its own timestamp index
+  """
+  table_name = "price_observation"
+  create_sql = "create table {0} ( \
+      ts integer primary key, \
+      price text not null);"
+  insert_sql = "insert or replace into {0} (ts, price) values (?, ?)"
+  near_sql = "select ts, price from {0} where ts between ? and ? order by abs(ts - ?) limit 1"
+
+  def args_for_obj(self, obj):
+    return [int(obj['ts']), str(obj['price'])]
+
+  def record(self, ts, price):
+    self.save({'ts': ts, 'price': price})
+
+  def price_near(self, ts, before, after):
+    # price observed closest to ts, from ts - before to ts + after
+    cursor = self.db.get_cursor()
+    sql = self.near_sql.format(self.table_name)
+
+    row = cursor.execute(sql, (ts - before, ts + after, ts)).fetchone()
+    if row:
+      return Decimal(row['price'])
+    return None
+
+
+class BroadcastQueue(TableDb):
+  """
+  Finished transactions waiting to be pushed to the network, one row per
+  transaction and sink. state is PENDING until the sink accepts it (SENT) or
+  it runs out of attempts (FAILED), IN_FLIGHT while a broadcaster has it
+  """
+  PENDING = 0
+  SENT = 1
+  FAILED = 3
+
+  table_name = "broadcast_queue"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      transaction_hex text not null, \
+      sink text not null, \
+      attempts integer default 0, \
+      next_attempt integer not null, \
+      last_error text, \
+      state integer default 0, \
+      unique (transaction_hex, sink));"
+  insert_sql = "insert or ignore into {0} (transaction_hex, sink, next_attempt) values (?, ?, ?)"
+  next_attempt_sql = "select min(next_attempt) as next_attempt from {0} where state=0"
+  due_sql = "select * from {0} where state=0 and next_attempt<=? order by next_attempt limit 1"
+  claim_sql = "update {0} set state=%d where id=?" % IN_FLIGHT
+  release_sql = "update {0} set state=0 where state=%d" % IN_FLIGHT
+  finish_sql = "update {0} set state=?, attempts=attempts+1, last_error=? where id=?"
+  retry_sql = "update {0} set state=0, attempts=attempts+1, last_error=?, next_attempt=? where id=?"
+  count_sql = "select state, count(*) as count from {0} where state in (0, %d) group by state" % IN_FLIGHT
+
+  migrations = [
+    "create index if not exists {0}_pending on {0} (next_attempt) where state=0",
+  ]
+
+  def args_for_obj(self, obj):
+    return [obj['transaction_hex'], obj['sink'], obj['next_attempt']]
+
+  def add(self, transaction_hex, sink):
+    # the same transaction is pushed to a sink once, however many times it's added
+    self.save({'transaction_hex': transaction_hex, 'sink': sink, 'next_attempt': int(time.time())})
+
+  def get_next_attempt(self):
+    # when the earliest pending push becomes due, None if there's none
+    cursor = self.db.get_cursor()
+    sql = self.next_attempt_sql.format(self.table_name)
+    return cursor.execute(sql).fetchone()['next_attempt']
+
+  def claim(self):
+    """
+    Returns the most overdue pending push and marks it in flight, None if
+    nothing is due. Like TaskQueue.claim_tasks, select and mark happen under
+    one write lock
+    """
+    self.db.commit()
+    cursor = self.db.get_cursor()
+    cursor.execute("begin immediate")
+    try:
+      sql = self.due_sql.format(self.table_name)
+      row = cursor.execute(sql, (time.time(), )).fetchone()
+      if row:
+        row = dict(row)
+        cursor.execute(self.claim_sql.format(self.table_name), (row['id'], ))
+    except:
+      self.db.rollback()
+      raise
+    self.db.commit()
+    return row
+
+  def release_claimed(self):
+    # pushes claimed by a process that died before finishing them
+    cursor = self.db.get_cursor()
+    sql = self.release_sql.format(self.table_name)
+    released = cursor.execute(sql).rowcount
+    self.db.commit()
+    return released
+
+  def sent(self, item):
+    self.finish(item, self.SENT, None)
+
+  def failed(self, item, error):
+    self.finish(item, self.FAILED, error)
+
+  def finish(self, item, state, error):
+    cursor = self.db.get_cursor()
+    sql = self.finish_sql.format(self.table_name)
+    cursor.execute(sql, (state, error, item['id']))
+    self.db.commit()
+
+  def retry(self, item, error, next_attempt):
+    cursor = self.db.get_cursor()
+    sql = self.retry_sql.format(self.table_name)
+    cursor.execute(sql, (error, int(next_attempt), item['id']))
+    self.db.commit()
+
+  def counts(self):
+    # number of pending and in flight pushes
+    cursor = self.db.get_cursor()
+    sql = self.count_sql.format(self.table_name)
+    counts = dict((row['state'], row['count']) for row in cursor.execute(sql))
+    return {'pending': counts.get(self.PENDING, 0), 'in_flight': counts.get(IN_FLIGHT, 0)}
@@ -0,0 +1,24 @@
+class OracleRequest(object):
+  """
+  Request taken from the inbox. The body is parsed and validated once, in
+  OracleCommunication, and handlers get it as .message. raw_message is the
+  text it was parsed from, kept for saving the request as it came.
+  """
+  __slots__ = (
+      'operation',
+      'message',
+      'raw_message',
+      'from_address',
+      'received_time_epoch',
+      'msgid')
+
+  def __init__(self, operation, body, bitmessage_message):
+    self.operation = operation
+    self.message = body
+    self.raw_message = bitmessage_message.message
+    self.from_address = bitmessage_message.from_address
+    self.received_time_epoch = bitmessage_message.received_time_epoch
+    self.msgid = bitmessage_message.msgid
+
+  def __repr__(self):
+    return '<OracleRequest %s %s from %s>' % (self.operation, self.msgid, self.from_address)
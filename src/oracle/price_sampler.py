@@ -0,0 +1,64 @@
+from oracle_db import PriceObservation
+
+import logging
+import threading
+import time
+
+# prices are sampled every SAMPLE_INTERVAL seconds from PRICE_LEAD seconds
+# before a pricecheck locktime until it passes. A task then takes the
+# observation closest to its locktime, up to PRICE_LAG seconds after it
+PRICE_LEAD = 30
+PRICE_LAG = 60
+SAMPLE_INTERVAL = 5
+
+# upcoming locktimes are checked at least this often, so tasks created
+# shortly before their locktime are sampled too
+MAX_SLEEP = PRICE_LEAD / 2
+
+class PriceSampler(threading.Thread):
+  """
+  Fetches prices ahead of pricecheck locktimes into price_observation, so
+  PricecheckCreateHandler.handle_task doesn't wait for the network when
+  the task is due
+  """
+  def __init__(self, oracle):
+    threading.Thread.__init__(self, name='price-sampler')
+    self.daemon = True
+    self.task_queue = oracle.task_queue
+    self.price_feed = oracle.price_feed
+    self.observations = PriceObservation(oracle.db)
+
+    self.samples = 0
+    self.failures = 0
+
+  def run(self):
+    while True:
+      try:
+        sleep = self.tick()
+      except:
+        logging.exception('price sampler failed')
+        sleep = MAX_SLEEP
+      time.sleep(sleep)
+
+  def tick(self):
+    # returns seconds until the next tick
+    now = time.time()
+    locktime = self.task_queue.get_operation_next_check('pricecheck_create', now - SAMPLE_INTERVAL)
+    if locktime is None or locktime - now > PRICE_LEAD:
+      if locktime is None:
+        return MAX_SLEEP
+      return min(locktime - now - PRICE_LEAD, MAX_SLEEP)
+
+    observation = self.price_feed.observe(max_age=SAMPLE_INTERVAL)
+    if observation is None:
+      self.failures += 1
+    else:
+      observed_at, price = observation
+      self.observations.record(observed_at, price)
+      self.samples += 1
+    return SAMPLE_INTERVAL
+
+  def stats(self):
+    return {
+        'samples': self.samples,
+        'failures': self.failures}
@@ -0,0 +1,107 @@
+import threading
+import time
+import logging
+
+# Bitmessage API can't notify us about new messages, so the inbox is polled.
+# Poll interval shrinks to MIN_POLL_INTERVAL when there is traffic and grows
+# by BACKOFF_FACTOR on every idle tick, up to MAX_POLL_INTERVAL. That's the
+# fixed sleep the loop had before, so an idle oracle isn't slower to notice
+# a request than it used to be
+MIN_POLL_INTERVAL = 0.1
+MAX_POLL_INTERVAL = 1.0
+BACKOFF_FACTOR = 1.5
+
+# how often loop statistics are written to the log
+STATS_LOG_INTERVAL = 60
+
+class LatencyStats:
+  """
+  Keeps count/avg/max/last of pickup latencies (in seconds)
+  """
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.last = 0.0
+
+  def add(self, latency):
+    latency = max(latency, 0.0)
+    self.count += 1
+    self.total += latency
+    self.max = max(self.max, latency)
+    self.last = latency
+
+  def as_dict(self):
+    avg = self.total / self.count if self.count else 0.0
+    return {
+        'count': self.count,
+        'avg_ms': int(avg * 1000),
+        'max_ms': int(self.max * 1000),
+        'last_ms': int(self.last * 1000)}
+
+
+class Scheduler:
+  """
+  Decides how long the oracle main loop sleeps between ticks. The loop wakes up
+  when the next task in TaskQueue becomes due, when wake() is called (e.g. from
+  another thread), or when the current inbox poll interval passes.
+  """
+  def __init__(self, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.poll_interval = min_interval
+    self.event = threading.Event()
+
+    self.ticks = 0
+    self.request_latency = LatencyStats()
+    self.task_latency = LatencyStats()
+    self.last_stats_log = time.time()
+
+  def activity(self):
+    # new inbox traffic - poll again soon
+    self.poll_interval = self.min_interval
+
+  def idle(self):
+    self.poll_interval = min(self.poll_interval * BACKOFF_FACTOR, self.max_interval)
+
+  def wake(self):
+    self.event.set()
+
+  def timeout(self, next_check):
+    timeout = self.poll_interval
+    if next_check is not None:
+      timeout = min(timeout, next_check - time.time())
+    return max(timeout, 0.0)
+
+  def wait(self, next_check):
+    # next_check None - nothing to wait for but the poll interval and wake()
+    self.ticks += 1
+    timeout = self.timeout(next_check)
+    if timeout > 0:
+      self.event.wait(timeout)
+    self.event.clear()
+
+  def request_picked_up(self, received_time):
+    self.request_latency.add(time.time() - received_time)
+
+  def task_picked_up(self, next_check):
+    self.task_latency.add(time.time() - next_check)
+
+  def stats(self):
+    return {
+        'ticks': self.ticks,
+        'poll_interval_ms': int(self.poll_interval * 1000),
+        'request_latency': self.request_latency.as_dict(),
+        'task_latency': self.task_latency.as_dict()}
+
+  def stats_due(self):
+    # other components' stats cost db reads, so they're only collected when
+    # they're going to be logged
+    return time.time() - self.last_stats_log >= STATS_LOG_INTERVAL
+
+  def log_stats(self, **other_stats):
+    # other_stats - counters of other components, logged along the loop ones
+    self.last_stats_log = time.time()
+    logging.info('loop stats: %r' % self.stats())
+    for name in sorted(other_stats):
+      logging.info('%s stats: %r' % (name, other_stats[name]))
@@ -0,0 +1,113 @@
+from collections import deque
+
+import logging
+import threading
+import time
+import Queue
+
+class Worker(threading.Thread):
+  """
+  Runs tasks from the pool queue. Context (e.g. db connection) is created in
+  the worker thread itself, as sqlite connections can't be shared by threads
+  """
+  def __init__(self, pool, number):
+    threading.Thread.__init__(self, name='task-worker-%d' % number)
+    self.daemon = True
+    self.pool = pool
+    self.busy = False
+    self.busy_time = 0.0
+    self.completed = 0
+
+  def run(self):
+    context = self.pool.make_context()
+    while True:
+      key, item = self.pool.queue.get()
+      self.busy = True
+      start = time.time()
+      try:
+        self.pool.run_item(context, item)
+      except:
+        logging.exception('error running task in %s' % self.name)
+      self.busy_time += time.time() - start
+      self.busy = False
+      self.completed += 1
+      self.pool.finished(key)
+
+
+class TaskPool:
+  """
+  Runs independent tasks concurrently in worker threads. Tasks submitted with
+  the same key run one at a time, in submission order.
+
+  make_context() - called once in every worker, result is passed to run_item
+  run_item(context, item) - does the work
+  max_pending - how many tasks can be submitted and not finished yet
+  """
+  def __init__(self, workers, make_context, run_item, max_pending, on_finished=None):
+    self.make_context = make_context
+    self.run_item = run_item
+    self.max_pending = max_pending
+    self.on_finished = on_finished
+
+    self.queue = Queue.Queue()
+    self.lock = threading.Lock()
+    # key -> tasks waiting for the running one with the same key
+    self.waiting = {}
+    self.pending = 0
+
+    self.last_stats = time.time()
+    self.last_busy_time = [0.0] * workers
+    self.workers = [Worker(self, number) for number in range(workers)]
+
+  def start(self):
+    for worker in self.workers:
+      worker.start()
+
+  def capacity(self):
+    with self.lock:
+      return max(self.max_pending - self.pending, 0)
+
+  def submit(self, key, item):
+    with self.lock:
+      self.pending += 1
+      if key in self.waiting:
+        self.waiting[key].append(item)
+        return
+      self.waiting[key] = deque()
+    self.queue.put((key, item))
+
+  def finished(self, key):
+    next_item = None
+    with self.lock:
+      self.pending -= 1
+      if self.waiting[key]:
+        next_item = self.waiting[key].popleft()
+      else:
+        del self.waiting[key]
+    if next_item is not None:
+      self.queue.put((key, next_item))
+    if self.on_finished:
+      self.on_finished()
+
+  def stats(self):
+    # utilisation is the share of time a worker was busy since the previous
+    # stats() call
+    now = time.time()
+    elapsed = max(now - self.last_stats, 0.001)
+    utilisation = []
+    for number, worker in enumerate(self.workers):
+      busy_time = worker.busy_time
+      utilisation.append(round(min((busy_time - self.last_busy_time[number]) / elapsed, 1.0), 2))
+      self.last_busy_time[number] = busy_time
+    self.last_stats = now
+
+    with self.lock:
+      pending = self.pending
+    running = len([worker for worker in self.workers if worker.busy])
+    return {
+        'workers': len(self.workers),
+        'pending': pending,
+        'queued': self.queue.qsize(),
+        'running': running,
+        'completed': sum(worker.completed for worker in self.workers),
+        'utilisation': utilisation}
@@ -1,20 +1,40 @@
-from condition_evaluator.evaluator import Evaluator
-from handlers.handlers import handlers
-from handlers.password_transaction.password_db import RSAKeyPairs, LockedPasswordTransaction, RightGuess, SentPasswordTransaction
-from handlers.password_transaction.util import Util
+from handlers.handlers import op_handlers as handlers
+from handlers.password_db import RSAKeyPairs, LockedPasswordTransaction, RightGuess, SentPasswordTransaction
+from handlers.bounty_contract.util import Util
+from handlers.bounty_contract import key_pool
+from handlers.bounty_contract.key_pool import KeyCipher, KeyPool, load_secret, generate_keypair, ENCRYPTED_PREFIX, SECRET_SIZE
 from oracle import Oracle
 from oracle_communication import OracleCommunication
-from oracle_db import OracleDb, TaskQueue, TransactionRequestDb, HandledTransaction, SignedTransaction
+from oracle_request import OracleRequest
+from compaction import Compactor, AUTO_VACUUM_INCREMENTAL
+from admission import AdmissionControl, TokenBucket
+from broadcaster import Broadcaster, BitcoindSink, StubSink, retry_delay, MAX_ATTEMPTS, RETRY_DELAY, MAX_RETRY_DELAY
+from oracle_db import OracleDb, TaskQueue, TransactionRequestDb, HandledTransaction, SignedTransaction, BroadcastQueue, KeyValue, PriceObservation
+from scheduler import Scheduler, STATS_LOG_INTERVAL
+from taskpool import TaskPool
 
 from settings_local import ORACLE_ADDRESS
+from shared.db_classes import GeneralDb
 from shared.bitmessage_communication.bitmessagemessage import BitmessageMessage
 from shared.bitcoind_client.bitcoinclient import BitcoinClient
+from shared.bitcoind_client import bitcoinclient
+from shared.tests import StubBitcoindServer, StubRpcError
 
 import base64
+import gzip
 import hashlib
 import json
 import os
+import shutil
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
 import unittest
+import xmlrpclib
+
+import oracle_communication
 
 from collections import defaultdict
 from Crypto.PublicKey import RSA
@@ -56,8 +76,7 @@ def create_message(tx, prevtx, pubkeys):
 
 class MockOracleDb(OracleDb):
   def __init__(self):
-    self._filename = TEMP_DB_FILE
-    self.connect()
+    GeneralDb.__init__(self, TEMP_DB_FILE)
     operations = {
       'conditioned_transaction': TransactionRequestDb
     }
@@ -75,7 +94,6 @@ class MockOracle(Oracle):
     self.communication = MockBitmessageCommunication()
     self.db = MockOracleDb()
     self.btc = BitcoinClient(account = TEST_ACCOUNT)
-    self.evaluator = Evaluator()
 
     self.task_queue = TaskQueue(self.db)
 
@@ -338,9 +356,9 @@ class OracleTests(unittest.TestCase):
     self.assertEqual(len(self.oracle.task_queue.get_all_tasks()), 1)
 
   def test_password_transaction_request_corresponds_to_protocol(self):
-    oc = OracleCommunication()
+    oc = OracleCommunication(self.oracle.db)
     operation, message = self.create_password_transaction_request()
-    self.assertEqual(oc.corresponds_to_protocol(message), 'password_transaction')
+    self.assertEqual(oc.parse_request(message).operation, 'password_transaction')
 
   def test_handle_expired_password_transaction(self):
     request = self.create_password_transaction_request()
@@ -450,3 +468,510 @@ class OracleTests(unittest.TestCase):
     self.oracle.handle_task(final_tasks[0])
 
     self.assertEqual(len(self.oracle.task_queue.get_all_ignore_checks()), 1)
+
+
+class TaskPoolTests(unittest.TestCase):
+  def run_pool(self, items, workers=2):
+    # submits (key, name) items, returns name -> (start, end) once all ran
+    times = {}
+    finished = threading.Event()
+
+    def run_item(context, name):
+      start = time.time()
+      time.sleep(0.05)
+      times[name] = (start, time.time())
+
+    def on_finished():
+      if len(times) == len(items):
+        finished.set()
+
+    pool = TaskPool(workers, lambda: None, run_item, len(items), on_finished=on_finished)
+    pool.start()
+    for key, name in items:
+      pool.submit(key, name)
+    self.assertTrue(finished.wait(5))
+    return times
+
+  def test_same_key_runs_one_at_a_time(self):
+    times = self.run_pool([('a', 'first'), ('a', 'second'), ('b', 'other')])
+    self.assertGreaterEqual(times['second'][0], times['first'][1])
+    # other keys aren't held up
+    self.assertLess(times['other'][0], times['first'][1])
+
+  def test_capacity(self):
+    done = threading.Event()
+    pool = TaskPool(1, lambda: None, lambda context, item: done.wait(5), 2)
+    pool.start()
+    pool.submit('a', 1)
+    self.assertEqual(pool.capacity(), 1)
+    pool.submit('a', 2)
+    self.assertEqual(pool.capacity(), 0)
+    done.set()
+    deadline = time.time() + 5
+    while pool.capacity() < 2 and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(pool.capacity(), 2)
+
+
+class SchedulerTests(unittest.TestCase):
+  def test_past_next_check_does_not_wait(self):
+    scheduler = Scheduler(min_interval=1.0, max_interval=1.0)
+    start = time.time()
+    scheduler.wait(time.time() - 10)
+    self.assertLess(time.time() - start, 0.1)
+
+  def test_no_next_check_waits_for_poll_interval(self):
+    # a full task pool waits this way instead of spinning on a past next_check
+    scheduler = Scheduler(min_interval=0.2, max_interval=0.2)
+    start = time.time()
+    scheduler.wait(None)
+    self.assertGreaterEqual(time.time() - start, 0.15)
+
+  def test_wake_ends_wait(self):
+    scheduler = Scheduler(min_interval=5.0, max_interval=5.0)
+    threading.Timer(0.05, scheduler.wake).start()
+    start = time.time()
+    scheduler.wait(None)
+    self.assertLess(time.time() - start, 1.0)
+    # and doesn't shorten the next one
+    start = time.time()
+    threading.Timer(0.2, scheduler.wake).start()
+    scheduler.wait(None)
+    self.assertGreaterEqual(time.time() - start, 0.15)
+
+  def test_stats_due_once_per_interval(self):
+    scheduler = Scheduler()
+    self.assertFalse(scheduler.stats_due())
+    scheduler.last_stats_log -= STATS_LOG_INTERVAL
+    self.assertTrue(scheduler.stats_due())
+    scheduler.log_stats()
+    self.assertFalse(scheduler.stats_due())
+
+
+class FakeBitmessageClient:
+  # marshals arguments like the API proxy would, so only msgids get through
+  default_address = 'dummyaddress'
+
+  def __init__(self):
+    self.read = []
+
+  def mark_message_as_read(self, msgid):
+    xmlrpclib.dumps((msgid, True))
+    self.read.append(msgid)
+
+
+class OracleCommunicationTests(unittest.TestCase):
+  def setUp(self):
+    self.bitmessage_client = oracle_communication.BitmessageClient
+    oracle_communication.BitmessageClient = FakeBitmessageClient
+    self.filename = tempfile.mktemp(suffix='.db')
+    self.communication = OracleCommunication(GeneralDb(self.filename))
+
+  def tearDown(self):
+    oracle_communication.BitmessageClient = self.bitmessage_client
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(self.filename + suffix):
+        os.remove(self.filename + suffix)
+
+  def pending_request(self, msgid):
+    # request as get_new_requests() hands it out
+    msg_dict = defaultdict(lambda: 'dummy')
+    msg_dict['receivedTime'] = 1000
+    msg_dict['msgid'] = msgid
+    msg_dict['message'] = base64.encodestring('{"operation": "timelock_create"}')
+    message = BitmessageMessage(msg_dict, 'otheraddress')
+    content_hash = self.communication.content_hash(message)
+    self.communication.request_hashes[msgid] = content_hash
+    self.communication.pending_hashes.add(content_hash)
+    return ('timelock_create', OracleRequest('timelock_create', {}, message)), content_hash
+
+  def test_mark_request_done(self):
+    request, content_hash = self.pending_request('msg1')
+    with self.communication.db.transaction():
+      self.communication.remember_request(request)
+    self.communication.mark_request_done(request)
+    self.assertEqual(self.communication.client.read, ['msg1'])
+    self.assertNotIn(content_hash, self.communication.pending_hashes)
+    self.assertTrue(self.communication.is_duplicate(content_hash))
+    self.assertTrue(self.communication.seen_requests.seen(content_hash))
+
+  def test_failed_request_is_not_seen(self):
+    request, content_hash = self.pending_request('msg1')
+    self.communication.mark_request_done(request, handled=False)
+    self.assertEqual(self.communication.client.read, ['msg1'])
+    self.assertNotIn(content_hash, self.communication.pending_hashes)
+    self.assertFalse(self.communication.is_duplicate(content_hash))
+
+
+class QueuedRequest:
+  # admission only looks at the operation
+  def __init__(self, operation, name):
+    self.operation = operation
+    self.name = name
+
+
+class AdmissionTests(unittest.TestCase):
+  def test_bucket_burst_and_refill(self):
+    bucket = TokenBucket(2.0, 3, 100.0)
+    self.assertEqual([bucket.take(100.0) for i in range(4)], [True, True, True, False])
+    # half a second at 2/s brings one token back
+    self.assertTrue(bucket.take(100.5))
+    self.assertFalse(bucket.take(100.5))
+    # never more than the burst, however long the sender was quiet
+    self.assertEqual([bucket.take(1000.0) for i in range(4)], [True, True, True, False])
+
+  def test_allow_limits_every_sender_alone(self):
+    admission = AdmissionControl(rate=0, burst=2)
+    self.assertEqual([admission.allow('a') for i in range(3)], [True, True, False])
+    self.assertTrue(admission.allow('b'))
+    self.assertEqual(admission.stats()['dropped'], {'rate_limited': 1})
+
+  def test_priority_order(self):
+    admission = AdmissionControl()
+    for operation, name in [('timelock_create', 'new'), ('bounty_redeem', 'redeem'), ('sign', 'sign1'), ('sign', 'sign2')]:
+      self.assertIsNone(admission.push(QueuedRequest(operation, name)))
+    self.assertEqual([r.name for r in admission.pop(3)], ['sign1', 'sign2', 'redeem'])
+    self.assertEqual([r.name for r in admission.pop()], ['new'])
+    self.assertEqual(admission.queued, 0)
+
+  def test_shedding_when_full(self):
+    admission = AdmissionControl(max_queued=2)
+    admission.push(QueuedRequest('timelock_create', 'old'))
+    admission.push(QueuedRequest('timelock_create', 'new'))
+    # the newest of the least important requests makes room
+    self.assertEqual(admission.push(QueuedRequest('sign', 'sign')).name, 'new')
+    # a request not more important than what's queued is shed itself
+    self.assertEqual(admission.push(QueuedRequest('timelock_create', 'newer')).name, 'newer')
+    self.assertEqual(admission.queued, 2)
+    self.assertEqual([r.name for r in admission.pop()], ['sign', 'old'])
+    self.assertEqual(admission.stats()['dropped'], {'queue_full': 2})
+
+
+class FailingSink:
+  def __init__(self):
+    self.attempts = 0
+
+  def push(self, transaction):
+    self.attempts += 1
+    raise IOError('push service unreachable')
+
+
+class BroadcasterTests(unittest.TestCase):
+  def setUp(self):
+    self.filename = tempfile.mktemp(suffix='.db')
+    self.db = GeneralDb(self.filename)
+    self.stub = StubSink()
+    self.failing = FailingSink()
+    self.broadcaster = Broadcaster(self.db, {'stub': self.stub, 'failing': self.failing}, workers=0)
+    self.queue = self.broadcaster.queue
+
+  def tearDown(self):
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(self.filename + suffix):
+        os.remove(self.filename + suffix)
+
+  def rows(self):
+    rows = self.db.get_cursor().execute('select * from broadcast_queue order by id').fetchall()
+    return dict((row['sink'], dict(row)) for row in rows)
+
+  def claim(self, sink):
+    # claims pushes until the one for sink, the others go back to the queue
+    claimed = []
+    item = self.queue.claim()
+    while item is not None and item['sink'] != sink:
+      claimed.append(item)
+      item = self.queue.claim()
+    for other in claimed:
+      self.queue.retry(other, None, time.time() - 1)
+    return item
+
+  def test_enqueue_once_per_sink(self):
+    self.broadcaster.enqueue('aabb')
+    self.broadcaster.enqueue('aabb')
+    self.assertEqual(sorted(self.rows()), ['failing', 'stub'])
+    self.assertEqual(self.queue.counts(), {'pending': 2, 'in_flight': 0})
+
+  def test_claim_is_atomic(self):
+    for number in range(20):
+      self.queue.add('tx%d' % number, 'stub')
+    claimed = []
+
+    def claimer():
+      item = self.queue.claim()
+      while item is not None:
+        claimed.append(item['id'])
+        item = self.queue.claim()
+
+    threads = [threading.Thread(target=claimer) for number in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(sorted(claimed), range(1, 21))
+    self.assertEqual(self.queue.counts(), {'pending': 0, 'in_flight': 20})
+
+  def test_release_claimed(self):
+    self.queue.add('aabb', 'stub')
+    item = self.queue.claim()
+    self.assertIsNone(self.queue.claim())
+    self.assertEqual(self.queue.release_claimed(), 1)
+    self.assertEqual(self.queue.claim()['id'], item['id'])
+
+  def test_push_to_stub(self):
+    self.broadcaster.enqueue('aabb')
+    self.assertTrue(self.broadcaster.push(self.claim('stub')))
+    self.assertEqual(self.stub.transactions, ['aabb'])
+    row = self.rows()['stub']
+    self.assertEqual((row['state'], row['attempts']), (BroadcastQueue.SENT, 1))
+    self.assertEqual(self.broadcaster.stats()['sent'], {'stub': 1})
+
+  def test_failed_push_is_retried_later(self):
+    self.broadcaster.enqueue('aabb')
+    before = time.time()
+    self.assertFalse(self.broadcaster.push(self.claim('failing')))
+    row = self.rows()['failing']
+    self.assertEqual((row['state'], row['attempts']), (BroadcastQueue.PENDING, 1))
+    self.assertIn('push service unreachable', row['last_error'])
+    self.assertGreaterEqual(row['next_attempt'], int(before) + RETRY_DELAY)
+    # not due until then
+    self.assertIsNone(self.claim('failing'))
+    self.assertEqual(self.broadcaster.stats()['retries'], {'failing': 1})
+
+  def test_retry_delay_backoff(self):
+    self.assertEqual([retry_delay(attempts) for attempts in (1, 2, 3)], [RETRY_DELAY, RETRY_DELAY * 2, RETRY_DELAY * 4])
+    self.assertEqual(retry_delay(MAX_ATTEMPTS), MAX_RETRY_DELAY)
+
+  def test_push_given_up_after_max_attempts(self):
+    self.broadcaster.enqueue('aabb')
+    self.db.get_cursor().execute('update broadcast_queue set attempts=?', (MAX_ATTEMPTS - 1, ))
+    self.db.commit()
+    self.assertFalse(self.broadcaster.push(self.claim('failing')))
+    row = self.rows()['failing']
+    self.assertEqual((row['state'], row['attempts']), (BroadcastQueue.FAILED, MAX_ATTEMPTS))
+    self.assertEqual(self.broadcaster.stats()['failed'], {'failing': 1})
+    self.assertEqual(self.queue.get_next_attempt(), self.rows()['stub']['next_attempt'])
+
+  def bitcoind_broadcaster(self, error_code):
+    # BitcoindSink talking to a stub bitcoind that rejects every transaction
+    def send_raw_transaction(transaction):
+      raise StubRpcError(error_code, 'rejected')
+    self.bitcoind = StubBitcoindServer({'sendrawtransaction': send_raw_transaction})
+    self.addCleanup(self.bitcoind.server_close)
+    self.addCleanup(self.bitcoind.shutdown)
+    port = bitcoinclient.BITCOIND_RPC_PORT
+    bitcoinclient.BITCOIND_RPC_PORT = self.bitcoind.port
+    try:
+      sink = BitcoindSink()
+    finally:
+      bitcoinclient.BITCOIND_RPC_PORT = port
+    return Broadcaster(self.db, {'bitcoind': sink}, workers=0)
+
+  def test_bitcoind_already_in_chain(self):
+    broadcaster = self.bitcoind_broadcaster(-27)
+    broadcaster.enqueue('aabb')
+    self.assertTrue(broadcaster.push(self.claim('bitcoind')))
+    self.assertEqual(self.rows()['bitcoind']['state'], BroadcastQueue.SENT)
+    self.assertEqual(self.bitcoind.calls, [('sendrawtransaction', ['aabb'])])
+
+  def test_bitcoind_rejected(self):
+    broadcaster = self.bitcoind_broadcaster(-26)
+    broadcaster.enqueue('aabb')
+    self.assertFalse(broadcaster.push(self.claim('bitcoind')))
+    row = self.rows()['bitcoind']
+    self.assertEqual(row['state'], BroadcastQueue.PENDING)
+    self.assertIn('-26', row['last_error'])
+
+# smallest size pycrypto generates, keeps the tests fast
+TEST_KEY_SIZE = 1024
+
+class KeyPoolTests(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.secret_file = key_pool.RSA_KEY_SECRET_FILE
+    os.mkdir(os.path.join(self.directory, 'secret'))
+    key_pool.RSA_KEY_SECRET_FILE = os.path.join(self.directory, 'secret', 'rsa_key.secret')
+    key_pool._cipher = None
+    self.db = GeneralDb(os.path.join(self.directory, 'keys.db'))
+    self.pool = KeyPool(self.db, size=1, processes=0, key_size=TEST_KEY_SIZE)
+
+  def tearDown(self):
+    key_pool.RSA_KEY_SECRET_FILE = self.secret_file
+    key_pool._cipher = None
+    shutil.rmtree(self.directory)
+
+  def test_cipher_round_trip(self):
+    cipher = KeyCipher('a' * SECRET_SIZE)
+    encrypted = cipher.encrypt('{"d": 12345}')
+    self.assertTrue(encrypted.startswith(ENCRYPTED_PREFIX))
+    self.assertNotIn('12345', encrypted)
+    self.assertEqual(cipher.decrypt(encrypted), '{"d": 12345}')
+    # fresh iv every time
+    self.assertNotEqual(cipher.encrypt('{"d": 12345}'), encrypted)
+
+  def test_cipher_rejects_other_secret(self):
+    encrypted = KeyCipher('a' * SECRET_SIZE).encrypt('{"d": 12345}')
+    self.assertRaises(ValueError, KeyCipher('b' * SECRET_SIZE).decrypt, encrypted)
+
+  def test_cipher_rejects_tampered_key(self):
+    cipher = KeyCipher('a' * SECRET_SIZE)
+    data = base64.b64decode(cipher.encrypt('{"d": 12345}')[len(ENCRYPTED_PREFIX):])
+    data = data[:20] + chr(ord(data[20]) ^ 1) + data[21:]
+    self.assertRaises(ValueError, cipher.decrypt, ENCRYPTED_PREFIX + base64.b64encode(data))
+
+  def test_cipher_passes_legacy_plaintext(self):
+    self.assertEqual(KeyCipher('a' * SECRET_SIZE).decrypt('{"d": 12345}'), '{"d": 12345}')
+
+  def test_load_secret_creates_it_once(self):
+    filename = key_pool.RSA_KEY_SECRET_FILE
+    secret = load_secret(filename)
+    self.assertEqual(len(secret), SECRET_SIZE)
+    self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0600)
+    self.assertEqual(load_secret(filename), secret)
+    # no temporary files left behind
+    self.assertEqual(os.listdir(os.path.dirname(filename)), ['rsa_key.secret'])
+
+  def test_load_secret_rejects_short_secret(self):
+    filename = key_pool.RSA_KEY_SECRET_FILE
+    with open(filename, 'wb') as f:
+      f.write('short')
+    self.assertRaises(ValueError, load_secret, filename)
+
+  def test_claim_from_pool(self):
+    public, whole = generate_keypair(TEST_KEY_SIZE)
+    self.pool.keys.add_unclaimed(public, key_pool.key_cipher().encrypt(whole))
+    self.assertEqual(self.pool.claim('pwtxid1'), public)
+    self.assertEqual(self.pool.keys.unclaimed_count(), 0)
+    stored = self.pool.keys.get_by_pwtxid('pwtxid1')
+    self.assertEqual(key_pool.key_cipher().decrypt(stored['whole']), whole)
+    self.assertEqual((self.pool.claimed, self.pool.fallbacks), (1, 0))
+
+  def test_claim_from_empty_pool_generates_key(self):
+    public = self.pool.claim('pwtxid1')
+    stored = self.pool.keys.get_by_pwtxid('pwtxid1')
+    self.assertEqual(stored['public'], public)
+    self.assertTrue(stored['whole'].startswith(ENCRYPTED_PREFIX))
+    whole = json.loads(key_pool.key_cipher().decrypt(stored['whole']))
+    self.assertEqual(whole['n'], json.loads(public)['n'])
+    self.assertEqual((self.pool.claimed, self.pool.fallbacks), (0, 1))
+
+  def test_fallback_key_generated_without_write_lock(self):
+    # another writer (worker, broadcaster) keeps writing while the key of
+    # an empty pool is being generated
+    filename = os.path.join(self.directory, 'keys.db')
+    self.db.execute('create table other_writes (a integer)')
+    writes = []
+
+    def write():
+      conn = sqlite3.connect(filename, timeout=0.5)
+      try:
+        conn.execute('insert into other_writes values (1)')
+        conn.commit()
+        writes.append('ok')
+      except sqlite3.OperationalError as e:
+        writes.append(str(e))
+      conn.close()
+
+    def generate(key_size):
+      thread = threading.Thread(target=write)
+      thread.start()
+      thread.join()
+      return generate_keypair(key_size)
+
+    key_pool.generate_keypair = generate
+    try:
+      with self.db.transaction():
+        # the request's own read before the claim
+        self.pool.keys.get_by_pwtxid('pwtxid1')
+        self.pool.claim('pwtxid1')
+    finally:
+      key_pool.generate_keypair = generate_keypair
+    self.assertEqual(writes, ['ok'])
+    self.assertIsNotNone(self.pool.keys.get_by_pwtxid('pwtxid1'))
+
+  def test_rolled_back_claim_returns_key(self):
+    public, whole = generate_keypair(TEST_KEY_SIZE)
+    self.pool.keys.add_unclaimed(public, key_pool.key_cipher().encrypt(whole))
+    try:
+      with self.db.transaction():
+        self.pool.claim('pwtxid1')
+        raise KeyError('handler failed')
+    except KeyError:
+      pass
+    self.assertEqual(self.pool.keys.unclaimed_count(), 1)
+    self.assertIsNone(self.pool.keys.get_by_pwtxid('pwtxid1'))
+    self.assertEqual(self.pool.claim('pwtxid2'), public)
+
+
+class KeyValueTests(unittest.TestCase):
+  def setUp(self):
+    self.filename = tempfile.mktemp(suffix='.db')
+    self.db = GeneralDb(self.filename)
+    self.kv = KeyValue(self.db)
+    self.kv.store('signable', 'tx', {'sigs_so_far': 0})
+
+  def tearDown(self):
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(self.filename + suffix):
+        os.remove(self.filename + suffix)
+
+  def get_in_other_thread(self):
+    # like a worker reading while this thread is in a transaction
+    values = []
+    thread = threading.Thread(target=lambda: values.append(self.kv.get_by_section_key('signable', 'tx')))
+    thread.start()
+    thread.join()
+    return values[0]
+
+  def test_rolled_back_value_never_shared(self):
+    try:
+      with self.db.transaction():
+        self.kv.update('signable', 'tx', {'sigs_so_far': 1})
+        self.assertEqual(self.kv.get_by_section_key('signable', 'tx'), {'sigs_so_far': 1})
+        self.assertEqual(self.get_in_other_thread(), {'sigs_so_far': 0})
+        raise KeyError('handler failed')
+    except KeyError:
+      pass
+    self.assertEqual(self.kv.get_by_section_key('signable', 'tx'), {'sigs_so_far': 0})
+    self.assertEqual(self.get_in_other_thread(), {'sigs_so_far': 0})
+
+  def test_committed_value_cached(self):
+    with self.db.transaction():
+      self.kv.update('signable', 'tx', {'sigs_so_far': 1})
+      # cached by the other thread meanwhile, replaced on commit
+      self.assertEqual(self.get_in_other_thread(), {'sigs_so_far': 0})
+    self.assertEqual(self.kv.cache.get(('signable', 'tx')), json.dumps({'sigs_so_far': 1}))
+    self.assertEqual(self.get_in_other_thread(), {'sigs_so_far': 1})
+
+class CompactionTests(unittest.TestCase):
+  def setUp(self):
+    self.filename = tempfile.mktemp(suffix='.db')
+    self.archive_dir = tempfile.mkdtemp()
+    self.db = GeneralDb(self.filename)
+    self.compactor = Compactor(self.db, self.archive_dir, {'price_observation': 30})
+
+  def tearDown(self):
+    shutil.rmtree(self.archive_dir)
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(self.filename + suffix):
+        os.remove(self.filename + suffix)
+
+  def auto_vacuum(self):
+    return self.db.get_cursor().execute('pragma auto_vacuum').fetchone()[0]
+
+  def test_full_vacuum_only_when_asked(self):
+    self.db.get_cursor().execute('create table t (x)')
+    self.assertFalse(self.compactor.enable_incremental_vacuum())
+    self.assertNotEqual(self.auto_vacuum(), AUTO_VACUUM_INCREMENTAL)
+    self.assertTrue(self.compactor.enable_incremental_vacuum(full_vacuum=True))
+    self.assertEqual(self.auto_vacuum(), AUTO_VACUUM_INCREMENTAL)
+
+  def test_price_observation_archived(self):
+    observations = PriceObservation(self.db)
+    old = int(time.time()) - 40 * 24 * 60 * 60
+    observations.record(old, '400')
+    observations.record(int(time.time()), '500')
+    self.assertTrue(self.compactor.step())
+    self.assertEqual([row['price'] for row in self.db.get_cursor().execute('select price from price_observation')], ['500'])
+    date = time.strftime('%Y-%m-%d', time.gmtime(old))
+    with gzip.open(os.path.join(self.archive_dir, 'price_observation', date + '.jsonl.gz')) as f:
+      self.assertEqual([json.loads(line) for line in f], [{'ts': old, 'price': '400'}])
@@ -1,9 +1,22 @@
 #!/usr/bin/env python2.7
 from shared import logger
 from oracle.oracle import Oracle
+from oracle.oracle_db import OracleDb
+from oracle.compaction import Compactor
+
+import sys
+
+def vacuum():
+  # full VACUUM rewrites the whole db, so it's run with the oracle stopped
+  db = OracleDb()
+  db.migrate()
+  Compactor(db).enable_incremental_vacuum(full_vacuum=True)
 
 def main():
   logger.init_logger()
+  if sys.argv[1:] == ['--vacuum']:
+    vacuum()
+    return
   o = Oracle()
   o.run()
 
@@ -1,42 +1,239 @@
 from settings_local import *
+from shared.lru_cache import LRUCache
+from rawtransaction import parse_transaction, TransactionParseError
 
+import functools
+import httplib
 import json
 import jsonrpclib
-from xmlrpclib import ProtocolError
+import socket
+import threading
+import time
+import xmlrpclib
 from decimal import Decimal
 
 import logging
 
+try:
+  from settings_local import BITCOIND_HEARTBEAT_INTERVAL
+except ImportError:
+  BITCOIND_HEARTBEAT_INTERVAL = 0
+
+try:
+  from settings_local import BITCOIND_RPC_TIMEOUT
+except ImportError:
+  BITCOIND_RPC_TIMEOUT = 60
+
+# decoderawtransaction/decodescript results kept per client
+DECODE_CACHE_SIZE = 512
+
+# how many times a call is retried after reconnecting on a transport error.
+# Calls that change something in bitcoind (single_attempt) aren't retried
+RPC_RETRIES = 2
+
+# errors meaning the connection is broken, as opposed to bitcoind
+# rejecting the call (RPC_ERRORS)
+TRANSPORT_ERRORS = (socket.error, httplib.HTTPException)
+
+# bitcoind rejecting the call. jsonrpclib raises its own ProtocolError with
+# (code, message) for errors, xmlrpclib's one comes from HTTP errors without
+# a JSON-RPC error in the body (e.g. wrong password)
+RPC_ERRORS = (jsonrpclib.ProtocolError, xmlrpclib.ProtocolError)
+
+def rpc_error_code(error):
+  # bitcoind's error code of one of RPC_ERRORS, None if there's none
+  if isinstance(error, jsonrpclib.ProtocolError) and error.args and isinstance(error.args[0], tuple):
+    return error.args[0][0]
+  return None
+
+class TimeoutTransport(jsonrpclib.jsonrpc.Transport):
+  # a call to a hung bitcoind fails after timeout seconds instead of
+  # blocking its thread forever
+  def __init__(self, timeout):
+    jsonrpclib.jsonrpc.Transport.__init__(self)
+    self.timeout = timeout
+
+  def make_connection(self, host):
+    connection = jsonrpclib.jsonrpc.Transport.make_connection(self, host)
+    connection.timeout = self.timeout
+    return connection
+
+  def request(self, host, handler, request_body, verbose=0):
+    # sent once. xmlrpclib's resends it if the connection drops before the
+    # answer, which would repeat single_attempt calls. Retries are left to
+    # keep_alive
+    return self.single_request(host, handler, request_body, verbose)
+
+  def single_request(self, host, handler, request_body, verbose=0):
+    # xmlrpclib's, except for error answers. bitcoind sends errors with HTTP
+    # status 500 and xmlrpclib throws the body with the error code away, so
+    # it's raised here like jsonrpclib raises errors in a 200 answer
+    connection = self.make_connection(host)
+    try:
+      self.send_request(connection, handler, request_body)
+      self.send_host(connection, host)
+      self.send_user_agent(connection)
+      self.send_content(connection, request_body)
+      response = connection.getresponse(buffering=True)
+      if response.status == 200:
+        self.verbose = verbose
+        return self.parse_response(response)
+      body = response.read()
+    except:
+      self.close()
+      raise
+
+    try:
+      error = json.loads(body)['error']
+      code, message = error['code'], error['message']
+    except (ValueError, KeyError, TypeError):
+      # without the credentials xmlrpclib puts in, errors get logged and stored
+      url = host.rpartition('@')[2] + handler
+      raise xmlrpclib.ProtocolError(url, response.status, response.reason, response.msg)
+    raise jsonrpclib.ProtocolError((code, message))
+
+
 class BitcoinClient:
 
   def __init__(self, account=None):
     self.account = account
+    # decoding is a pure function of the hex, so results can be reused.
+    # cached dicts are shared between callers and must not be modified
+    self.transaction_cache = LRUCache(DECODE_CACHE_SIZE)
+    self.script_cache = LRUCache(DECODE_CACHE_SIZE)
+
+    # jsonrpclib connection is not thread safe (heartbeat runs in a thread)
+    self.lock = threading.RLock()
+    self.reconnects = 0
+    self.retries = 0
+    self.last_call = time.time()
     self.connect()
 
+    if BITCOIND_HEARTBEAT_INTERVAL:
+      self.start_heartbeat(BITCOIND_HEARTBEAT_INTERVAL)
+
   def connect(self):
+    # jsonrpclib uses xmlrpclib's HTTP/1.1 transport, which keeps the
+    # connection open between calls. New server = new connection
     self.server = jsonrpclib.Server('http://{0}:{1}@{2}:{3}'.format(
         BITCOIND_RPC_USERNAME,
         BITCOIND_RPC_PASSWORD,
         BITCOIND_RPC_HOST,
-        BITCOIND_RPC_PORT))
+        BITCOIND_RPC_PORT),
+        transport=TimeoutTransport(BITCOIND_RPC_TIMEOUT))
+
+  def keep_alive(fun, max_retries=RPC_RETRIES):
+    def call_and_reconnect(self, *args, **kwargs):
+      with self.lock:
+        retries = 0
+        while True:
+          try:
+            result = fun(self, *args, **kwargs)
+            self.last_call = time.time()
+            return result
+          except TRANSPORT_ERRORS:
+            logging.warning('bitcoind connection lost during {0}, reconnecting'.format(fun.__name__))
+            self.reconnects += 1
+            self.connect()
+            if retries >= max_retries:
+              raise
+            retries += 1
+            self.retries += 1
+    call_and_reconnect.__name__ = fun.__name__
+    return call_and_reconnect
+
+  # for calls with side effects - bitcoind may have acted on a call whose
+  # reply was lost, so it's not repeated. The connection is still replaced
+  single_attempt = functools.partial(keep_alive, max_retries=0)
+
+  def start_heartbeat(self, interval):
+    """
+    Pings bitcoind from a background thread whenever there was no other call
+    for `interval` seconds, so a dead connection gets replaced before
+    a request needs it.
+    """
+    def heartbeat():
+      while True:
+        time.sleep(interval)
+        if time.time() - self.last_call < interval:
+          continue
+        try:
+          self.ping()
+        except:
+          logging.exception('bitcoind heartbeat failed')
+
+    thread = threading.Thread(target=heartbeat, name='btc-heartbeat')
+    thread.daemon = True
+    thread.start()
+
+  def stats(self):
+    return {
+        'reconnects': self.reconnects,
+        'retries': self.retries,
+        'transactions': self.transaction_cache.stats(),
+        'scripts': self.script_cache.stats()}
 
-  def keep_alive(fun):
-    def ping_and_reconnect(self, *args, **kwargs):
-      try:
-        # Cheap API call that checks wether we're connected
-        self.server.help()
-      except:
-        self.connect()
-      return fun(self, *args, **kwargs)
-    return ping_and_reconnect
+  @keep_alive
+  def ping(self):
+    return self.server.getblockcount()
+
+  def _decode_raw_transaction(self, hex_transaction):
+    transaction_dict = self.transaction_cache.get(hex_transaction)
+    if transaction_dict is None:
+      transaction_dict = self.server.decoderawtransaction(hex_transaction)
+      self.transaction_cache.put(hex_transaction, transaction_dict)
+    return transaction_dict
+
+  def _parse_transaction(self, raw_transaction):
+    # helpers that only need the structure of a transaction parse it locally,
+    # bitcoind is asked only when the local parser can't handle it
+    try:
+      return parse_transaction(raw_transaction)
+    except TransactionParseError:
+      return self._decode_raw_transaction(raw_transaction)
+
+  def _decode_script(self, script):
+    script_dict = self.script_cache.get(script)
+    if script_dict is None:
+      script_dict = self.server.decodescript(script)
+      self.script_cache.put(script, script_dict)
+    return script_dict
+
+  def _decode_scripts(self, scripts):
+    # cache misses are decoded with a single batch request
+    missing = [script for script in set(scripts) if not script in self.script_cache]
+    decoded = self._batch([('decodescript', [script]) for script in missing])
+    for script, script_dict in zip(missing, decoded):
+      self.script_cache.put(script, script_dict)
+    return [self._decode_script(script) for script in scripts]
+
+  def _batch(self, calls):
+    if len(calls) == 0:
+      return []
+    # jsonrpclib's MultiCall returns answers in the order they come, but a
+    # server may answer a batch in any order. Calls are numbered instead,
+    # from 1 as jsonrpclib replaces id 0 with a random one
+    request = '[%s]' % ','.join(
+        jsonrpclib.dumps(list(params), method, rpcid=number) for number, (method, params) in enumerate(calls, 1))
+    answers = sorted(self.server._run_request(request), key=lambda answer: answer['id'])
+    return [jsonrpclib.jsonrpc.check_for_errors(answer)['result'] for answer in answers]
+
+  @keep_alive
+  def batch(self, calls):
+    """
+    Sends all calls as one JSON-RPC batch request. calls is a list of
+    (method, params) pairs, results are returned in the same order.
+    Raises if any of the calls failed.
+    """
+    return self._batch(calls)
 
   @keep_alive
   def decode_raw_transaction(self, hex_transaction):
-    return self.server.decoderawtransaction(hex_transaction)
+    return self._decode_raw_transaction(hex_transaction)
 
   @keep_alive
   def get_json_transaction(self, hex_transaction):
-    return self.server.decoderawtransaction(hex_transaction)
+    return self._decode_raw_transaction(hex_transaction)
 
   @keep_alive
   def sign_transaction(self, raw_transaction, prevtx = [], priv_keys=None):
@@ -48,16 +245,18 @@ class BitcoinClient:
 
   @keep_alive
   def get_txid(self, raw_transaction):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self._parse_transaction(raw_transaction)
     return transaction_dict['txid']
 
   @keep_alive
   def signatures_count(self, raw_transaction, prevtx):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self._parse_transaction(raw_transaction)
 
     prevtx_dict = {}
     for tx in prevtx:
       prevtx_dict[str((tx['txid'], tx['vout']))] = tx['redeemScript']
+    # fills the script cache for the loop below
+    self._decode_scripts(prevtx_dict.values())
 
     has_signatures = 999
     for vin in transaction_dict['vin']:
@@ -69,7 +268,7 @@ class BitcoinClient:
         continue
       asm_elements = asm.split()
       try:
-        asm_script_dict = self.server.decodescript(redeem_script)
+        asm_script_dict = self._decode_script(redeem_script)
         int(asm_script_dict['reqSigs'])
       except KeyError:
         logging.error('script is missing reqSigs field')
@@ -88,7 +287,7 @@ class BitcoinClient:
 
   @keep_alive
   def signatures(self, raw_transaction, prevtx):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self._decode_raw_transaction(raw_transaction)
 
     prevtx_dict = {}
     for tx in prevtx:
@@ -104,7 +303,7 @@ class BitcoinClient:
         continue
       asm_elements = asm.split()
       try:
-        asm_script_dict = self.server.decodescript(redeem_script)
+        asm_script_dict = self._decode_script(redeem_script)
         int(asm_script_dict['reqSigs'])
       except KeyError:
         logging.error('script is missing reqSigs field')
@@ -120,8 +319,8 @@ class BitcoinClient:
   def is_valid_transaction(self, raw_transaction):
     # Is raw transaction valid and decodable?
     try:
-      self.server.decoderawtransaction(raw_transaction)
-    except ProtocolError:
+      self._decode_raw_transaction(raw_transaction)
+    except RPC_ERRORS:
       logging.exception('tx invalid')
       return False
     return True
@@ -131,13 +330,22 @@ class BitcoinClient:
     result = self.server.validateaddress(address)
     return result['ismine']
 
+  @keep_alive
+  def addresses_are_mine(self, addresses):
+    results = self._batch([('validateaddress', [address]) for address in addresses])
+    return [result['ismine'] for result in results]
+
   @keep_alive
   def decode_script(self, script):
-    return self.server.decodescript(script)
+    return self._decode_script(script)
+
+  @keep_alive
+  def decode_scripts(self, scripts):
+    return self._decode_scripts(scripts)
 
   @keep_alive
   def get_inputs_outputs(self, raw_transaction):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self._parse_transaction(raw_transaction)
     vin = transaction_dict["vin"]
     vouts = transaction_dict["vout"]
     result = (
@@ -163,7 +371,7 @@ class BitcoinClient:
       return True
     return False
 
-  @keep_alive
+  @single_attempt
   def transaction_need_signature(self, raw_transaction):
     """
     This is shameful ugly function. It tries to send transaction to network
@@ -173,12 +381,17 @@ class BitcoinClient:
     try:
       self.server.sendrawtransaction(raw_transaction)
       return False
-    except ProtocolError:
+    except RPC_ERRORS:
       return True
 
+  @single_attempt
+  def send_raw_transaction(self, raw_transaction):
+    # returns txid, raises one of RPC_ERRORS if bitcoind rejects the transaction
+    return self.server.sendrawtransaction(raw_transaction)
+
   @keep_alive
   def transaction_contains_output(self, raw_transaction, address, fee):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self._parse_transaction(raw_transaction)
     if not 'vout' in transaction_dict:
       return False
     for vout in transaction_dict['vout']:
@@ -221,7 +434,7 @@ class BitcoinClient:
   def create_raw_transaction(self, tx_inputs, outputs):
     return self.server.createrawtransaction(tx_inputs, outputs)
 
-  @keep_alive
+  @single_attempt
   def get_new_address(self):
     if self.account:
       return self.server.getnewaddress(self.account)
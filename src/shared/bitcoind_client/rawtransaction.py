@@ -0,0 +1,259 @@
+"""
+In-process decoder for raw transactions. Covers what our read-only helpers
+need from decoderawtransaction (inputs, outputs, scripts, locktime, txid),
+and returns dicts of the same shape, so they don't need a bitcoind round-trip.
+Anything it can't parse raises TransactionParseError, callers fall back to
+bitcoind then.
+"""
+import binascii
+import hashlib
+import struct
+
+try:
+  hashlib.new('ripemd160')
+  def ripemd160(data):
+    return hashlib.new('ripemd160', data).digest()
+except ValueError:
+  # openssl builds without ripemd160
+  from Crypto.Hash import RIPEMD
+  def ripemd160(data):
+    return RIPEMD.new(data).digest()
+
+PUBKEY_ADDRESS_VERSION = 0
+SCRIPT_ADDRESS_VERSION = 5
+
+COIN = 100000000
+
+OP_0 = 0x00
+OP_PUSHDATA1 = 0x4c
+OP_PUSHDATA2 = 0x4d
+OP_PUSHDATA4 = 0x4e
+OP_1NEGATE = 0x4f
+OP_1 = 0x51
+OP_16 = 0x60
+OP_RETURN = 0x6a
+OP_DUP = 0x76
+OP_EQUAL = 0x87
+OP_EQUALVERIFY = 0x88
+OP_HASH160 = 0xa9
+OP_CHECKSIG = 0xac
+OP_CHECKMULTISIG = 0xae
+
+OP_NAMES = {
+    0x61: 'OP_NOP', 0x63: 'OP_IF', 0x64: 'OP_NOTIF', 0x67: 'OP_ELSE',
+    0x68: 'OP_ENDIF', 0x69: 'OP_VERIFY', 0x6a: 'OP_RETURN', 0x75: 'OP_DROP',
+    0x76: 'OP_DUP', 0x87: 'OP_EQUAL', 0x88: 'OP_EQUALVERIFY', 0xa8: 'OP_SHA256',
+    0xa9: 'OP_HASH160', 0xaa: 'OP_HASH256', 0xac: 'OP_CHECKSIG',
+    0xad: 'OP_CHECKSIGVERIFY', 0xae: 'OP_CHECKMULTISIG',
+    0xaf: 'OP_CHECKMULTISIGVERIFY', 0xb1: 'OP_CHECKLOCKTIMEVERIFY',
+}
+
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+class TransactionParseError(ValueError):
+  pass
+
+
+def double_sha256(data):
+  return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def hash160(data):
+  return ripemd160(hashlib.sha256(data).digest())
+
+def base58check(version, payload):
+  data = chr(version) + payload
+  data += double_sha256(data)[:4]
+  number = int(binascii.hexlify(data), 16)
+  encoded = ''
+  while number > 0:
+    number, rest = divmod(number, 58)
+    encoded = BASE58_ALPHABET[rest] + encoded
+  leading_zeros = len(data) - len(data.lstrip('\0'))
+  return BASE58_ALPHABET[0] * leading_zeros + encoded
+
+def amount_to_value(satoshis):
+  # the same float jsonrpclib gets from bitcoind's "%.8f" formatted amount
+  return float('%d.%08d' % divmod(satoshis, COIN))
+
+
+class Reader:
+  def __init__(self, data):
+    self.data = data
+    self.offset = 0
+
+  def unpack(self, fmt, size):
+    if self.offset + size > len(self.data):
+      raise TransactionParseError('unexpected end of transaction')
+    value = struct.unpack_from(fmt, self.data, self.offset)[0]
+    self.offset += size
+    return value
+
+  def read(self, size):
+    if self.offset + size > len(self.data):
+      raise TransactionParseError('unexpected end of transaction')
+    chunk = self.data[self.offset:self.offset + size]
+    self.offset += size
+    return chunk
+
+  def varint(self):
+    first = self.unpack('<B', 1)
+    if first == 0xfd:
+      return self.unpack('<H', 2)
+    if first == 0xfe:
+      return self.unpack('<I', 4)
+    if first == 0xff:
+      return self.unpack('<Q', 8)
+    return first
+
+  def at_end(self):
+    return self.offset == len(self.data)
+
+
+def script_ops(script):
+  """
+  Yields (opcode, pushed data or None) for every operation in the script
+  """
+  reader = Reader(script)
+  while not reader.at_end():
+    opcode = reader.unpack('<B', 1)
+    if 0 < opcode < OP_PUSHDATA1:
+      yield opcode, reader.read(opcode)
+    elif opcode == OP_PUSHDATA1:
+      yield opcode, reader.read(reader.unpack('<B', 1))
+    elif opcode == OP_PUSHDATA2:
+      yield opcode, reader.read(reader.unpack('<H', 2))
+    elif opcode == OP_PUSHDATA4:
+      yield opcode, reader.read(reader.unpack('<I', 4))
+    elif opcode == OP_0:
+      yield opcode, ''
+    else:
+      yield opcode, None
+
+def script_number(data):
+  # little endian with sign bit, as CScriptNum
+  if data == '':
+    return 0
+  number = int(binascii.hexlify(data[::-1]), 16)
+  if ord(data[-1]) & 0x80:
+    return -(number & ~(0x80 << (8 * (len(data) - 1))))
+  return number
+
+def script_to_asm(script):
+  elements = []
+  try:
+    for opcode, data in script_ops(script):
+      if data is not None:
+        if len(data) <= 4:
+          elements.append(str(script_number(data)))
+        else:
+          elements.append(binascii.hexlify(data))
+      elif opcode == OP_1NEGATE:
+        elements.append('-1')
+      elif OP_1 <= opcode <= OP_16:
+        elements.append(str(opcode - OP_1 + 1))
+      else:
+        elements.append(OP_NAMES.get(opcode, 'OP_UNKNOWN'))
+  except TransactionParseError:
+    # push past the end of script, bitcoind shows it the same way
+    elements.append('[error]')
+  return ' '.join(elements)
+
+def script_pubkey_dict(script):
+  script_dict = {
+      'asm': script_to_asm(script),
+      'hex': binascii.hexlify(script)}
+  try:
+    ops = list(script_ops(script))
+  except TransactionParseError:
+    ops = []
+  opcodes = [opcode for opcode, data in ops]
+
+  if opcodes == [OP_DUP, OP_HASH160, 20, OP_EQUALVERIFY, OP_CHECKSIG]:
+    script_dict['type'] = 'pubkeyhash'
+    addresses = [base58check(PUBKEY_ADDRESS_VERSION, ops[2][1])]
+    req_sigs = 1
+  elif opcodes == [OP_HASH160, 20, OP_EQUAL]:
+    script_dict['type'] = 'scripthash'
+    addresses = [base58check(SCRIPT_ADDRESS_VERSION, ops[1][1])]
+    req_sigs = 1
+  elif len(ops) == 2 and opcodes[1] == OP_CHECKSIG and opcodes[0] in (33, 65):
+    script_dict['type'] = 'pubkey'
+    addresses = [base58check(PUBKEY_ADDRESS_VERSION, hash160(ops[0][1]))]
+    req_sigs = 1
+  elif len(ops) >= 4 and opcodes[-1] == OP_CHECKMULTISIG \
+      and OP_1 <= opcodes[0] <= OP_16 and OP_1 <= opcodes[-2] <= OP_16 \
+      and opcodes[-2] - OP_1 + 1 == len(ops) - 3 \
+      and all(opcode in (33, 65) for opcode in opcodes[1:-2]):
+    script_dict['type'] = 'multisig'
+    addresses = [base58check(PUBKEY_ADDRESS_VERSION, hash160(data)) for opcode, data in ops[1:-2]]
+    req_sigs = opcodes[0] - OP_1 + 1
+  elif len(ops) > 0 and opcodes[0] == OP_RETURN:
+    script_dict['type'] = 'nulldata'
+    return script_dict
+  else:
+    script_dict['type'] = 'nonstandard'
+    return script_dict
+
+  script_dict['reqSigs'] = req_sigs
+  script_dict['addresses'] = addresses
+  return script_dict
+
+
+def parse_transaction(raw_transaction):
+  """
+  raw_transaction - hex string, or raw bytes (str/memoryview)
+  returns dict shaped like bitcoind's decoderawtransaction
+  """
+  if isinstance(raw_transaction, memoryview):
+    data = raw_transaction.tobytes()
+  else:
+    data = raw_transaction
+    try:
+      data = binascii.unhexlify(raw_transaction)
+    except (TypeError, binascii.Error):
+      # not hex - already raw bytes
+      pass
+
+  try:
+    return _parse(data)
+  except struct.error as e:
+    raise TransactionParseError(str(e))
+
+def _parse(data):
+  reader = Reader(data)
+  transaction = {'version': reader.unpack('<I', 4)}
+
+  vin = []
+  for i in range(reader.varint()):
+    prev_hash = reader.read(32)
+    prev_n = reader.unpack('<I', 4)
+    script = reader.read(reader.varint())
+    sequence = reader.unpack('<I', 4)
+    if prev_hash == '\0' * 32 and prev_n == 0xffffffff:
+      vin.append({'coinbase': binascii.hexlify(script), 'sequence': sequence})
+      continue
+    vin.append({
+        'txid': binascii.hexlify(prev_hash[::-1]),
+        'vout': prev_n,
+        'scriptSig': {
+            'asm': script_to_asm(script),
+            'hex': binascii.hexlify(script)},
+        'sequence': sequence})
+
+  vout = []
+  for n in range(reader.varint()):
+    satoshis = reader.unpack('<q', 8)
+    script = reader.read(reader.varint())
+    vout.append({
+        'value': amount_to_value(satoshis),
+        'n': n,
+        'scriptPubKey': script_pubkey_dict(script)})
+
+  transaction['locktime'] = reader.unpack('<I', 4)
+  if not reader.at_end():
+    raise TransactionParseError('trailing data after transaction')
+
+  transaction['vin'] = vin
+  transaction['vout'] = vout
+  transaction['txid'] = binascii.hexlify(double_sha256(data)[::-1])
+  return transaction
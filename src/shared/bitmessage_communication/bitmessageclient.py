@@ -10,14 +10,38 @@ from bitmessagemessage import BitmessageMessage
 from bitmessageserver import BitmessageServer
 from bitmessageexceptions import ChanAlreadySubscribedException
 
+import httplib
 import json
 import base64
 import logging
+import random
+import socket
+import threading
+import time
+import xmlrpclib
+
+# how many times a call is retried after reconnecting on a transport error
+API_RETRIES = 3
+# upper bound (seconds) of the first random delay before a retry,
+# doubled with every next attempt
+RETRY_BASE_DELAY = 0.5
+
+# errors meaning the API connection is broken. BitmessageExceptions are
+# answers from the API and are passed to the caller
+TRANSPORT_ERRORS = (socket.error, httplib.HTTPException, xmlrpclib.ProtocolError)
 
 class BitmessageClient:
 
   def __init__(self, default_address_label=DEFAULT_ADDRESS_LABEL):
     self.default_address_label = default_address_label
+    # msgids already returned by get_unread_messages, None until the first
+    # full inbox fetch
+    self.seen_msgids = None
+
+    # Bitmessage API handles one call at a time anyway
+    self.lock = threading.RLock()
+    self.reconnects = 0
+    self.retries = 0
     self.connect()
     self.get_addresses()
     self.update_address_if_empty()
@@ -28,27 +52,49 @@ class BitmessageClient:
     self.api = BitmessageServer()
 
   def keep_alive(fun):
-    def ping_and_reconnect(self, *args, **kwargs):
-      try:
-        response = self.api.helloWorld('x', 'y')
-        assert(response == "x-y")
-        response = fun(self, *args, **kwargs)
-        return response
-      except:
-        self.connect()
-        return getattr(self, fun.__name__)(*args, **kwargs)
-    return ping_and_reconnect
+    # only public methods are wrapped, they call the API directly or through
+    # unwrapped _methods, so a failure is retried once and not in every level
+    def call_and_reconnect(self, *args, **kwargs):
+      with self.lock:
+        retries = 0
+        while True:
+          try:
+            return fun(self, *args, **kwargs)
+          except TRANSPORT_ERRORS:
+            logging.warning('bitmessage connection lost during {0}, reconnecting'.format(fun.__name__))
+            # also when giving up, so the next call doesn't get the broken one
+            self.reconnects += 1
+            self.connect()
+            if retries >= API_RETRIES:
+              raise
+            # jitter, so restarted API isn't hit by all the retries at once
+            time.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** retries))
+            retries += 1
+            self.retries += 1
+    call_and_reconnect.__name__ = fun.__name__
+    return call_and_reconnect
+
+  def stats(self):
+    return {
+        'reconnects': self.reconnects,
+        'retries': self.retries}
 
   @keep_alive
   def create_random_address(self, label=None):
+    self._create_random_address(label)
+
+  def _create_random_address(self, label=None):
     if not label:
       label = self.default_address_label
     label_base64 = base64.encodestring(label)
     self.api.createRandomAddress(label_base64)
-    self.get_addresses()
+    self._get_addresses()
 
   @keep_alive
   def get_addresses(self):
+    self._get_addresses()
+
+  def _get_addresses(self):
     addresses_json = self.api.listAddresses2()
     logging.debug(addresses_json)
     address_list = json.loads(addresses_json)['addresses']
@@ -60,12 +106,11 @@ class BitmessageClient:
 
     self.default_address = self.find_default_address()
     if not self.default_address:
-      self.create_random_address()
+      self._create_random_address()
 
     self.default_address = self.find_default_address()
     # if none - raise exception? it will happen eventually
 
-  @keep_alive
   def find_default_address(self):
     default_address = None
     for address in self.enabled_addresses:
@@ -78,7 +123,7 @@ class BitmessageClient:
   def update_address_if_empty(self):
     if len(self.addresses) > 0:
       return
-    self.create_random_address()
+    self._create_random_address()
 
   @keep_alive
   def send_message(self, address, subject, message):
@@ -99,18 +144,60 @@ class BitmessageClient:
 
   @keep_alive
   def get_inbox(self):
+    return self._get_inbox()
+
+  def _get_inbox(self):
     messages_json = self.api.getAllInboxMessages()
-    messages_list = json.loads(messages_json)['inboxMessages']
+    return BitmessageMessage.from_json(messages_json, self.default_address)
+
+  @keep_alive
+  def get_inbox_message(self, msgid):
+    return self._get_inbox_message(msgid)
+
+  def _get_inbox_message(self, msgid):
+    # single argument call doesn't change the read status of the message
+    message_json = self.api.getInboxMessageById(msgid)
+    messages = BitmessageMessage.from_json(
+        message_json, self.default_address, key='inboxMessage')
+    if len(messages) == 0:
+      return None
+    return messages[0]
 
-    messages_inbox = \
-        [BitmessageMessage(msg, self.default_address) for msg in messages_list]
+  @keep_alive
+  def get_inbox_ids(self):
+    return self._get_inbox_ids()
 
-    return messages_inbox
+  def _get_inbox_ids(self):
+    ids_json = self.api.getAllInboxMessageIds()
+    return [msg['msgid'] for msg in json.loads(ids_json)['inboxMessageIds']]
 
   @keep_alive
   def get_unread_messages(self):
-    messages = self.get_inbox()
-    unread_messages = [msg for msg in messages if not msg.read]
+    """
+    First call fetches the whole inbox, later ones only fetch messages whose
+    ids we haven't seen yet, so a steady-state poll costs one id listing plus
+    one call per new message.
+    """
+    if self.seen_msgids is None:
+      messages = self._get_inbox()
+      self.seen_msgids = set(msg.msgid for msg in messages)
+      return [msg for msg in messages if not msg.read]
+
+    inbox_ids = self._get_inbox_ids()
+    new_ids = [msgid for msgid in inbox_ids if not msgid in self.seen_msgids]
+
+    unread_messages = []
+    for msgid in new_ids:
+      msg = self._get_inbox_message(msgid)
+      if msg and not msg.read:
+        unread_messages.append(msg)
+    # remembered only once the whole batch is fetched, if a fetch fails the
+    # messages fetched before it are returned by the next call
+    self.seen_msgids.update(new_ids)
+
+    # forget ids of trashed messages so the set doesn't outgrow the inbox
+    if len(self.seen_msgids) > len(inbox_ids):
+      self.seen_msgids.intersection_update(inbox_ids)
     return unread_messages
 
   @keep_alive
@@ -128,6 +215,9 @@ class BitmessageClient:
     else:
       msgid = msg
     self.api.getInboxMessageByID(msgid, False)
+    # let get_unread_messages pick it up again
+    if self.seen_msgids is not None:
+      self.seen_msgids.discard(msgid)
 
   @keep_alive
   def trash_message(self, msgid):
@@ -2,7 +2,23 @@ import base64
 import datetime
 import json
 
-class BitmessageMessage:
+class BitmessageMessage(object):
+  """
+  Inbox entry. Subject and body stay base64 encoded until someone reads them,
+  most of the chan traffic is rejected before that happens.
+  """
+  __slots__ = (
+      'encoding_type',
+      'from_address',
+      'to_address',
+      'received_time_epoch',
+      'read',
+      'msgid',
+      'subject_encoded',
+      'message_encoded',
+      'direct',
+      '_subject',
+      '_message')
 
   def __init__(self, message_dict, client_address):
     self.encoding_type = message_dict['encodingType']
@@ -11,18 +27,46 @@ class BitmessageMessage:
     self.to_address = message_dict['toAddress']
 
     self.received_time_epoch = int(message_dict['receivedTime'])
-    self.received_time = datetime.datetime.fromtimestamp(self.received_time_epoch)
 
     self.read = message_dict['read'] == True
     self.msgid = message_dict['msgid']
 
     self.subject_encoded = message_dict['subject']
-    self.subject = base64.decodestring(self.subject_encoded)
-
     self.message_encoded = message_dict['message']
-    self.message = base64.decodestring(self.message_encoded)
+    self._subject = None
+    self._message = None
+
     self.direct = self.to_address == client_address
 
+  @classmethod
+  def from_json(cls, messages_json, client_address, key='inboxMessages'):
+    # builds all messages of a single API response
+    return [cls(msg, client_address) for msg in json.loads(messages_json)[key]]
+
+  @property
+  def subject(self):
+    if self._subject is None:
+      self._subject = base64.decodestring(self.subject_encoded)
+    return self._subject
+
+  @subject.setter
+  def subject(self, value):
+    self._subject = value
+
+  @property
+  def message(self):
+    if self._message is None:
+      self._message = base64.decodestring(self.message_encoded)
+    return self._message
+
+  @message.setter
+  def message(self, value):
+    self._message = value
+
+  @property
+  def received_time(self):
+    return datetime.datetime.fromtimestamp(self.received_time_epoch)
+
   def __repr__(self):
     return "BitmessageMessage(id:{0})".format(self.msgid)
 
@@ -7,6 +7,11 @@ import re
 import time
 import logging
 
+try:
+  from settings_local import BITMESSAGE_API_TIMEOUT
+except ImportError:
+  BITMESSAGE_API_TIMEOUT = 30
+
 def check_exception(result):
   number = get_exception_number(result)
   if number:
@@ -18,6 +23,17 @@ def get_exception_number(result):
     return None
   return r.group(1)
 
+class TimeoutTransport(xmlrpclib.Transport):
+  def __init__(self, timeout):
+    xmlrpclib.Transport.__init__(self)
+    self.timeout = timeout
+
+  def make_connection(self, host):
+    connection = xmlrpclib.Transport.make_connection(self, host)
+    connection.timeout = self.timeout
+    return connection
+
+
 class BitmessageServer:
   def __init__(self):
     try_factor = 1
@@ -28,7 +44,8 @@ class BitmessageServer:
             BITMESSAGE_USERNAME,
             BITMESSAGE_PASSWORD,
             BITMESSAGE_HOST,
-            BITMESSAGE_PORT))
+            BITMESSAGE_PORT),
+            transport=TimeoutTransport(BITMESSAGE_API_TIMEOUT))
         self.api.helloWorld('x', 'y')
         return
       except:
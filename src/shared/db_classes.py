@@ -1,50 +1,182 @@
 from collections import defaultdict
+from contextlib import contextmanager
 
+import logging
 import sqlite3
+import threading
 import time
 
+# sqlite PRAGMA synchronous for every connection. With WAL journal NORMAL is
+# durable against application crashes, power loss can lose the last commits
+try:
+  from settings_local import DB_SYNCHRONOUS
+except ImportError:
+  DB_SYNCHRONOUS = 'NORMAL'
+
+# seconds a connection waits for another one to release the write lock
+DB_BUSY_TIMEOUT = 30
+
 class GeneralDb:
+  """
+  Every thread gets its own connection (sqlite connections can't be shared
+  between threads). Connections use WAL journal, so readers don't block the
+  writer and the other way round.
+  """
 
   def __init__(self, filename):
     self._filename = filename
+    self.local = threading.local()
+    # TableDb instances of this db, one per class
+    self.tables = {}
+    self.tables_lock = threading.RLock()
     self.connect()
 
+  def migrate(self):
+    """
+    Creates and migrates tables of every TableDb subclass imported so far.
+    Meant to be called once at startup, so table objects made later don't
+    have to check the schema
+    """
+    for table_class in TableDb.table_classes():
+      table_class(self)
+
   def connect(self):
-    self.conn = sqlite3.connect(self._filename, detect_types=sqlite3.PARSE_COLNAMES)
-    self.conn.row_factory = sqlite3.Row
+    conn = sqlite3.connect(self._filename, detect_types=sqlite3.PARSE_COLNAMES, timeout=DB_BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    conn.execute('pragma journal_mode=wal')
+    conn.execute('pragma synchronous=%s' % DB_SYNCHRONOUS)
+    self.local.conn = conn
+    self.local.transaction_depth = 0
+
+  @property
+  def conn(self):
+    if getattr(self.local, 'conn', None) is None:
+      self.connect()
+    return self.local.conn
+
+  def in_transaction(self):
+    return getattr(self.local, 'transaction_depth', 0) > 0
+
+  @contextmanager
+  def transaction(self):
+    """
+    Commits everything done inside the block once, at the end of the
+    outermost transaction() (commit() calls inside are skipped). Rolls back
+    if the outermost block raises.
+
+    sqlite takes the write lock at the first write of the block and holds it
+    until the end, so other threads' writes wait meanwhile. Slow calls (RPC,
+    HTTP) belong before the first write, or in after_commit()
+    """
+    conn = self.conn
+    if self.local.transaction_depth == 0:
+      self.local.after_commit = []
+    self.local.transaction_depth += 1
+    try:
+      yield
+    except:
+      self.local.transaction_depth -= 1
+      if self.local.transaction_depth == 0:
+        self.rollback()
+        self.local.after_commit = []
+      raise
+    self.local.transaction_depth -= 1
+    if self.local.transaction_depth == 0:
+      conn.commit()
+      callbacks, self.local.after_commit = self.local.after_commit, []
+      for callback in callbacks:
+        try:
+          callback()
+        except:
+          # what the block wrote is committed already, so it isn't failed
+          logging.exception('after commit callback failed')
+
+  def after_commit(self, callback):
+    """
+    Calls callback once the current transaction() is committed, it's dropped
+    if it's rolled back. Outside transaction() it's called right away
+    """
+    if self.in_transaction():
+      self.local.after_commit.append(callback)
+    else:
+      callback()
 
   def commit(self):
+    if self.in_transaction():
+      return
     self.conn.commit()
 
+  def rollback(self):
+    self.conn.rollback()
+
   def execute(self, sql):
     cursor = self.conn.cursor()
     cursor.execute(sql)
-    self.conn.commit()
+    self.commit()
 
   def get_cursor(self):
-    if not self.conn:
-      self.connect()
-
     try:
       return self.conn.cursor()
-    except:
+    except sqlite3.ProgrammingError:
+      # connection was closed
       self.connect()
       return self.conn.cursor()
 
 
-class TableDb:
+class TableDb(object):
   """
   TableDb is class designed as wrapper for new tables and database requests.
-  It creates table when needed, so no need to worry about it
+  It creates table when needed, so no need to worry about it.
+  There is one instance per class and db, so constructing it again (e.g.
+  KeyValue(db) in every handler) is only a dictionary lookup
   """
   table_name = "TableDB"
   exist_sql = "select name from sqlite_master where type='table' and name='{0}'"
 
+  # schema changes (indexes, new columns) applied in order after create_sql.
+  # Number of applied ones is kept in schema_version table, so new
+  # migrations should only be appended
+  migrations = []
+  version_table_sql = "create table if not exists schema_version ( \
+      table_name text primary key, \
+      version integer not null)"
+  version_sql = "select version from schema_version where table_name=?"
+  set_version_sql = "insert or replace into schema_version (table_name, version) values (?, ?)"
+
+  def __new__(cls, db):
+    table = db.tables.get(cls)
+    if table is not None:
+      return table
+
+    with db.tables_lock:
+      table = db.tables.get(cls)
+      if table is None:
+        table = object.__new__(cls)
+        table.setup(db)
+        db.tables[cls] = table
+    return table
+
   def __init__(self, db):
+    # everything is done once, in setup()
+    pass
+
+  def setup(self, db):
     self.db = db
     if not self.table_exists():
       self.create_table()
-  
+    if self.migrations:
+      self.migrate()
+
+  @classmethod
+  def table_classes(cls):
+    # all subclasses that define a table, in definition order of the hierarchy
+    classes = []
+    for subclass in cls.__subclasses__():
+      if 'create_sql' in subclass.__dict__:
+        classes.append(subclass)
+      classes.extend(subclass.table_classes())
+    return classes
+
   def table_exists(self):
     cursor = self.db.get_cursor()
     sql = self.exist_sql.format(self.table_name)
@@ -58,6 +190,27 @@ class TableDb:
     cursor.execute(sql)
     self.db.commit()
 
+  def schema_version(self):
+    cursor = self.db.get_cursor()
+    if not cursor.execute(self.exist_sql.format('schema_version')).fetchall():
+      return 0
+    row = cursor.execute(self.version_sql, (self.table_name, )).fetchone()
+    if row:
+      return row['version']
+    return 0
+
+  def migrate(self):
+    version = self.schema_version()
+    if version >= len(self.migrations):
+      return
+
+    cursor = self.db.get_cursor()
+    cursor.execute(self.version_table_sql)
+    for sql in self.migrations[version:]:
+      cursor.execute(sql.format(self.table_name))
+    cursor.execute(self.set_version_sql, (self.table_name, len(self.migrations)))
+    self.db.commit()
+
   def args_for_obj(self, obj):
     raise NotImplementedError()
 
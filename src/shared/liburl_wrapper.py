@@ -1,37 +1,184 @@
-import signal
+"""
+HTTP helpers safe to call from any thread. Every request has its own
+deadline (no signals, no process-wide socket timeout), and keep-alive
+connections are pooled per host, so repeated calls to the same service
+don't pay for a new TCP/TLS handshake.
+"""
+import httplib
+import logging
 import socket
-import urllib2
+import threading
+import time
 import urllib
+import urlparse
 
 TIMEOUT = 10
 
-socket.setdefaulttimeout(TIMEOUT)
+# idle keep-alive connections kept per host
+MAX_IDLE_CONNECTIONS = 4
+MAX_REDIRECTS = 3
+READ_CHUNK = 16 * 1024
 
-def timeout_catcher(signum, _):
-  raise urllib2.URLError("Read timeout")
+PUSHTX_URL = 'http://eligius.st/~wizkid057/newstats/pushtxn.php'
 
-signal.signal(signal.SIGALRM, timeout_catcher)
+class HttpError(Exception):
+  pass
+
+class DeadlineExceeded(HttpError):
+  pass
+
+
+class HttpClient:
+  def __init__(self, max_idle=MAX_IDLE_CONNECTIONS):
+    self.max_idle = max_idle
+    self.lock = threading.Lock()
+    # (scheme, host, port) -> idle connections
+    self.idle = {}
+
+    self.requests = 0
+    self.reused = 0
+    self.errors = 0
+
+  def get_connection(self, key, timeout):
+    with self.lock:
+      connections = self.idle.get(key)
+      if connections:
+        self.reused += 1
+        connection = connections.pop()
+        connection.sock.settimeout(timeout)
+        return connection, True
+
+    scheme, host, port = key
+    if scheme == 'https':
+      return httplib.HTTPSConnection(host, port, timeout=timeout), False
+    return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+  def release(self, key, connection):
+    with self.lock:
+      connections = self.idle.setdefault(key, [])
+      if len(connections) < self.max_idle:
+        connections.append(connection)
+        return
+    connection.close()
+
+  def request(self, method, url, body=None, headers=None, timeout=TIMEOUT):
+    """
+    Returns (status, response body). The whole request, including redirects,
+    has to finish within timeout seconds, DeadlineExceeded is raised
+    otherwise. Connection problems raise socket.error/httplib.HTTPException
+    """
+    deadline = time.time() + timeout
+    try:
+      for redirect in range(MAX_REDIRECTS + 1):
+        status, location, content = self.request_once(method, url, body, headers or {}, deadline)
+        if not (status in (301, 302, 303, 307) and location and method == 'GET'):
+          return status, content
+        url = urlparse.urljoin(url, location)
+      raise HttpError('too many redirects')
+    except Exception:
+      # requests run in many threads
+      with self.lock:
+        self.errors += 1
+      raise
+
+  def request_once(self, method, url, body, headers, deadline):
+    parsed = urlparse.urlsplit(url)
+    default_port = 443 if parsed.scheme == 'https' else 80
+    key = (parsed.scheme, parsed.hostname, parsed.port or default_port)
+    path = parsed.path or '/'
+    if parsed.query:
+      path += '?' + parsed.query
+
+    with self.lock:
+      self.requests += 1
+    done = False
+    while not done:
+      connection, reused = self.get_connection(key, self.remaining(deadline))
+      try:
+        connection.request(method, path, body, headers)
+        # getresponse drops connection.sock when the server won't keep it alive
+        sock = connection.sock
+        response = connection.getresponse()
+        content = self.read(response, sock, deadline)
+        done = True
+      except socket.timeout:
+        raise DeadlineExceeded('deadline exceeded')
+      except (socket.error, httplib.HTTPException):
+        # server may have closed an idle connection, try a fresh one
+        if not reused:
+          raise
+      finally:
+        # on any error, DeadlineExceeded from read included, the connection
+        # is in an unknown state, so it's neither pooled nor left open
+        if not done:
+          connection.close()
+
+    if response.will_close:
+      connection.close()
+    else:
+      self.release(key, connection)
+    return response.status, response.getheader('location'), content
+
+  def read(self, response, sock, deadline):
+    chunks = []
+    while True:
+      # socket timeout bounds a single read, the deadline the whole response
+      sock.settimeout(self.remaining(deadline))
+      chunk = response.read(READ_CHUNK)
+      if not chunk:
+        return ''.join(chunks)
+      chunks.append(chunk)
+
+  def remaining(self, deadline):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      raise DeadlineExceeded('deadline exceeded')
+    return remaining
+
+  def get(self, url, timeout=TIMEOUT):
+    # returns response body, raises HttpError on non 2xx status
+    status, content = self.request('GET', url, timeout=timeout)
+    if not 200 <= status < 300:
+      raise HttpError('%s returned %d' % (url, status))
+    return content
+
+  def post_form(self, url, fields, timeout=TIMEOUT):
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    status, content = self.request('POST', url, urllib.urlencode(fields), headers, timeout)
+    if not 200 <= status < 300:
+      raise HttpError('%s returned %d' % (url, status))
+    return content
+
+  def close(self):
+    with self.lock:
+      idle, self.idle = self.idle, {}
+    for connections in idle.values():
+      for connection in connections:
+        connection.close()
+
+  def stats(self):
+    with self.lock:
+      idle = sum(len(connections) for connections in self.idle.values())
+    return {
+        'requests': self.requests,
+        'reused_connections': self.reused,
+        'idle_connections': idle,
+        'errors': self.errors}
+
+# shared by the whole process
+http = HttpClient()
 
 def safe_read(url, timeout_time):
-  signal.setitimer(signal.ITIMER_REAL, timeout_time)
   try:
-    content = urllib2.urlopen(url, timeout=timeout_time).read()
-    signal.setitimer(signal.ITIMER_REAL, 0)
-    return content
-  except:
-    signal.setitimer(signal.ITIMER_REAL, 0)
+    return http.get(url, timeout_time)
+  except Exception as e:
+    logging.debug('reading %s failed: %r' % (url, e))
     return None
 
 def safe_pushtx(tx, timeout_time = 10):
-  signal.setitimer(signal.ITIMER_REAL, timeout_time)
+  #thanks http://www.pythonforbeginners.com/python-on-the-web/how-to-use-urllib2-in-python/
   try:
-    #thanks http://www.pythonforbeginners.com/python-on-the-web/how-to-use-urllib2-in-python/
-    query_args = {'send': 'Push', 'transaction': tx}
-    data = urllib.urlencode(query_args)
-    url = 'http://eligius.st/~wizkid057/newstats/pushtxn.php'
-    content = urllib2.urlopen(url, data, timeout=timeout_time).read()
-    signal.setitimer(signal.ITIMER_REAL, 0)
-    return content
-  except:
-    signal.setitimer(signal.ITIMER_REAL, 0)
+    return http.post_form(PUSHTX_URL, {'send': 'Push', 'transaction': tx}, timeout_time)
+  except Exception as e:
+    logging.debug('pushing transaction failed: %r' % e)
     return None
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+import threading
+
+class LRUCache:
+  """
+  Size bounded dict-like cache. When full, the least recently used entry
+  is evicted. Keeps hit/miss counters so it's possible to check if the cache
+  actually helps.
+  """
+  def __init__(self, size):
+    self.size = size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, default=None):
+    with self.lock:
+      try:
+        value = self.entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self.entries[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      if len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def add(self, key, value):
+    # like put, but keeps the value that is already cached
+    with self.lock:
+      if key in self.entries:
+        return
+      self.entries[key] = value
+      if len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def discard(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def __len__(self):
+    return len(self.entries)
+
+  def stats(self):
+    return {
+        'size': len(self.entries),
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions}
@@ -0,0 +1,153 @@
+"""
+BTC/USD price for contracts that depend on it. Concurrent callers share one
+fetch, the result is cached for PRICE_TTL seconds, and with several sources
+configured they're queried in parallel and the median is used, so a single
+exchange being off or down doesn't decide a contract.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+import json
+import logging
+import threading
+import time
+
+from liburl_wrapper import http
+
+# name -> (ticker url, function taking the price out of the decoded response)
+KNOWN_SOURCES = {
+    'bitstamp': ('https://www.bitstamp.net/api/ticker/', lambda ticker: ticker['last']),
+    'bitfinex': ('https://api.bitfinex.com/v1/pubticker/btcusd', lambda ticker: ticker['last_price']),
+    'coinbase': ('https://api.coinbase.com/v2/prices/BTC-USD/spot', lambda ticker: ticker['data']['amount']),
+}
+
+try:
+  from settings_local import PRICE_SOURCES
+except ImportError:
+  PRICE_SOURCES = ['bitstamp']
+
+PRICE_TTL = 30
+FETCH_TIMEOUT = 10
+
+def median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2
+
+
+class Flight:
+  # a fetch in progress, callers that come during it wait for its result
+  def __init__(self):
+    self.done = threading.Event()
+    self.observation = None
+
+
+class PriceFeed:
+  def __init__(self, sources=None, ttl=PRICE_TTL, timeout=FETCH_TIMEOUT):
+    """
+    sources - list of (name, url, extract) tuples, PRICE_SOURCES by default
+    """
+    if sources is None:
+      sources = [(name, ) + KNOWN_SOURCES[name] for name in PRICE_SOURCES]
+    self.sources = sources
+    self.ttl = ttl
+    self.timeout = timeout
+
+    self.lock = threading.Lock()
+    # (time it was fetched, price) of the last good fetch
+    self.observation = None
+    self.flight = None
+
+    self.fetches = 0
+    self.cache_hits = 0
+    self.coalesced = 0
+    self.failures = defaultdict(int)
+
+  def get_price(self, max_age=None):
+    """
+    Returns current price as Decimal, None if no source answered
+    """
+    observation = self.observe(max_age)
+    if observation is None:
+      return None
+    return observation[1]
+
+  def observe(self, max_age=None):
+    """
+    Returns (fetch time, price) not older than max_age seconds (PRICE_TTL
+    by default), None if no source answered
+    """
+    if max_age is None:
+      max_age = self.ttl
+
+    with self.lock:
+      if self.observation is not None and time.time() - self.observation[0] < max_age:
+        self.cache_hits += 1
+        return self.observation
+
+      leader = self.flight is None
+      if leader:
+        self.flight = Flight()
+      else:
+        self.coalesced += 1
+      flight = self.flight
+
+    if not leader:
+      flight.done.wait(self.timeout + 1)
+      return flight.observation
+
+    try:
+      price = self.fetch()
+      if price is not None:
+        flight.observation = (time.time(), price)
+    finally:
+      with self.lock:
+        if flight.observation is not None:
+          self.observation = flight.observation
+        self.flight = None
+      flight.done.set()
+    return flight.observation
+
+  def fetch(self):
+    self.fetches += 1
+    if len(self.sources) == 1:
+      prices = [self.fetch_source(*self.sources[0])]
+    else:
+      prices = [None] * len(self.sources)
+      def fetch_into(idx, source):
+        prices[idx] = self.fetch_source(*source)
+
+      threads = [threading.Thread(target=fetch_into, args=(idx, source))
+          for idx, source in enumerate(self.sources)]
+      for thread in threads:
+        thread.daemon = True
+        thread.start()
+      deadline = time.time() + self.timeout
+      for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+
+    prices = [price for price in prices if price is not None]
+    if not prices:
+      return None
+    return median(prices)
+
+  def fetch_source(self, name, url, extract):
+    try:
+      response = http.get(url, self.timeout)
+      price = Decimal(str(extract(json.loads(response))))
+      if price <= 0:
+        raise ValueError('price %s' % price)
+      return price
+    except Exception as e:
+      logging.warning('price source %s failed: %r' % (name, e))
+      self.failures[name] += 1
+      return None
+
+  def stats(self):
+    return {
+        'fetches': self.fetches,
+        'cache_hits': self.cache_hits,
+        'coalesced': self.coalesced,
+        'failures': dict(self.failures)}
@@ -0,0 +1,142 @@
+"""
+Validators for JSON request bodies. A schema is built once from the functions
+below, each of them returns a check function:
+
+  check(value) -> None if value is valid, error message otherwise
+
+so validating a request is a few nested function calls, without walking
+a schema description every time.
+
+  validate = obj({'txid': hex_string(lengths=(64, )), 'vout': integer(min_value=0)})
+  error = validate(json.loads(body))
+"""
+import re
+
+HEX_RE = re.compile('^[0-9a-fA-F]*$')
+DECIMAL_RE = re.compile(r'^[0-9]+(?:\.[0-9]+)?$')
+
+NUMBER_TYPES = (int, long, float)
+STRING_TYPES = (str, unicode)
+
+def anything():
+  def check(value):
+    return None
+  return check
+
+def _range_error(value, min_value, max_value):
+  if min_value is not None and value < min_value:
+    return '%r lower than %r' % (value, min_value)
+  if max_value is not None and value > max_value:
+    return '%r higher than %r' % (value, max_value)
+  return None
+
+def integer(min_value=None, max_value=None):
+  def check(value):
+    # bool is an int subclass, but never a valid number here
+    if not isinstance(value, (int, long)) or isinstance(value, bool):
+      return 'expected integer, got %s' % type(value).__name__
+    return _range_error(value, min_value, max_value)
+  return check
+
+def number(min_value=None, max_value=None):
+  def check(value):
+    if not isinstance(value, NUMBER_TYPES) or isinstance(value, bool):
+      return 'expected number, got %s' % type(value).__name__
+    return _range_error(value, min_value, max_value)
+  return check
+
+def amount(min_value=0, max_value=None):
+  # bitcoin amount - number, or decimal string like "0.0001"
+  check_number = number(min_value, max_value)
+  def check(value):
+    if isinstance(value, STRING_TYPES):
+      if not DECIMAL_RE.match(value):
+        return 'expected decimal amount, got %r' % value[:20]
+      value = float(value)
+    return check_number(value)
+  return check
+
+def string(min_length=0, max_length=None, pattern=None):
+  regex = re.compile(pattern) if pattern else None
+  def check(value):
+    if not isinstance(value, STRING_TYPES):
+      return 'expected string, got %s' % type(value).__name__
+    if len(value) < min_length:
+      return 'string shorter than %d' % min_length
+    if max_length is not None and len(value) > max_length:
+      return 'string longer than %d' % max_length
+    if regex and not regex.match(value):
+      return '%r has wrong format' % value[:20]
+    return None
+  return check
+
+def hex_string(lengths=None, max_length=None):
+  """
+  lengths - allowed lengths in characters (e.g. (64, ) for a txid)
+  """
+  def check(value):
+    if not isinstance(value, STRING_TYPES):
+      return 'expected hex string, got %s' % type(value).__name__
+    if lengths is not None and len(value) not in lengths:
+      return 'hex string of length %d, expected %r' % (len(value), lengths)
+    if max_length is not None and len(value) > max_length:
+      return 'hex string longer than %d' % max_length
+    if len(value) % 2 or not HEX_RE.match(value):
+      return '%r is not hex' % value[:20]
+    return None
+  return check
+
+def list_of(item, min_length=0, max_length=None):
+  def check(value):
+    if not isinstance(value, list):
+      return 'expected list, got %s' % type(value).__name__
+    if len(value) < min_length:
+      return 'list shorter than %d' % min_length
+    if max_length is not None and len(value) > max_length:
+      return 'list longer than %d' % max_length
+    for idx, element in enumerate(value):
+      error = item(element)
+      if error:
+        return '[%d]: %s' % (idx, error)
+    return None
+  return check
+
+def dict_of(key, value, min_length=0, max_length=None):
+  def check(obj_value):
+    if not isinstance(obj_value, dict):
+      return 'expected object, got %s' % type(obj_value).__name__
+    if len(obj_value) < min_length:
+      return 'object with less than %d entries' % min_length
+    if max_length is not None and len(obj_value) > max_length:
+      return 'object with more than %d entries' % max_length
+    for k, v in obj_value.iteritems():
+      error = key(k) or value(v)
+      if error:
+        return '%s: %s' % (k, error)
+    return None
+  return check
+
+def obj(fields, optional=None):
+  """
+  fields - name -> check of required fields
+  optional - name -> check of fields that may be missing
+  Other fields are allowed and not checked.
+  """
+  required = sorted(fields.items())
+  optional = sorted((optional or {}).items())
+  def check(value):
+    if not isinstance(value, dict):
+      return 'expected object, got %s' % type(value).__name__
+    for name, check_field in required:
+      if not name in value:
+        return '%s: missing' % name
+      error = check_field(value[name])
+      if error:
+        return '%s: %s' % (name, error)
+    for name, check_field in optional:
+      if name in value:
+        error = check_field(value[name])
+        if error:
+          return '%s: %s' % (name, error)
+    return None
+  return check
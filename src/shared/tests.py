@@ -0,0 +1,743 @@
+from bitmessage_communication.bitmessagemessage import BitmessageMessage
+from bitmessage_communication.bitmessageclient import BitmessageClient
+from bitmessage_communication import bitmessageclient
+from bitcoind_client.bitcoinclient import BitcoinClient, TimeoutTransport, RPC_ERRORS, rpc_error_code
+from bitcoind_client import bitcoinclient
+from lru_cache import LRUCache
+from bitcoind_client.rawtransaction import parse_transaction, TransactionParseError
+from db_classes import GeneralDb, TableDb
+from schema import obj, integer, number, amount, string, hex_string, list_of, dict_of
+from price_feed import PriceFeed
+from liburl_wrapper import HttpClient, HttpError, DeadlineExceeded, safe_read, http
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from decimal import Decimal
+
+import base64
+import binascii
+import json
+import jsonrpclib
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+def create_inbox_entry(subject, body, msgid='dummy'):
+  return {
+      'encodingType': 2,
+      'fromAddress': 'dummy',
+      'toAddress': 'dummy',
+      'read': False,
+      'receivedTime': 1000,
+      'msgid': msgid,
+      'subject': base64.encodestring(subject),
+      'message': base64.encodestring(body)}
+
+class BitmessageMessageTests(unittest.TestCase):
+  def test_lazy_decoding(self):
+    message = BitmessageMessage(create_inbox_entry('subject', '{"a": 1}'), 'dummyaddress')
+    self.assertIsNone(message._message)
+    self.assertEqual(message.subject, 'subject')
+    self.assertEqual(json.loads(message.message), {'a': 1})
+    self.assertEqual(message.received_time.year, 1970)
+
+  def test_message_can_be_replaced(self):
+    message = BitmessageMessage(create_inbox_entry('subject', '{"a": 1}'), 'dummyaddress')
+    message.message = json.loads(message.message)
+    self.assertEqual(message.message, {'a': 1})
+
+  def test_from_json(self):
+    entries = [create_inbox_entry('s', 'm', msgid=str(i)) for i in range(3)]
+    messages = BitmessageMessage.from_json(
+        json.dumps({'inboxMessages': entries}), 'dummyaddress')
+    self.assertEqual([m.msgid for m in messages], ['0', '1', '2'])
+    self.assertEqual(messages[2].message, 'm')
+
+class StubBitmessageApi:
+  """
+  Inbox part of the Bitmessage API. failures - msgid -> how many fetches of
+  the message fail with a transport error. Fetched msgids are recorded
+  """
+  def __init__(self):
+    self.inbox = []
+    self.failures = {}
+    self.fetched = []
+
+  def add(self, msgid, read=False):
+    self.inbox.append({
+        'msgid': msgid,
+        'read': read,
+        'encodingType': 2,
+        'fromAddress': 'BM-sender',
+        'toAddress': 'BM-chan',
+        'receivedTime': '1000',
+        'subject': base64.encodestring('subject'),
+        'message': base64.encodestring('message %s' % msgid)})
+
+  def getAllInboxMessages(self):
+    return json.dumps({'inboxMessages': self.inbox})
+
+  def getAllInboxMessageIds(self):
+    return json.dumps({'inboxMessageIds': [{'msgid': msg['msgid']} for msg in self.inbox]})
+
+  def getInboxMessageById(self, msgid, read=None):
+    self.fetched.append(msgid)
+    if self.failures.get(msgid):
+      self.failures[msgid] -= 1
+      raise socket.error('connection reset by peer')
+    messages = [msg for msg in self.inbox if msg['msgid'] == msgid]
+    for msg in messages:
+      if read is not None:
+        msg['read'] = read
+    return json.dumps({'inboxMessage': messages})
+
+  # the API accepts both spellings
+  getInboxMessageByID = getInboxMessageById
+
+class StubApiBitmessageClient(BitmessageClient):
+  # without the address and chan setup, which needs the rest of the API
+  def __init__(self, api):
+    self.stub_api = api
+    self.default_address = 'BM-oracle'
+    self.seen_msgids = None
+    self.lock = threading.RLock()
+    self.reconnects = 0
+    self.retries = 0
+    self.connect()
+
+  def connect(self):
+    self.api = self.stub_api
+
+class BitmessageClientTests(unittest.TestCase):
+  def setUp(self):
+    self.retry_delay = bitmessageclient.RETRY_BASE_DELAY
+    bitmessageclient.RETRY_BASE_DELAY = 0
+    self.api = StubBitmessageApi()
+    self.client = StubApiBitmessageClient(self.api)
+
+  def tearDown(self):
+    bitmessageclient.RETRY_BASE_DELAY = self.retry_delay
+
+  def unread_ids(self):
+    return [msg.msgid for msg in self.client.get_unread_messages()]
+
+  def test_first_call_reads_whole_inbox(self):
+    self.api.add('a')
+    self.api.add('b', read=True)
+    self.assertEqual(self.unread_ids(), ['a'])
+    self.assertEqual(self.api.fetched, [])
+
+  def test_later_calls_fetch_new_messages(self):
+    self.api.add('a')
+    self.unread_ids()
+    self.api.add('b')
+    self.api.add('c', read=True)
+    self.assertEqual(self.unread_ids(), ['b'])
+    self.assertEqual(self.api.fetched, ['b', 'c'])
+    self.assertEqual(self.unread_ids(), [])
+    self.assertEqual(self.api.fetched, ['b', 'c'])
+
+  def test_unread_again(self):
+    self.api.add('a')
+    self.unread_ids()
+    self.client.mark_message_as_read('a')
+    self.client.mark_message_as_unread('a')
+    self.assertEqual(self.unread_ids(), ['a'])
+
+  def test_failure_in_the_middle_of_a_batch(self):
+    self.unread_ids()
+    for msgid in 'abc':
+      self.api.add(msgid)
+    self.api.failures['b'] = 1
+    self.assertEqual(self.unread_ids(), ['a', 'b', 'c'])
+
+  def test_failed_batch_is_returned_by_next_call(self):
+    self.unread_ids()
+    for msgid in 'abc':
+      self.api.add(msgid)
+    self.api.failures['b'] = 1000
+    self.assertRaises(socket.error, self.client.get_unread_messages)
+    self.api.failures['b'] = 0
+    self.assertEqual(self.unread_ids(), ['a', 'b', 'c'])
+
+  def test_batch_retried_only_by_outer_call(self):
+    self.unread_ids()
+    self.api.add('a')
+    self.api.failures['a'] = 1000
+    self.assertRaises(socket.error, self.client.get_unread_messages)
+    # one attempt plus API_RETRIES retries, not retried again inside
+    self.assertEqual(len(self.api.fetched), bitmessageclient.API_RETRIES + 1)
+
+  def test_counters(self):
+    self.unread_ids()
+    self.api.add('a')
+    self.api.failures['a'] = 1
+    self.unread_ids()
+    self.assertEqual(self.client.stats(), {'reconnects': 1, 'retries': 1})
+    self.api.failures['a'] = 1000
+    self.client.seen_msgids.clear()
+    self.assertRaises(socket.error, self.client.get_unread_messages)
+    stats = self.client.stats()
+    self.assertEqual(stats['retries'], 1 + bitmessageclient.API_RETRIES)
+    self.assertEqual(stats['reconnects'], stats['retries'] + 1)
+
+class LRUCacheTests(unittest.TestCase):
+  def test_evicts_least_recently_used(self):
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    self.assertEqual(cache.get('a'), 1)
+    cache.put('c', 3)
+    self.assertNotIn('b', cache)
+    self.assertIn('a', cache)
+    self.assertEqual(len(cache), 2)
+
+  def test_add_keeps_cached_value(self):
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.add('a', 2)
+    cache.add('b', 3)
+    self.assertEqual(cache.get('a'), 1)
+    self.assertEqual(cache.get('b'), 3)
+
+  def test_counters(self):
+    cache = LRUCache(1)
+    cache.put('a', 1)
+    cache.get('a')
+    cache.get('b')
+    cache.put('b', 2)
+    stats = cache.stats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 1, 1))
+
+GENESIS_COINBASE = (
+  "01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d01"
+  "04455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f6620"
+  "7365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548"
+  "271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b"
+  "8d578a4c702b6bf11d5fac00000000")
+FAKE_TXID = '3bda4918180fd55775a24580652f4c26d898d5840c7e71313491a05ef0b743d8'
+FAKE_PUBKEYS = [
+  "0446ea8a207cb52c15c36bed7fb4cabc6d86df92ae0e1d32eb5274352c41fe763751150205aa93b07432030e9fe9f4a3e546925656c9ea69ab3977d5885215868d",
+  "04ae31650f219e598a2c69beeb97867c9d3a292581af56ee156394f639ee4d6d7d19d2f4c9c565cc962fc5ecb5954edd1df13a8cd49962b8ebb78143c69cff7d6a",
+]
+
+def push(data):
+  if len(data) < 0x4c:
+    return chr(len(data)) + data
+  return '\x4c' + chr(len(data)) + data
+
+def varint(number):
+  if number < 0xfd:
+    return chr(number)
+  return '\xfd' + struct.pack('<H', number)
+
+def create_multisig_spend(signatures):
+  # 2-of-2 multisig input with given signatures and two outputs
+  redeem_script = '\x52' + ''.join(push(binascii.unhexlify(k)) for k in FAKE_PUBKEYS) + '\x52\xae'
+  script_sig = '\x00' + ''.join(push(sig) for sig in signatures) + push(redeem_script)
+  p2pkh = '\x76\xa9\x14' + '\x00' * 20 + '\x88\xac'
+  p2sh = '\xa9\x14' + '\x00' * 20 + '\x87'
+  tx = struct.pack('<I', 1) + '\x01'
+  tx += binascii.unhexlify(FAKE_TXID)[::-1] + struct.pack('<I', 1)
+  tx += varint(len(script_sig)) + script_sig + struct.pack('<I', 0xffffffff)
+  tx += '\x02'
+  tx += struct.pack('<q', 10000) + chr(len(p2pkh)) + p2pkh
+  tx += struct.pack('<q', 123456789) + chr(len(p2sh)) + p2sh
+  tx += struct.pack('<I', 1402318623)
+  return binascii.hexlify(tx), redeem_script
+
+class RawTransactionTests(unittest.TestCase):
+  def test_genesis_coinbase(self):
+    # fields as returned by decoderawtransaction
+    tx = parse_transaction(GENESIS_COINBASE)
+    self.assertEqual(tx['txid'], '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b')
+    self.assertEqual(tx['locktime'], 0)
+    self.assertIn('coinbase', tx['vin'][0])
+    vout = tx['vout'][0]
+    self.assertEqual(vout['value'], 50.0)
+    self.assertEqual(vout['scriptPubKey']['type'], 'pubkey')
+    self.assertEqual(vout['scriptPubKey']['addresses'], ['1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'])
+
+  def test_bytes_and_memoryview(self):
+    raw = binascii.unhexlify(GENESIS_COINBASE)
+    self.assertEqual(parse_transaction(raw), parse_transaction(GENESIS_COINBASE))
+    self.assertEqual(parse_transaction(memoryview(raw)), parse_transaction(GENESIS_COINBASE))
+
+  def test_multisig_spend(self):
+    tx_hex, redeem_script = create_multisig_spend(['\x30' * 71, '\x31' * 71])
+    tx = parse_transaction(tx_hex)
+    vin = tx['vin'][0]
+    self.assertEqual((vin['txid'], vin['vout']), (FAKE_TXID, 1))
+    asm = vin['scriptSig']['asm'].split()
+    self.assertEqual(asm[0], '0')
+    self.assertEqual(asm[1], '30' * 71)
+    self.assertEqual(asm[-1], binascii.hexlify(redeem_script))
+    self.assertEqual(tx['locktime'], 1402318623)
+
+    p2pkh, p2sh = tx['vout']
+    self.assertEqual(p2pkh['value'], 0.0001)
+    self.assertEqual(p2pkh['scriptPubKey']['addresses'], ['1111111111111111111114oLvT2'])
+    self.assertEqual(p2sh['value'], 1.23456789)
+    self.assertEqual(p2sh['scriptPubKey']['type'], 'scripthash')
+
+  def test_truncated_transaction(self):
+    self.assertRaises(TransactionParseError, parse_transaction, GENESIS_COINBASE[:-10])
+    self.assertRaises(TransactionParseError, parse_transaction, GENESIS_COINBASE + '00')
+
+
+class SchemaTests(unittest.TestCase):
+  def setUp(self):
+    self.validate = obj({
+        'txid': hex_string(lengths=(64, )),
+        'vout': integer(min_value=0),
+        'prevtxs': list_of(obj({'vout': integer()}), min_length=1, max_length=2),
+        'outputs': dict_of(string(), amount())},
+      optional={'locktime': number(min_value=0)})
+    self.valid = {
+        'txid': 'ab' * 32,
+        'vout': 1,
+        'prevtxs': [{'vout': 0}],
+        'outputs': {'addr': '0.0001', 'other': 2}}
+
+  def invalid(self, **changes):
+    body = dict(self.valid)
+    body.update(changes)
+    return self.validate(body)
+
+  def test_valid(self):
+    self.assertIsNone(self.validate(self.valid))
+    self.assertIsNone(self.invalid(locktime=1.5, extra='ignored'))
+
+  def test_missing_field(self):
+    body = dict(self.valid)
+    del body['vout']
+    self.assertEqual(self.validate(body), 'vout: missing')
+
+  def test_types(self):
+    self.assertIn('vout', self.invalid(vout='1'))
+    self.assertIn('vout', self.invalid(vout=True))
+    self.assertIn('prevtxs', self.invalid(prevtxs={'vout': 0}))
+    self.assertIn('locktime', self.invalid(locktime='now'))
+    self.assertIsNotNone(self.validate([]))
+
+  def test_ranges_and_lengths(self):
+    self.assertIn('vout', self.invalid(vout=-1))
+    self.assertIn('prevtxs', self.invalid(prevtxs=[]))
+    self.assertIn('prevtxs', self.invalid(prevtxs=[{'vout': 0}] * 3))
+    self.assertIn('[1]', self.invalid(prevtxs=[{'vout': 0}, {'vout': 'x'}]))
+    self.assertIn('outputs', self.invalid(outputs={'addr': '-1'}))
+
+  def test_hex(self):
+    self.assertIn('txid', self.invalid(txid='zz' * 32))
+    self.assertIn('txid', self.invalid(txid='ab'))
+
+class CounterTable(TableDb):
+  table_name = 'counter'
+  create_sql = 'create table {0} (id integer primary key, value integer)'
+  setups = 0
+
+  def setup(self, db):
+    TableDb.setup(self, db)
+    CounterTable.setups += 1
+
+class GeneralDbTests(unittest.TestCase):
+  def setUp(self):
+    self.filename = tempfile.mktemp(suffix='.db')
+    self.db = GeneralDb(self.filename)
+    self.db.execute('create table t (a integer)')
+
+  def tearDown(self):
+    for filename in (self.filename, self.filename + '.other'):
+      for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(filename + suffix):
+          os.remove(filename + suffix)
+
+  def count_from_other_connection(self):
+    # a fresh connection sees only committed rows
+    return GeneralDb(self.filename).get_cursor().execute('select count(*) from t').fetchone()[0]
+
+  def test_wal_journal(self):
+    mode = self.db.get_cursor().execute('pragma journal_mode').fetchone()[0]
+    self.assertEqual(mode, 'wal')
+
+  def test_transaction_commits_once(self):
+    with self.db.transaction():
+      self.db.get_cursor().execute('insert into t values (1)')
+      self.db.commit()
+      with self.db.transaction():
+        self.db.get_cursor().execute('insert into t values (2)')
+      self.assertEqual(self.count_from_other_connection(), 0)
+    self.assertEqual(self.count_from_other_connection(), 2)
+
+  def test_transaction_rollback(self):
+    try:
+      with self.db.transaction():
+        self.db.get_cursor().execute('insert into t values (1)')
+        raise ValueError()
+    except ValueError:
+      pass
+    self.assertEqual(self.count_from_other_connection(), 0)
+    self.assertFalse(self.db.in_transaction())
+
+  def test_connection_per_thread(self):
+    connections = []
+    thread = threading.Thread(target=lambda: connections.append(self.db.conn))
+    thread.start()
+    thread.join()
+    self.assertIsNot(connections[0], self.db.conn)
+
+  def test_table_instance_per_db(self):
+    CounterTable.setups = 0
+    table = CounterTable(self.db)
+    self.assertIs(CounterTable(self.db), table)
+    self.assertEqual(CounterTable.setups, 1)
+
+    other_db = GeneralDb(self.filename + '.other')
+    self.assertIsNot(CounterTable(other_db), table)
+    self.assertEqual(CounterTable.setups, 2)
+
+  def test_migrate_creates_tables(self):
+    self.assertIn(CounterTable, TableDb.table_classes())
+    self.db.migrate()
+    self.assertIn(CounterTable, self.db.tables)
+    self.assertTrue(CounterTable(self.db).table_exists())
+
+
+class StubTickerServer(ThreadingMixIn, HTTPServer):
+  """
+  Serves /<price> as a bitstamp-like ticker, /fail with 500. Requests are
+  counted per path, and answered after delay seconds
+  """
+  daemon_threads = True
+
+  def __init__(self, delay=0):
+    HTTPServer.__init__(self, ('127.0.0.1', 0), StubTickerHandler)
+    self.delay = delay
+    self.requests = []
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def url(self, path):
+    return 'http://127.0.0.1:%d/%s' % (self.server_address[1], path)
+
+  def handle_error(self, request, client_address):
+    # clients that gave up waiting close the connection early
+    pass
+
+class StubTickerHandler(BaseHTTPRequestHandler):
+  # keep-alive, with responses sent in one write (see benchmarks/http_bench.py)
+  protocol_version = 'HTTP/1.1'
+  wbufsize = -1
+
+  def do_GET(self):
+    self.server.requests.append(self.path)
+    time.sleep(self.server.delay)
+    if self.path == '/fail':
+      self.send_response(500)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    body = json.dumps({'last': self.path[1:]})
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class StubRpcError(Exception):
+  def __init__(self, code, message):
+    Exception.__init__(self, message)
+    self.code = code
+    self.message = message
+
+class StubBitcoindServer(ThreadingMixIn, HTTPServer):
+  """
+  JSON-RPC server answering like bitcoind. methods - name -> function of
+  the call params, raising StubRpcError for an error answer, which is sent
+  with HTTP status 500 as bitcoind does. Batches are answered with 200 and
+  a result or error for every call. Calls are recorded as (method, params),
+  HTTP requests are counted. The next `drops` requests get the connection
+  closed without an answer. Batches are answered in reverse order, which
+  JSON-RPC allows
+  """
+  daemon_threads = True
+
+  def __init__(self, methods):
+    HTTPServer.__init__(self, ('127.0.0.1', 0), StubBitcoindHandler)
+    self.methods = methods
+    self.calls = []
+    self.requests = 0
+    self.drops = 0
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  def handle_error(self, request, client_address):
+    pass
+
+class StubBitcoindHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  wbufsize = -1
+
+  def answer(self, call):
+    params = call.get('params') or []
+    self.server.calls.append((call['method'], params))
+    try:
+      result = self.server.methods[call['method']](*params)
+    except StubRpcError as e:
+      return {'result': None, 'error': {'code': e.code, 'message': e.message}, 'id': call['id']}
+    return {'result': result, 'error': None, 'id': call['id']}
+
+  def do_POST(self):
+    request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+    self.server.requests += 1
+    if self.server.drops:
+      # bitcoind may have acted on it, but the answer is lost
+      self.server.drops -= 1
+      for call in (request if isinstance(request, list) else [request]):
+        self.server.calls.append((call['method'], call.get('params') or []))
+      self.close_connection = True
+      return
+    if isinstance(request, list):
+      status, answer = 200, [self.answer(call) for call in request][::-1]
+    else:
+      answer = self.answer(request)
+      status = 500 if answer['error'] else 200
+    body = json.dumps(answer)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class BitcoinClientTests(unittest.TestCase):
+  def setUp(self):
+    self.server = StubBitcoindServer({
+        'getblockcount': lambda: 100,
+        'getnewaddress': lambda *account: '1NewAddress',
+        'decoderawtransaction': lambda transaction: {'txid': 'decoded-' + transaction, 'vin': [], 'vout': []},
+        'decodescript': lambda script: {'asm': 'decoded-' + script},
+        'sendrawtransaction': self.send_raw_transaction})
+    port = bitcoinclient.BITCOIND_RPC_PORT
+    bitcoinclient.BITCOIND_RPC_PORT = self.server.port
+    try:
+      self.client = BitcoinClient()
+    finally:
+      bitcoinclient.BITCOIND_RPC_PORT = port
+    # reconnecting goes to the stub as well
+    self.client.connect = lambda: setattr(self.client, 'server', jsonrpclib.Server(
+        'http://127.0.0.1:%d' % self.server.port, transport=TimeoutTransport(5)))
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def send_raw_transaction(self, transaction):
+    if transaction == 'rejected':
+      raise StubRpcError(-26, 'rejected')
+    return 'txid-' + transaction
+
+  def methods(self):
+    return [method for method, params in self.server.calls]
+
+  def test_call(self):
+    self.assertEqual(self.client.ping(), 100)
+    self.assertEqual(self.client.stats()['reconnects'], 0)
+
+  def test_retried_after_reconnect(self):
+    self.server.drops = 1
+    self.assertEqual(self.client.ping(), 100)
+    self.assertEqual(self.methods(), ['getblockcount'] * 2)
+    stats = self.client.stats()
+    self.assertEqual((stats['reconnects'], stats['retries']), (1, 1))
+
+  def test_gives_up_after_retries(self):
+    self.server.drops = 100
+    self.assertRaises(bitcoinclient.TRANSPORT_ERRORS, self.client.ping)
+    self.assertEqual(self.server.requests, bitcoinclient.RPC_RETRIES + 1)
+    self.server.drops = 0
+    self.assertEqual(self.client.ping(), 100)
+
+  def test_calls_with_side_effects_not_repeated(self):
+    for call in (lambda: self.client.send_raw_transaction('aabb'), self.client.get_new_address):
+      self.server.calls = []
+      self.server.drops = 1
+      self.assertRaises(bitcoinclient.TRANSPORT_ERRORS, call)
+      self.assertEqual(len(self.server.calls), 1)
+    # on a new connection
+    self.assertEqual(self.client.send_raw_transaction('aabb'), 'txid-aabb')
+    self.assertEqual(self.client.get_new_address(), '1NewAddress')
+
+  def test_rpc_errors_not_retried(self):
+    try:
+      self.client.send_raw_transaction('rejected')
+      self.fail('rejected transaction accepted')
+    except RPC_ERRORS as e:
+      self.assertEqual(rpc_error_code(e), -26)
+    self.assertTrue(self.client.transaction_need_signature('rejected'))
+    self.assertEqual(self.methods(), ['sendrawtransaction'] * 2)
+    self.assertEqual(self.client.stats()['reconnects'], 0)
+
+  def test_decode_cache(self):
+    for i in range(2):
+      self.assertEqual(self.client.decode_raw_transaction('00')['txid'], 'decoded-00')
+      self.assertEqual(self.client.decode_script('51'), {'asm': 'decoded-51'})
+    self.assertEqual(self.methods(), ['decoderawtransaction', 'decodescript'])
+    stats = self.client.stats()
+    self.assertEqual((stats['transactions']['hits'], stats['transactions']['misses']), (1, 1))
+    self.assertEqual((stats['scripts']['hits'], stats['scripts']['misses']), (1, 1))
+
+  def test_decode_scripts_batches_misses(self):
+    self.client.decode_script('51')
+    requests = self.server.requests
+    decoded = self.client.decode_scripts(['52', '51', '53', '52'])
+    self.assertEqual([d['asm'] for d in decoded], ['decoded-52', 'decoded-51', 'decoded-53', 'decoded-52'])
+    # one request for both misses
+    self.assertEqual(self.server.requests, requests + 1)
+    self.assertEqual(sorted(self.methods()), ['decodescript'] * 3)
+
+  def test_local_parse_with_rpc_fallback(self):
+    self.assertEqual(self.client.get_txid(GENESIS_COINBASE), parse_transaction(GENESIS_COINBASE)['txid'])
+    self.assertEqual(self.server.calls, [])
+    # what the local parser can't handle goes to bitcoind
+    self.assertEqual(self.client.get_txid('00'), 'decoded-00')
+    self.assertEqual(self.server.calls, [('decoderawtransaction', ['00'])])
+
+  def test_batch(self):
+    self.assertEqual(self.client.batch([]), [])
+    self.assertEqual(self.server.requests, 0)
+    results = self.client.batch([
+        ('getblockcount', []),
+        ('decodescript', ['51']),
+        ('sendrawtransaction', ['aabb'])])
+    self.assertEqual(results, [100, {'asm': 'decoded-51'}, 'txid-aabb'])
+    self.assertEqual(self.server.requests, 1)
+
+  def test_batch_error(self):
+    calls = [('getblockcount', []), ('sendrawtransaction', ['rejected'])]
+    try:
+      self.client.batch(calls)
+      self.fail('failed call not reported')
+    except RPC_ERRORS as e:
+      self.assertEqual(rpc_error_code(e), -26)
+    # a rejected call isn't retried
+    self.assertEqual(self.server.requests, 1)
+
+class PriceFeedTests(unittest.TestCase):
+  def setUp(self):
+    self.server = StubTickerServer()
+
+  def tearDown(self):
+    http.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def feed(self, paths, **kwargs):
+    sources = [(path, self.server.url(path), lambda ticker: ticker['last']) for path in paths]
+    return PriceFeed(sources, **kwargs)
+
+  def test_median_of_sources(self):
+    self.assertEqual(self.feed(['500.5', '400', '600']).get_price(), Decimal('500.5'))
+    self.assertEqual(self.feed(['400', '600']).get_price(), Decimal('500'))
+
+  def test_failed_sources_are_skipped(self):
+    feed = self.feed(['400', 'fail'])
+    self.assertEqual(feed.get_price(), Decimal('400'))
+    self.assertEqual(feed.stats()['failures'], {'fail': 1})
+    self.assertIsNone(self.feed(['fail']).get_price())
+
+  def test_cached_for_ttl(self):
+    feed = self.feed(['400'], ttl=60)
+    feed.get_price()
+    feed.get_price()
+    self.assertEqual(len(self.server.requests), 1)
+
+    feed = self.feed(['400'], ttl=0)
+    feed.get_price()
+    feed.get_price()
+    self.assertEqual(len(self.server.requests), 3)
+
+  def test_concurrent_callers_share_a_fetch(self):
+    self.server.delay = 0.2
+    feed = self.feed(['400'])
+    prices = []
+    threads = [threading.Thread(target=lambda: prices.append(feed.get_price())) for i in range(10)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(prices, [Decimal('400')] * 10)
+    self.assertEqual(len(self.server.requests), 1)
+
+class HttpClientTests(unittest.TestCase):
+  def setUp(self):
+    self.server = StubTickerServer()
+    self.client = HttpClient()
+
+  def tearDown(self):
+    self.client.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_connections_are_reused(self):
+    for i in range(5):
+      self.assertEqual(json.loads(self.client.get(self.server.url('400'))), {'last': '400'})
+    stats = self.client.stats()
+    self.assertEqual(stats['requests'], 5)
+    self.assertEqual(stats['reused_connections'], 4)
+    self.assertEqual(stats['idle_connections'], 1)
+
+  def test_concurrent_requests(self):
+    self.server.delay = 0.05
+    results = []
+    def get(idx):
+      results.append(self.client.get(self.server.url(str(idx))))
+    threads = [threading.Thread(target=get, args=(idx, )) for idx in range(20)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(sorted(json.loads(result)['last'] for result in results),
+        sorted(str(idx) for idx in range(20)))
+    self.assertLessEqual(self.client.stats()['idle_connections'], self.client.max_idle)
+
+  def test_deadline(self):
+    self.server.delay = 0.5
+    started = time.time()
+    self.assertRaises(DeadlineExceeded, self.client.get, self.server.url('400'), 0.1)
+    self.assertLess(time.time() - started, 0.4)
+
+  def test_connection_closed_on_any_error(self):
+    connections = []
+    get_connection = self.client.get_connection
+    def record_connection(key, timeout):
+      connection, reused = get_connection(key, timeout)
+      connections.append(connection)
+      return connection, reused
+    def read(response, sock, deadline):
+      raise DeadlineExceeded('deadline exceeded')
+    self.client.get_connection = record_connection
+    self.client.read = read
+    self.assertRaises(DeadlineExceeded, self.client.get, self.server.url('400'))
+    self.assertIsNone(connections[0].sock)
+    stats = self.client.stats()
+    self.assertEqual((stats['idle_connections'], stats['errors']), (0, 1))
+
+  def test_errors(self):
+    self.assertRaises(HttpError, self.client.get, self.server.url('fail'))
+    self.assertIsNone(safe_read(self.server.url('fail'), 1))
+    self.assertIsNone(safe_read('http://127.0.0.1:1/', 1))
@@ -1,12 +1,30 @@
 #!/usr/bin/env python2.7
-from oracle.tests import OracleTests
+from oracle.tests import OracleTests, TaskPoolTests, SchedulerTests, OracleCommunicationTests, AdmissionTests, BroadcasterTests, KeyPoolTests, KeyValueTests, CompactionTests
 from client.tests import ClientTests
+from shared.tests import BitmessageMessageTests, BitmessageClientTests, BitcoinClientTests, LRUCacheTests, RawTransactionTests, GeneralDbTests, SchemaTests, PriceFeedTests, HttpClientTests
 
 import unittest
 
 TESTS = [
    OracleTests,
+   TaskPoolTests,
+   SchedulerTests,
+   OracleCommunicationTests,
+   AdmissionTests,
+   BroadcasterTests,
+   KeyPoolTests,
+   KeyValueTests,
+   CompactionTests,
    ClientTests,
+   BitmessageMessageTests,
+   BitmessageClientTests,
+   BitcoinClientTests,
+   LRUCacheTests,
+   RawTransactionTests,
+   GeneralDbTests,
+   SchemaTests,
+   PriceFeedTests,
+   HttpClientTests,
 ]
 
 def test():